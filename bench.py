@@ -0,0 +1,85 @@
+"""Measure the memory a run keeps per failed test.
+
+Fails a number of tests whose fixtures hold some data, keeps their failures
+the way the plugin used to (``(test, traceback, exc_type)`` tuples) and the
+way it does now (FailureRecords), and prints the memory still held per
+failure once the failures have been stored::
+
+    python bench.py [number of failures] [fixture bytes]
+
+Needs Python 3.4 or later, for tracemalloc.
+"""
+from __future__ import absolute_import, print_function
+
+import gc
+import sys
+import tracemalloc
+import unittest
+
+import rudolf
+
+
+class FailingTest(unittest.TestCase):
+    fixture_size = 0
+
+    def setUp(self):
+        self.fixture = bytearray(self.fixture_size)
+
+    def test_fails(self):
+        self.assertEqual(len(self.fixture), -1)
+
+
+def run_failures(count, store):
+    kept = []
+    for nr in range(count):
+        test = FailingTest("test_fails")
+        result = unittest.TestResult()
+        test.run(result)
+        # only the failure is kept, as in a real run
+        del result
+        try:
+            test.test_fails()
+        except AssertionError:
+            err = sys.exc_info()
+        text = rudolf.format_exception(*err)
+        kept.append(store(test, text, err[0]))
+        del test, err
+    return kept
+
+
+def store_tuple(test, text, exc_type):
+    return (test, text, exc_type)
+
+
+def store_record(test, text, exc_type):
+    return rudolf.FailureRecord.from_test(test, text, exc_type, str)
+
+
+def measure(count, store):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = run_failures(count, store)
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    return held
+
+
+def main(argv):
+    count = 500
+    if len(argv) > 1:
+        count = int(argv[1])
+    FailingTest.fixture_size = 10000
+    if len(argv) > 2:
+        FailingTest.fixture_size = int(argv[2])
+    print("%d failures, %d byte fixtures" % (count, FailingTest.fixture_size))
+    for name, store in [("tuples", store_tuple), ("records", store_record)]:
+        held = measure(count, store)
+        print("%-8s %10d bytes held, %8d bytes per failure"
+              % (name, held, held // count))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
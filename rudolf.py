@@ -32,18 +32,48 @@ following copyright and licensing notice:
 from __future__ import division, print_function
 
 import binascii
+import difflib
 import doctest
+import fnmatch
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import optparse
 import os
+import pprint
 import re
+import signal
 import sys
+import threading
 import time
 import traceback
+import types
 import unittest
 import warnings
+import zlib
+
+try:
+    import reprlib
+except ImportError:
+    import repr as reprlib  # Python 2
+
+try:
+    import faulthandler
+except ImportError:
+    faulthandler = None  # Python < 3.3
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # Python < 3.4
 
 import nose.config
 import nose.core
+import nose.loader
 import nose.plugins
+import nose.suite
 import nose.util
 
 # TODO
@@ -120,6 +150,25 @@ def xterm_from_rgb(rgb):
     return best_match + TABLE_START
 
 
+# Approximate RGB values of the basic 16 colours (xterm defaults), for the
+# renderers that can't use the terminal's own idea of them.
+ANSI16_RGB = ((0x00, 0x00, 0x00), (0xcd, 0x00, 0x00), (0x00, 0xcd, 0x00),
+              (0xcd, 0xcd, 0x00), (0x00, 0x00, 0xee), (0xcd, 0x00, 0xcd),
+              (0x00, 0xcd, 0xcd), (0xe5, 0xe5, 0xe5), (0x7f, 0x7f, 0x7f),
+              (0xff, 0x00, 0x00), (0x00, 0xff, 0x00), (0xff, 0xff, 0x00),
+              (0x5c, 0x5c, 0xff), (0xff, 0x00, 0xff), (0x00, 0xff, 0xff),
+              (0xff, 0xff, 0xff))
+
+
+def ansi16_from_rgb(rgb):
+    """Return the nearest basic colour to ``rgb`` as an Ansi16Color."""
+    distances = [((rc[0] - rgb[0]) ** 2 + (rc[1] - rgb[1]) ** 2
+                  + (rc[2] - rgb[2]) ** 2, index)
+                 for index, rc in enumerate(ANSI16_RGB)]
+    index = min(distances)[1]
+    return Ansi16Color(index % 8, index >= 8)
+
+
 class Xterm256Color(object):
 
     def __init__(self, xterm_color_code):
@@ -128,6 +177,19 @@ class Xterm256Color(object):
     def terminal_code(self):
         return "\033[38;5;%dm" % self._code
 
+    def rgb(self):
+        if self._code < CUBE_START:
+            return ANSI16_RGB[self._code]
+        return rgb_from_xterm(self._code)
+
+    def ansi16(self):
+        if self._code < CUBE_START:
+            return Ansi16Color(self._code % 8, self._code >= 8)
+        return ansi16_from_rgb(self.rgb())
+
+    def css_color(self):
+        return "#%02x%02x%02x" % self.rgb()
+
 
 class Ansi16Color(object):
 
@@ -135,6 +197,15 @@ class Ansi16Color(object):
         self._fg_color = foreground_color
         self._bright = bright
 
+    def ansi16(self):
+        return self
+
+    def css_color(self):
+        if self._fg_color is None:
+            return "inherit"
+        index = self._fg_color + 8 * bool(self._bright)
+        return "#%02x%02x%02x" % ANSI16_RGB[index]
+
     def terminal_code(self):
         if self._fg_color is None:
             fg_code = 0
@@ -254,354 +325,3124 @@ def elide_foreign_path_and_line_nr(base_dir, path, line_nr):
         return relpath, line_nr
 
 
-class DocTestFailureException(AssertionError):
-    """Custom exception for doctest unit test failures."""
+class FrameFilter(object):
+    """Decides which traceback frames to hide.
 
+    A frame is hidden if its module name starts with one of
+    ``module_prefixes`` (a prefix matches whole dotted name components), if
+    its filename matches one of ``path_globs``, or if it has a local or
+    global variable named in ``markers`` (like pytest's
+    ``__tracebackhide__``).  None of that changes during a run for a given
+    code object, so decisions are cached per code object.
+    """
 
-# colour output code taken from zope.testing, and hacked
+    def __init__(self, module_prefixes=(), path_globs=(),
+                 markers=("__tracebackhide__",)):
+        self._module_prefixes = tuple(prefix.rstrip(".")
+                                      for prefix in module_prefixes)
+        self._path_globs = tuple(path_globs)
+        self._markers = tuple(markers)
+        self._hidden = {}
+        self._in_unittest = {}
 
-class ColorfulOutputFormatter(object):
-    """Output formatter that uses ANSI color codes.
+    def is_hidden(self, frame):
+        try:
+            return self._hidden[frame.f_code]
+        except KeyError:
+            hidden = self._hidden[frame.f_code] = self._decide(frame)
+            return hidden
 
-    Like syntax highlighting in your text editor, colorizing
-    test failures helps the developer.
-    """
+    def in_unittest(self, frame):
+        """Is ``frame`` in a module marked with unittest's ``__unittest``?"""
+        try:
+            return self._in_unittest[frame.f_code]
+        except KeyError:
+            marked = "__unittest" in frame.f_globals
+            self._in_unittest[frame.f_code] = marked
+            return marked
 
-    separator1 = "=" * 70
-    separator2 = "-" * 70
+    def _decide(self, frame):
+        code = frame.f_code
+        for marker in self._markers:
+            if marker in code.co_varnames or marker in frame.f_globals:
+                return True
+        module = frame.f_globals.get("__name__") or ""
+        for prefix in self._module_prefixes:
+            if module == prefix or module.startswith(prefix + "."):
+                return True
+        if self._path_globs:
+            filename = code.co_filename
+            for glob in self._path_globs:
+                if fnmatch.fnmatch(filename, glob):
+                    return True
+        return False
 
-    doctest_template = """
-File "%s", line %s, in %s
+    def extract(self, tb, limit=None):
+        """Like traceback.extract_tb, leaving out hidden frames."""
+        return [entry for entry, frame in self.extract_frames(tb, limit)]
 
-%s
-Want:
-%s
-Got:
-%s
-"""
+    def extract_frames(self, tb, limit=None):
+        """Return ``(entry, frame)`` for each frame that isn't hidden.
 
-    # Map prefix character to color in diff output.  This handles ndiff and
-    # udiff correctly, but not cdiff.
-    diff_color = {"-": "expected-output",
-                  "+": "actual-output",
-                  "?": "character-diffs",
-                  "@": "diff-chunk",
-                  "*": "diff-chunk",
-                  "!": "actual-output"}
+        ``entry`` is what traceback.extract_tb gives for the frame.  Source
+        lines are only looked up for the frames that are kept.
+        """
+        kept = []
+        for tb in _walk_tb(tb, limit):
+            if not self.is_hidden(tb.tb_frame):
+                kept.append((traceback.extract_tb(tb, 1)[0], tb.tb_frame))
+        return kept
 
-    def __init__(self, verbosity, descriptions, colorscheme,
-                 stream=sys.stdout, clean_tracebacks=False, base_dir=False):
-        self._stream = stream
-        self._verbose = bool(verbosity)
-        self._show_all = verbosity > 1
-        self._dots = verbosity == 1
-        self._descriptions = descriptions
-        self._clean_tracebacks = clean_tracebacks
-        self._base_dir = base_dir
-        self._colorscheme = colorscheme
 
-    def color(self, what):
-        """Pick a named color from the color scheme"""
-        return self._colorscheme[what].terminal_code()
+def _walk_tb(tb, limit=None):
+    """Return the traceback entries of ``tb`` that traceback.extract_tb()
+    would show with ``limit``."""
+    entries = []
+    while tb is not None:
+        entries.append(tb)
+        tb = tb.tb_next
+    if limit is None:
+        limit = getattr(sys, "tracebacklimit", None)
+    if limit is None:
+        return entries
+    if limit >= 0:
+        return entries[:limit]
+    return entries[limit:]
 
-    def colorize(self, what, message, normal="normal"):
-        """Wrap message in color."""
-        return u'' + self.color(what) + message + self.color(normal)
 
-    def get_description(self, test):
-        if self._descriptions:
-            return test.shortDescription() or str(test)
-        else:
-            return str(test)
+def parse_frame_filters(filters_text):
+    """Return a FrameFilter from a comma-separated list of filters.
 
-    def start_test(self, test):
-        if self._show_all:
-            self._stream.write(self.colorize("normal",
-                                             self.get_description(test)))
-            self._stream.write(self.colorize("normal", " ... "))
-        self._stream.flush()
+    Each filter is ``module:PREFIX``, ``path:GLOB`` or ``marker:NAME``.
+    """
+    kinds = {"module": [], "path": [], "marker": ["__tracebackhide__"]}
+    if filters_text:
+        for spec in filters_text.split(","):
+            try:
+                kind, value = spec.split(":", 1)
+                kinds[kind].append(value)
+            except (ValueError, KeyError):
+                raise ValueError("Bad frame filter (expected module:PREFIX, "
+                                 "path:GLOB or marker:NAME): %r" % spec)
+            if not value:
+                raise ValueError("Missing value in frame filter: %r" % spec)
+    return FrameFilter(kinds["module"], kinds["path"], kinds["marker"])
 
-    def test_success(self, test):
-        if self._show_all:
-            self._stream.writeln(self.colorize("pass", "ok"))
-        elif self._dots:
-            self._stream.write(self.colorize("pass", "."))
 
-    def test_error(self, test, exc_info, label):
-        if self._show_all:
-            self._stream.writeln(self.colorize("error", label))
-        elif self._dots:
-            self._stream.write(self.colorize("error", label[:1]))
+class _BoundedRepr(reprlib.Repr):
+    """A reprlib.Repr that never calls repr() on a big value.
 
-    def test_skip(self, label):
-        if self._show_all:
-            self._stream.writeln(self.colorize("skip", label))
-        elif self._dots:
-            self._stream.write(self.colorize("skip", label[:1]))
+    reprlib only limits the builtin containers and str; it calls repr() on
+    anything else and truncates the result afterwards.  Here bytes are cut
+    before repr(), subclasses of the builtin containers get the limited
+    container reprs, and other values with more than ``maxlen`` items are
+    only shown as ``<Type len=N>``.
+    """
 
-    def test_failure(self, test, exc_info):
-        if self._show_all:
-            self._stream.writeln(self.colorize("failure", "FAIL"))
-        elif self._dots:
-            self._stream.write(self.colorize("failure", "F"))
+    maxlen = 1000
+    _containers = (("dict", dict), ("list", list), ("tuple", tuple),
+                   ("set", set), ("frozenset", frozenset))
 
-    def print_error_list(self, flavour, errors):
-        problem_color = {
-            "FAIL": "failure",
-            "SKIP": "skip"
-        }.get(flavour, "error")
-        for tup in errors:
-            test, err = tup[:2]
-            try:
-                err_type = tup[2]
-            except IndexError:
-                err_type = None
-            # Handle skip message
-            skip_msg = ""
-            if flavour == "SKIP":
-                reason = getattr(err, "message", None)
-                if reason:
-                    skip_msg = " (%s)" % self.colorize("skip", reason)
-            self._stream.writeln(self.separator1)
-            self._stream.writeln("%s: %s%s" % (
-                self.colorize(problem_color, flavour),
-                self.colorize("testname", self.get_description(test)),
-                skip_msg
-            ))
-            if flavour != "SKIP":
-                self._stream.writeln(self.separator2)
-                self.print_traceback(err, err_type)
+    def repr1(self, x, level):
+        typename = type(x).__name__
+        if hasattr(self, "repr_" + typename.replace(" ", "_")):
+            return reprlib.Repr.repr1(self, x, level)
+        for name, container in self._containers:
+            if isinstance(x, container):
+                return "%s(%s)" % (typename, getattr(self, "repr_" + name)(
+                    x, level))
+        try:
+            size = len(x)
+        except Exception:
+            size = None
+        if size is not None and size > self.maxlen:
+            return "<%s len=%d>" % (typename, size)
+        return reprlib.Repr.repr1(self, x, level)
 
-    def print_summary(self, success, summary, tests_run, start, stop):
-        write = self._stream.write
-        writeln = self._stream.writeln
-        writelines = self._stream.writelines
-        taken = float(stop - start)
-        plural = tests_run != 1 and "s" or ""
-        count_color = success and "ok-number" or "error-number"
+    def repr_bytes(self, x, level):
+        # like repr_str, but slicing first
+        s = repr(bytes(x[:self.maxstring]))
+        if len(s) > self.maxstring or len(x) > self.maxstring:
+            i = max(0, (self.maxstring - 3) // 2)
+            j = max(0, self.maxstring - 3 - i)
+            s = "%s...%s" % (repr(bytes(x[:i])), repr(bytes(x[len(x) - j:])))
+        return s
 
-        writeln(self.separator2)
-        writelines([
-            "Ran ",
-            self.colorize(count_color, "%s " % tests_run),
-            "test%s in " % plural,
-            self._format_seconds(taken)])
-        writeln()
-        if not success:
-            write(self.colorize("failure", "FAILED"))
-            write(" (")
-            any = False
-            for label, count in summary.items():
-                if not count:
-                    continue
-                if any:
-                    write(", ")
-                write("%s=" % label)
-                problem_color = (label == "failures") and "failure" or "error"
-                write(self.colorize(problem_color, str(count)))
-                any = True
-            writeln(")")
-        else:
-            writeln(self.colorize("pass", "OK"))
+    def repr_bytearray(self, x, level):
+        return "bytearray(%s)" % self.repr_bytes(x, level)
 
-    def _format_seconds(self, n_seconds, normal="normal"):
-        """Format a time in seconds."""
-        if n_seconds >= 60:
-            n_minutes, n_seconds = divmod(n_seconds, 60)
-            return "%s minutes %s seconds" % (
-                   self.colorize("number", "%d" % n_minutes, normal),
-                   self.colorize("number", "%.3f" % n_seconds, normal))
-        else:
-            return "%s seconds" % (
-                   self.colorize("number", "%.3f" % n_seconds, normal))
 
-    def format_traceback(self, exc_info):
-        """Format the traceback."""
-        v = exc_info[1]
-        if isinstance(v, DocTestFailureException):
-            tb = v.args[0]
-        if isinstance(v, doctest.DocTestFailure):
-            tb = self.doctest_template % (
-                v.test.filename,
-                v.test.lineno + v.example.lineno + 1,
-                v.test.name,
-                v.example.source,
-                v.example.want,
-                v.got,
-            )
-        else:
-            tb = "".join(traceback.format_exception(*exc_info))
-        return tb
+class LocalsCapture(object):
+    """Formats the local variables of traceback frames, at bounded cost.
 
-    def print_traceback(self, formatted_traceback, err_type):
-        """Report an error with a traceback."""
-        if issubclass(err_type, DocTestFailureException):
-            self.print_doctest_failure(formatted_traceback)
-        else:
-            self.print_colorized_traceback(formatted_traceback)
-            print(file=self._stream)
+    Values are shown with reprlib, limited in size and nesting depth, and
+    at most ``max_locals`` variables are shown per frame.  Capturing stops
+    once a failure has used ``budget`` seconds.
+    """
 
-    def print_doctest_failure(self, formatted_failure):
-        """Report a doctest failure.
+    indentation = " " * 8
 
-        ``formatted_failure`` is a string -- that's what
-        DocTestSuite/DocFileSuite gives us.
-        """
-        color_of_indented_text = 'normal'
-        colorize_diff = False
-        colorize_exception = False
-        lines = formatted_failure.splitlines()
+    def __init__(self, budget=0.1, max_locals=25, maxstring=80, maxother=80,
+                 maxlevel=2):
+        self.budget = budget
+        self._max_locals = max_locals
+        self._repr = _BoundedRepr()
+        self._repr.maxstring = maxstring
+        self._repr.maxother = maxother
+        self._repr.maxlevel = maxlevel
 
-        # this first traceback in a doctest failure report is rarely
-        # interesting, but it looks funny non-colourized so let's colourize it
-        # anyway
-        exc_lines = []
-        while True:
-            line = lines.pop(0)
-            if line == self.separator2:
+    def _safe_repr(self, value):
+        try:
+            return self._repr.repr(value)
+        except Exception as exc:
+            return "<repr() failed: %s>" % type(exc).__name__
+
+    def format_frames(self, frames):
+        """Return a list of formatted locals for each frame in ``frames``.
+
+        The innermost (last) frames are usually the interesting ones, so
+        they get the time budget first.
+        """
+        deadline = time.time() + self.budget
+        formatted = [[] for frame in frames]
+        for index in range(len(frames) - 1, -1, -1):
+            if time.time() > deadline:
+                formatted[index].append(
+                    "%s(locals not captured: time budget exceeded)\n" %
+                    self.indentation)
                 break
-            exc_lines.append(line)
-        self.print_colorized_traceback("\n".join(exc_lines))
-        print(file=self._stream)
-        print(self.separator2, file=self._stream)
-        exc_lines = []
+            formatted[index] = self.format_locals(frames[index], deadline)
+        return formatted
 
-        for line in lines:
-            if line.startswith('File '):
-                m = re.match(r'File "(.*)", line (\d*), in (.*)$', line)
-                if m:
-                    filename, lineno, test = m.groups()
-                    if self._clean_tracebacks:
-                        filename, lineno = elide_foreign_path_and_line_nr(
-                            self._base_dir, filename, lineno)
-                    self._stream.writelines([
-                        self.color('normal'), 'File "',
-                        self.color('filename'), filename,
-                        self.color('normal'), '", line ',
-                        self.color('lineno'), lineno,
-                        self.color('normal'), ', in ',
-                        self.color('testname'), test,
-                        self.color('normal'), '\n'])
-                else:
-                    print(line, file=self._stream)
-            elif line.startswith('    '):
-                if colorize_diff and len(line) > 4:
-                    color = self.diff_color.get(line[4],
-                                                color_of_indented_text)
-                    print(self.colorize(color, line), file=self._stream)
-                elif colorize_exception:
-                    exc_lines.append(line[4:])
-                else:
-                    print(self.colorize(color_of_indented_text,
-                                        line), file=self._stream)
-            else:
-                colorize_diff = False
-                if colorize_exception:
-                    self.print_colorized_traceback("\n".join(exc_lines),
-                                                   indent_level=1)
-                    colorize_exception = False
-                    exc_lines = []
-                if line.startswith('Failed example'):
-                    color_of_indented_text = 'failed-example'
-                elif line.startswith('Expected:'):
-                    color_of_indented_text = 'expected-output'
-                elif line.startswith('Got:'):
-                    color_of_indented_text = 'actual-output'
-                elif line.startswith('Exception raised:'):
-                    color_of_indented_text = 'exception'
-                    colorize_exception = True
-                elif line.startswith('Differences '):
-                    if line in [
-                        "Differences (ndiff with -expected +actual):",
-                        "Differences (unified diff with -expected +actual):"
-                    ]:
-                        line = "".join([
-                            "Differences (ndiff with ",
-                            self.color("expected-output"), "-expected ",
-                            self.color("actual-output"), "+actual",
-                            self.color("normal"), "):",
-                        ])
-                    color_of_indented_text = 'normal'
-                    colorize_diff = True
-                else:
-                    color_of_indented_text = 'normal'
-                print(line, file=self._stream)
-        print(file=self._stream)
+    def format_locals(self, frame, deadline):
+        lines = []
+        names = [name for name in frame.f_locals
+                 if not (name.startswith("__") and name.endswith("__"))]
+        for name in names[:self._max_locals]:
+            if time.time() > deadline:
+                lines.append("%s(more locals not captured: time budget "
+                             "exceeded)\n" % self.indentation)
+                return lines
+            lines.append("%s%s = %s\n" % (
+                self.indentation, name,
+                self._safe_repr(frame.f_locals[name])))
+        if len(names) > self._max_locals:
+            lines.append("%s(%d more locals)\n" % (
+                self.indentation, len(names) - self._max_locals))
+        return lines
 
-    def print_colorized_traceback(self, formatted_traceback, indent_level=0):
-        """Report a test failure.
 
-        ``formatted_traceback`` is a string.
-        """
-        indentation = "    " * indent_level
-        for line in formatted_traceback.splitlines():
-            if line.startswith("  File"):
-                m = re.match(r'  File "(.*)", line (\d*)(?:, in (.*))?$', line)
-                if m:
-                    filename, lineno, test = m.groups()
-                    if self._clean_tracebacks:
-                        filename, lineno = elide_foreign_path_and_line_nr(
-                            self._base_dir, filename, lineno)
-                    tb_lines = [
-                        self.color("normal"), '  File "',
-                        self.color("filename"), filename,
-                        self.color("normal"), '", line ',
-                        self.color("lineno"), lineno,
-                    ]
-                    if test:
-                        # this is missing for the first traceback in doctest
-                        # failure report
-                        tb_lines.extend([
-                            self.color("normal"), ", in ",
-                            self.color("testname"), test,
-                        ])
-                    tb_lines.extend([
-                        self.color("normal"), "\n",
-                    ])
-                    self._stream.write(indentation)
-                    self._stream.writelines(tb_lines)
-                else:
-                    print(indentation + line, file=self._stream)
-            elif line.startswith("    "):
-                print(self.colorize("failed-example",
-                                    indentation + line), file=self._stream)
-            elif line.startswith("Traceback (most recent call last)"):
-                print(indentation + line, file=self._stream)
-            else:
-                print(self.colorize("exception",
-                                    indentation + line), file=self._stream)
+_text_types = (type(""), type(u""))
 
-    def stop_test(self, test):
-        if self._verbose > 1:
-            print(file=self._stream)
-        self._stream.flush()
 
-    def stop_tests(self):
-        if self._verbose == 1:
-            self._stream.write("\n")
-        self._stream.flush()
+class AssertionDiff(object):
+    """Diffs the two values of a failed assertEqual(), at bounded cost.
 
+    The values are found in the locals of the unittest assert method's
+    frame.  Strings are compared line by line, other values as pprint
+    shows them; lines that were changed rather than added or removed also
+    get ndiff-style "? " lines marking the characters that differ.
 
-class ColorOutputPlugin(nose.plugins.Plugin):
+    Values more than ``max_size`` characters long (both together, as
+    estimated before formatting them), or a diff that would take, or takes,
+    more than ``budget`` seconds, are summarised: only the first differing
+    line of each is shown.  Only ``context`` unchanged
+    lines are shown around changes, and at most ``max_lines`` lines in all.
+    """
 
-    """Output test results in colour to terminal."""
+    header = "Diff (-first +second):"
 
-    name = "color"
+    # unittest methods that compare two values, with the names of the
+    # arguments holding them
+    methods = {"assertEqual": ("first", "second"),
+               "assertEquals": ("first", "second"),
+               "assertMultiLineEqual": ("first", "second"),
+               "assertSequenceEqual": ("seq1", "seq2"),
+               "assertListEqual": ("list1", "list2"),
+               "assertTupleEqual": ("tuple1", "tuple2"),
+               "assertDictEqual": ("d1", "d2")}
 
-    formatter_class = ColorfulOutputFormatter
-    clean_tracebacks = False
-    base_dir = None
+    # Roughly how many pairs of lines SequenceMatcher compares a second,
+    # when they differ in many places: cost estimates assume the worst.
+    match_rate = 1e8
 
-    # These colors are carefully chosen to have enough contrast
-    # on terminals with both black and white background.
-    default_colorscheme = {"normal": "normal",
-                           "pass": "green",
-                           "failure": "magenta",
-                           "error": "brightred",
-                           "number": "green",
-                           "ok-number": "green",
-                           "error-number": "brightred",
-                           "filename": "lightblue",
+    def __init__(self, budget=0.5, max_size=1024 * 1024, context=3,
+                 max_lines=100, max_line_length=200):
+        self.budget = budget
+        self.max_size = max_size
+        self.context = context
+        self.max_lines = max_lines
+        self.max_line_length = max_line_length
+
+    def find_values(self, tb):
+        """Return ``(first, second, msg)`` from the outermost unittest
+        assert method in ``tb``, or None."""
+        while tb is not None:
+            frame = tb.tb_frame
+            names = self.methods.get(frame.f_code.co_name)
+            if names is not None and "__unittest" in frame.f_globals:
+                frame_locals = frame.f_locals
+                if names[0] in frame_locals and names[1] in frame_locals:
+                    return (frame_locals[names[0]], frame_locals[names[1]],
+                            frame_locals.get("msg"))
+            tb = tb.tb_next
+        return None
+
+    def format(self, exctype, value, tb):
+        """Format an AssertionError with a diff instead of unittest's own
+        message, or return None to leave it as it is.
+
+        Short values that unittest showed in full on one line are left
+        alone.
+        """
+        found = self.find_values(tb)
+        if found is None:
+            return None
+        first, second, msg = found
+        deadline = time.time() + self.budget
+        message = "".join(traceback.format_exception_only(exctype, value))
+        lines = [message.split("\n", 1)[0] + "\n"]
+        if msg is not None and str(msg) not in lines[0]:
+            lines.append("%s\n" % (msg,))
+        lines.append(self.header + "\n")
+        # before pprint gets to spend any time on them
+        size = (self.estimate_size(first, self.max_size) +
+                self.estimate_size(second, self.max_size))
+        if size > self.max_size:
+            reason = "%d characters, more than %d" % (size, self.max_size)
+            a = b = None
+            if (isinstance(first, _text_types) and
+                    isinstance(second, _text_types)):
+                a, b = first.splitlines(), second.splitlines()
+            lines.extend(self.summary(a, b, reason))
+            return lines
+        try:
+            a, b = self.lines(first, second)
+        except Exception:
+            return None
+        if a == b or ("\n" not in message.rstrip("\n") and
+                      len(a) == len(b) == 1 and
+                      len(a[0]) + len(b[0]) < self.max_line_length):
+            return None
+        if time.time() > deadline:
+            lines.extend(self.summary(
+                a, b, "took more than %gs" % self.budget))
+            return lines
+        # Matching can't be interrupted, so don't start it unless it will
+        # likely be done in time.  Lines at the start and end that are the
+        # same cost little.
+        same = _common_prefix_length(a, b)
+        same += _common_prefix_length(a[same:][::-1], b[same:][::-1])
+        cost = (len(a) - same) * (len(b) - same) / self.match_rate
+        if time.time() + cost > deadline:
+            lines.extend(self.summary(
+                a, b, "would take about %.1fs, more than %gs" % (
+                    cost, self.budget)))
+            return lines
+        matcher = difflib.SequenceMatcher(None, a, b)
+        matcher.get_opcodes()
+        if time.time() > deadline:
+            lines.extend(self.summary(
+                a, b, "took more than %gs" % self.budget))
+            return lines
+        body = []
+        for group in matcher.get_grouped_opcodes(self.context):
+            body.append("@@ -%d,%d +%d,%d @@\n" % (
+                group[0][1] + 1, group[-1][2] - group[0][1],
+                group[0][3] + 1, group[-1][4] - group[0][3]))
+            for tag, i1, i2, j1, j2 in group:
+                if tag == "equal":
+                    body.extend("  %s\n" % self.cut(line)
+                                for line in a[i1:i2])
+                    continue
+                pairs = 0
+                if tag == "replace":
+                    pairs = min(i2 - i1, j2 - j1)
+                for line_a, line_b in zip(a[i1:i1 + pairs], b[j1:j1 + pairs]):
+                    body.extend(self.changed_line(line_a, line_b,
+                                                  time.time() <= deadline))
+                body.extend("- %s\n" % self.cut(line)
+                            for line in a[i1 + pairs:i2])
+                body.extend("+ %s\n" % self.cut(line)
+                            for line in b[j1 + pairs:j2])
+            if len(body) > self.max_lines:
+                break
+        if len(body) > self.max_lines:
+            body[self.max_lines:] = ["@@ diff cut short after %d lines @@\n"
+                                     % self.max_lines]
+        lines.extend(body)
+        return lines
+
+    def estimate_size(self, value, limit):
+        """Roughly how long pprint would make ``value``, counting up to
+        little more than ``limit``."""
+        size = 0
+        todo = [value]
+        while todo and size <= limit:
+            value = todo.pop()
+            if isinstance(value, _text_types + (bytes,)):
+                size += len(value) + 2
+            elif isinstance(value, dict):
+                todo.extend(value.keys())
+                todo.extend(value.values())
+                size += 2
+            elif isinstance(value, (list, tuple, set, frozenset)):
+                todo.extend(value)
+                size += 2
+            else:
+                size += 8
+        return size
+
+    def lines(self, first, second):
+        """Return the lines to compare ``first`` and ``second`` by."""
+        if isinstance(first, _text_types) and isinstance(second, _text_types):
+            a, b = first.splitlines(), second.splitlines()
+            if a == b:
+                # they only differ in line endings
+                a, b = [repr(first)], [repr(second)]
+            return a, b
+        a = pprint.pformat(first).splitlines()
+        b = pprint.pformat(second).splitlines()
+        if a == b:
+            a, b = [repr(first)], [repr(second)]
+        return a, b
+
+    def changed_line(self, a, b, mark_characters=True):
+        """Return "- " and "+ " lines for ``a`` changed into ``b``, with
+        "? " lines marking the characters that differ."""
+        a, b = self.excerpt(a, b)
+        lines = ["- %s\n" % a]
+        guide_a = guide_b = ""
+        if mark_characters:
+            guide_a, guide_b = self.guides(a, b)
+        if guide_a:
+            lines.append("? %s\n" % guide_a)
+        lines.append("+ %s\n" % b)
+        if guide_b:
+            lines.append("? %s\n" % guide_b)
+        return lines
+
+    def guides(self, a, b):
+        # lines are short by now, so there's no need for autojunk's
+        # shortcut (which ignores the most common characters)
+        matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+        if matcher.real_quick_ratio() < 0.5 or matcher.ratio() < 0.5:
+            # too different for marking characters to help
+            return "", ""
+        guide_a, guide_b = [], []
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                guide_a.append(" " * (i2 - i1))
+                guide_b.append(" " * (j2 - j1))
+            else:
+                guide_a.append({"replace": "^"}.get(tag, "-") * (i2 - i1))
+                guide_b.append({"replace": "^"}.get(tag, "+") * (j2 - j1))
+        return "".join(guide_a).rstrip(), "".join(guide_b).rstrip()
+
+    def cut(self, line):
+        if len(line) > self.max_line_length:
+            return line[:self.max_line_length] + "..."
+        return line
+
+    def excerpt(self, a, b):
+        """Cut long lines down to the part around their first difference."""
+        width = self.max_line_length
+        if len(a) <= width and len(b) <= width:
+            return a, b
+        start = max(0, _common_prefix_length(a, b) - width // 4)
+
+        def cut(line):
+            return "%s%s%s" % (start and "..." or "",
+                               line[start:start + width],
+                               len(line) > start + width and "..." or "")
+        return cut(a), cut(b)
+
+    def summary(self, a, b, reason):
+        """Lines showing only where ``a`` and ``b`` first differ; if they
+        are None, just the reason."""
+        if a is None:
+            return ["@@ diff skipped (%s) @@\n" % reason]
+        index = 0
+        for index, (line_a, line_b) in enumerate(zip(a, b)):
+            if line_a != line_b:
+                break
+        else:
+            index = min(len(a), len(b))
+        lines = ["@@ diff skipped (%s): -%d +%d lines, first difference "
+                 "at line %d @@\n" % (reason, len(a), len(b), index + 1)]
+        if index < len(a) and index < len(b):
+            lines.extend(self.changed_line(a[index], b[index]))
+        elif index < len(a):
+            lines.append("- %s\n" % self.cut(a[index]))
+        elif index < len(b):
+            lines.append("+ %s\n" % self.cut(b[index]))
+        return lines
+
+
+def _common_prefix_length(a, b):
+    index = 0
+    for index, (char_a, char_b) in enumerate(zip(a, b)):
+        if char_a != char_b:
+            return index
+    return min(len(a), len(b))
+
+
+def split_assertion_diff(lines):
+    """Split formatted traceback lines around an AssertionDiff.
+
+    Returns ``(before, diff, after)``; ``diff`` is the header line and the
+    diff lines after it, or empty if there is no diff.
+    """
+    for start, line in enumerate(lines):
+        if line == AssertionDiff.header:
+            break
+    else:
+        return lines, [], []
+    end = start + 1
+    while end < len(lines) and lines[end][:2] in ("  ", "- ", "+ ", "? ",
+                                                  "@@"):
+        end += 1
+    return lines[:start], lines[start:end], lines[end:]
+
+
+_cause_message = ("\nThe above exception was the direct cause "
+                  "of the following exception:\n\n")
+_context_message = ("\nDuring handling of the above exception, "
+                    "another exception occurred:\n\n")
+
+
+def format_exception(exctype, value, tb, limit=None, frame_filter=None,
+                     capture_locals=None, assertion_diff=None):
+    """Like traceback.format_exception, but ``frame_filter`` hides frames.
+
+    If ``capture_locals`` (a LocalsCapture) is given, each frame shown is
+    followed by its local variables.  If ``assertion_diff`` (an
+    AssertionDiff) is given, failed assertEqual()s end with its diff.
+
+    The traceback module still does the formatting, so chained exceptions,
+    exception groups and notes come out as usual.
+    """
+    if frame_filter is None:
+        if capture_locals is None and assertion_diff is None:
+            return traceback.format_exception(exctype, value, tb, limit)
+        frame_filter = FrameFilter()
+    if not hasattr(traceback, "TracebackException"):
+        return _format_exception_chain(exctype, value, tb, limit,
+                                       frame_filter, capture_locals,
+                                       assertion_diff, set())
+    exception = traceback.TracebackException(exctype, value, tb, limit=limit,
+                                             lookup_lines=False)
+    _filter_stacks(exception, value, tb, limit, frame_filter,
+                   capture_locals, set())
+    lines = list(exception.format())
+    if assertion_diff is not None and issubclass(exctype, AssertionError):
+        diff = assertion_diff.format(exctype, value, tb)
+        if diff is not None:
+            # the message is the first line format_exception_only() gives,
+            # and any notes follow it
+            only = list(exception.format_exception_only())
+            if lines[-len(only):] == only:
+                lines[-len(only):] = diff + only[1:]
+    return lines
+
+
+if hasattr(traceback, "StackSummary"):
+    class _LocalsStackSummary(traceback.StackSummary):
+        """A stack that shows each frame's local variables after it."""
+
+        def format(self):
+            lines = []
+            for entry, frame_locals in zip(self, self.frame_locals):
+                lines.extend(traceback.StackSummary.from_list([entry])
+                             .format())
+                lines.extend(frame_locals)
+            return lines
+
+
+def _filter_stacks(exception, value, tb, limit, frame_filter, capture_locals,
+                   seen):
+    """Leave hidden frames out of a TracebackException, and those of the
+    exceptions chained to it or grouped in it."""
+    if id(value) in seen:
+        return
+    seen.add(id(value))
+    kept = frame_filter.extract_frames(tb, limit)
+    entries = [entry for entry, frame in kept]
+    if capture_locals is None:
+        exception.stack = traceback.StackSummary.from_list(entries)
+    else:
+        exception.stack = _LocalsStackSummary(entries)
+        exception.stack.frame_locals = capture_locals.format_frames(
+            [frame for entry, frame in kept])
+    # don't keep the frames (and everything they refer to) alive
+    del kept
+    related = [(getattr(exception, name, None), getattr(value, name, None))
+               for name in ("__cause__", "__context__")]
+    related.extend(zip(getattr(exception, "exceptions", None) or (),
+                       getattr(value, "exceptions", None) or ()))
+    for related_exception, related_value in related:
+        if related_exception is not None and related_value is not None:
+            _filter_stacks(related_exception, related_value,
+                           related_value.__traceback__, limit, frame_filter,
+                           capture_locals, seen)
+
+
+def _format_exception_chain(exctype, value, tb, limit, frame_filter,
+                            capture_locals, assertion_diff, _seen):
+    # for Pythons without traceback.TracebackException
+    lines = []
+    # Python 3 exception chaining
+    if _seen is None:
+        _seen = set()
+    _seen.add(id(value))
+    cause = getattr(value, "__cause__", None)
+    context = getattr(value, "__context__", None)
+    if cause is not None and id(cause) not in _seen:
+        lines.extend(_format_exception_chain(
+            type(cause), cause, cause.__traceback__, None, frame_filter,
+            capture_locals, assertion_diff, _seen))
+        lines.append(_cause_message)
+    elif (context is not None and id(context) not in _seen
+          and not getattr(value, "__suppress_context__", False)):
+        lines.extend(_format_exception_chain(
+            type(context), context, context.__traceback__, None,
+            frame_filter, capture_locals, assertion_diff, _seen))
+        lines.append(_context_message)
+    if tb is not None:
+        lines.append("Traceback (most recent call last):\n")
+        if capture_locals is None:
+            lines.extend(traceback.format_list(frame_filter.extract(tb,
+                                                                    limit)))
+        else:
+            kept = frame_filter.extract_frames(tb, limit)
+            all_locals = capture_locals.format_frames(
+                [frame for entry, frame in kept])
+            # bound even if no frame is kept, for the del below
+            frame = None
+            for (entry, frame), frame_locals in zip(kept, all_locals):
+                lines.extend(traceback.format_list([entry]))
+                lines.extend(frame_locals)
+            # don't keep the frames (and everything they refer to) alive
+            del kept, frame
+    diff = None
+    if assertion_diff is not None and issubclass(exctype, AssertionError):
+        diff = assertion_diff.format(exctype, value, tb)
+    if diff is None:
+        diff = traceback.format_exception_only(exctype, value)
+    lines.extend(diff)
+    return lines
+
+
+# Renderers turn named colours from the colour scheme into output.  The
+# formatter only ever asks for ``color(what)`` and ``colorize(what, message)``.
+
+class AnsiRenderer(object):
+    """Renders colours as ANSI / xterm 256 colour escape codes."""
+
+    def __init__(self, colorscheme):
+        self._codes = dict((name, self.convert(color).terminal_code())
+                           for name, color in colorscheme.items())
+
+    def convert(self, color):
+        return color
+
+    def color(self, what):
+        return self._codes[what]
+
+    def colorize(self, what, message, normal="normal"):
+        return u'' + self._codes[what] + message + self._codes[normal]
+
+
+class Ansi16Renderer(AnsiRenderer):
+    """Renders colours with the basic 16 ANSI colours only.
+
+    xterm 256 and RGB colours are mapped to the nearest basic colour.
+    """
+
+    def convert(self, color):
+        return color.ansi16()
+
+
+class PlainRenderer(object):
+    """Renders no colour at all."""
+
+    def __init__(self, colorscheme=None):
+        pass
+
+    def color(self, what):
+        return ""
+
+    def colorize(self, what, message, normal="normal"):
+        return message
+
+
+class HtmlRenderer(object):
+    """Renders colours as markers that HtmlReportStream turns into HTML."""
+
+    def __init__(self, colorscheme=None):
+        pass
+
+    def color(self, what):
+        return u"\0%s\0" % what
+
+    def colorize(self, what, message, normal="normal"):
+        return u"\0%s\0%s\0%s\0" % (what, message, normal)
+
+
+def _css_class(name):
+    return "c-" + re.sub(r"[^a-zA-Z0-9-]", "-", name)
+
+
+class HtmlReportStream(object):
+    """Stream that writes formatter output as an HTML document.
+
+    Text is escaped and written straight through to ``stream`` as it
+    arrives, with HtmlRenderer colour markers turned into ``<span>``s, so
+    memory use doesn't grow with the number of tests.
+    """
+
+    header = u"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%(title)s</title>
+<style>
+body { background: #000; color: #e5e5e5; }
+pre { font-family: monospace; white-space: pre-wrap; }
+%(css)s
+</style>
+</head>
+<body>
+<pre><span class="c-normal">"""
+
+    footer = u"""</span></pre>
+</body>
+</html>
+"""
+
+    def __init__(self, stream, colorscheme, title="Test results"):
+        self._stream = stream
+        # colour of the open <span>, and colour for the next text written
+        self._current = self._wanted = "normal"
+        css = ["span.%s { color: %s; }" % (_css_class(name), color.css_color())
+               for name, color in sorted(colorscheme.items())]
+        stream.write(self.header % {"title": title, "css": "\n".join(css)})
+
+    def write(self, text):
+        parts = text.split(u"\0")
+        out = []
+        for index, part in enumerate(parts):
+            if index % 2:
+                self._wanted = part
+            elif part:
+                if self._wanted != self._current:
+                    out.append(u'</span><span class="%s">' %
+                               _css_class(self._wanted))
+                    self._current = self._wanted
+                out.append(part.replace(u"&", u"&amp;").replace(
+                    u"<", u"&lt;").replace(u">", u"&gt;"))
+        if out:
+            self._stream.write(u"".join(out))
+
+    def writeln(self, text=u""):
+        self.write(text + u"\n")
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self._stream.flush()
+
+    def close(self):
+        self._stream.write(self.footer)
+        self._stream.flush()
+
+
+renderers = {"ansi256": AnsiRenderer,
+             "ansi16": Ansi16Renderer,
+             "plain": PlainRenderer,
+             "html": HtmlRenderer}
+
+
+def resolve_renderer_name(name, isatty=False):
+    """Return the renderer "auto" stands for; other names are returned
+    as they are."""
+    if name == "auto":
+        return isatty and "ansi256" or "plain"
+    return name
+
+
+def make_renderer(name, colorscheme, isatty=False):
+    """Return the renderer called ``name``.
+
+    "auto" picks xterm 256 colour output for terminals and plain text
+    otherwise.
+    """
+    name = resolve_renderer_name(name, isatty)
+    try:
+        renderer_class = renderers[name]
+    except KeyError:
+        raise ValueError("Unknown renderer: %r" % name)
+    return renderer_class(colorscheme)
+
+
+# What a compiled theme can hold codes for: the renderers that use colours.
+theme_capabilities = ("ansi256", "ansi16", "html")
+
+
+def compile_color(color, capability):
+    """Return the code that renders ``color`` with ``capability``."""
+    if capability == "ansi16":
+        return color.ansi16().terminal_code()
+    if capability == "html":
+        return color.css_color()
+    return color.terminal_code()
+
+
+class CompiledColor(object):
+    """A colour from a compiled theme, as ready-made codes.
+
+    ``codes`` maps capabilities to codes; only those the theme was loaded
+    for are there.
+    """
+
+    __slots__ = ("_codes",)
+
+    def __init__(self, codes):
+        self._codes = codes
+
+    def terminal_code(self):
+        return self._codes["ansi256"]
+
+    def ansi16(self):
+        return CompiledColor({"ansi256": self._codes["ansi16"]})
+
+    def css_color(self):
+        return self._codes["html"]
+
+
+def parse_theme(theme_text):
+    """Parse a theme file: one ``name = colour`` per line.
+
+    Colours are in the format --colors takes.  Blank lines and lines
+    starting with "#" are ignored.
+    """
+    colors = {}
+    for lineno, line in enumerate(theme_text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            name, color_text = [part.strip() for part in line.split("=", 1)]
+        except ValueError:
+            raise ValueError("line %d: missing equals (name = colour): %r"
+                             % (lineno, line))
+        if not color_text:
+            raise ValueError("line %d: missing colour (name = colour): %r"
+                             % (lineno, line))
+        try:
+            colors[name] = parse_color(color_text)
+        except ValueError as exc:
+            raise ValueError("line %d: %s" % (lineno, exc))
+    return colors
+
+
+def _config_dir(env_var, default):
+    return os.path.join(os.environ.get(env_var) or
+                        os.path.join(os.path.expanduser("~"), default),
+                        "rudolf")
+
+
+def theme_dirs(project_dir):
+    """Where --color-theme looks for NAME.theme: the project's
+    .rudolf/themes, then the user's ~/.config/rudolf/themes."""
+    return [os.path.join(project_dir, ".rudolf", "themes"),
+            os.path.join(_config_dir("XDG_CONFIG_HOME", ".config"),
+                         "themes")]
+
+
+def find_theme(name, dirs):
+    """Return the path of theme ``name``, which may also be a path."""
+    if os.sep in name or name.endswith(".theme"):
+        if os.path.isfile(name):
+            return name
+    else:
+        for theme_dir in dirs:
+            path = os.path.join(theme_dir, name + ".theme")
+            if os.path.isfile(path):
+                return path
+    raise ValueError("no theme %r in %s" % (name, " or ".join(dirs)))
+
+
+class ThemeCache(object):
+    """Compiled themes, kept in a JSON file between runs.
+
+    A theme is compiled into a table of codes for each capability it is
+    loaded for, and its tables are kept until the theme file's mtime or
+    size changes.  Loading a theme whose tables are cached costs a stat()
+    of the theme and one read of the cache file, which is shared by all
+    the themes.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._entries = None
+
+    @classmethod
+    def default_path(cls):
+        return os.path.join(_config_dir("XDG_CACHE_HOME", ".cache"),
+                            "themes.json")
+
+    def load(self, theme_path, capabilities):
+        """Return the colour scheme of a theme file: {name: CompiledColor}.
+
+        ``capabilities`` are those of theme_capabilities the colours will
+        be rendered with.
+        """
+        theme_path = os.path.abspath(theme_path)
+        stat = os.stat(theme_path)
+        if self._entries is None:
+            self._entries = _load_json_dict(self._path, "theme cache")
+        entry = self._entries.get(theme_path)
+        if not (isinstance(entry, dict) and
+                isinstance(entry.get("tables"), dict) and
+                entry.get("mtime") == stat.st_mtime and
+                entry.get("size") == stat.st_size):
+            entry = {"mtime": stat.st_mtime, "size": stat.st_size,
+                     "tables": {}}
+        tables = entry["tables"]
+        missing = [capability for capability in capabilities
+                   if capability not in tables]
+        if missing:
+            with io.open(theme_path, encoding="utf-8") as fileobj:
+                try:
+                    colors = parse_theme(fileobj.read())
+                except ValueError as exc:
+                    raise ValueError("%s: %s" % (theme_path, exc))
+            for capability in missing:
+                tables[capability] = dict(
+                    (name, compile_color(color, capability))
+                    for name, color in colors.items())
+            self._entries[theme_path] = entry
+            self._save()
+        if not capabilities:
+            return {}
+        names = tables[capabilities[0]]
+        return dict((name, CompiledColor(dict(
+            (capability, tables[capability][name])
+            for capability in capabilities))) for name in names)
+
+    def _save(self):
+        # the cache only saves time; not being able to write it is fine
+        try:
+            cache_dir = os.path.dirname(self._path)
+            if cache_dir and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            _save_json(self._path, self._entries)
+        except (IOError, OSError):
+            pass
+
+
+def load_theme(name, capabilities, project_dir, cache=None):
+    """Return the colour scheme of theme ``name``: {name: colour}.
+
+    Raises ValueError if there is no such theme, or it is malformed.
+    """
+    path = find_theme(name, theme_dirs(project_dir))
+    if cache is None:
+        cache = ThemeCache(ThemeCache.default_path())
+    capabilities = [capability for capability in theme_capabilities
+                    if capability in capabilities]
+    return cache.load(path, capabilities)
+
+
+class DocTestFailureException(AssertionError):
+    """Custom exception for doctest unit test failures."""
+
+
+# colour output code taken from zope.testing, and hacked
+
+class OutputChunk(object):
+    """Collects the output of one event, to be written to a stream at once.
+
+    Has the stream methods formatters use, so rendering code can write to
+    either.
+    """
+
+    def __init__(self):
+        self._parts = []
+        self.write = self._parts.append
+        self.writelines = self._parts.extend
+
+    def writeln(self, text=""):
+        self._parts.append(text)
+        self._parts.append("\n")
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return u"".join(self._parts)
+
+
+def format_bytes(n, sign=False):
+    """Format a number of bytes in B, kB, MB or GB (powers of 1024)."""
+    prefix = sign and n >= 0 and "+" or ""
+    for unit in ("B", "kB", "MB"):
+        if abs(n) < 1024:
+            break
+        n /= 1024
+    else:
+        unit = "GB"
+    if unit == "B":
+        return "%s%d %s" % (prefix, n, unit)
+    return "%s%.1f %s" % (prefix, n, unit)
+
+
+class _LineState(object):
+    """The " ... " line of a test in verbose output."""
+
+    __slots__ = ("start_text", "line_broken")
+
+    def __init__(self):
+        self.start_text = ""
+        self.line_broken = False
+
+
+def split_traceback_frames(lines):
+    """Group the lines of a formatted traceback into frames.
+
+    Yields lists of lines: a frame is a "  File" line with the indented
+    lines that follow it (source, carets and local variables); any other
+    line is a list of its own.
+    """
+    frame = None
+    for line in lines:
+        if frame is not None and line.startswith("    "):
+            frame.append(line)
+            continue
+        if frame is not None:
+            yield frame
+            frame = None
+        if line.startswith("  File"):
+            frame = [line]
+        else:
+            yield [line]
+    if frame is not None:
+        yield frame
+
+
+def collapse_repeated_frames(items, min_frames=3):
+    """Replace repeated runs of frames with ``(period, repeats)`` tuples.
+
+    ``items`` are lists of lines from split_traceback_frames().  When the
+    frames that follow a run of ``period`` frames repeat it ``repeats`` times
+    over (at least ``min_frames`` frames in all), they are replaced by one
+    tuple.  Frames are compared by their first two lines, so local
+    variables don't stop recursion from being noticed.  Runs are found in
+    one pass over the frames, whatever their period: each frame is looked up
+    in a dict of where that frame was last seen.
+    """
+    items = list(items)
+    keys = []
+    for item in items:
+        if item[0].startswith("  File"):
+            keys.append(tuple(item[:2]))
+        else:
+            # other lines end runs of frames
+            keys.append(None)
+    last_seen = {}
+    pos = 0
+    end = len(items)
+    while pos < end:
+        key = keys[pos]
+        if key is None:
+            last_seen.clear()
+            yield items[pos]
+            pos += 1
+            continue
+        seen = last_seen.get(key)
+        if seen is not None:
+            period = pos - seen
+            stop = pos
+            while stop < end and keys[stop] == keys[stop - period]:
+                stop += 1
+            repeats = (stop - pos) // period
+            if repeats and repeats * period >= min_frames:
+                skipped = pos + repeats * period
+                while pos < skipped:
+                    last_seen[keys[pos]] = pos
+                    pos += 1
+                yield (period, repeats)
+                continue
+        last_seen[key] = pos
+        yield items[pos]
+        pos += 1
+
+
+class Progress(object):
+    """Estimate how long a run has left.
+
+    ``predictions`` are the expected durations of the tests to run, in the
+    order they run, with None for tests that have no timing history.  With
+    no history at all, the estimate comes from the mean rate of the run so
+    far.  ``test_done`` is called after each test; it only looks at the
+    clock about once every ``interval`` seconds, going by the rate so far,
+    and says when an estimate is due.
+    """
+
+    def __init__(self, predictions, interval):
+        self.total = len(predictions)
+        self.interval = interval
+        self.done = 0
+        known = [p for p in predictions if p is not None]
+        self._cumulative = None
+        self.predicted = None
+        if known:
+            mean = sum(known) / len(known)
+            cumulative = [0.0]
+            for prediction in predictions:
+                if prediction is None:
+                    prediction = mean
+                cumulative.append(cumulative[-1] + prediction)
+            self._cumulative = cumulative
+            self.predicted = cumulative[-1]
+        self._start = time.time()
+        self._next_refresh = self._start + interval
+        self._next_check = 1
+
+    def test_done(self):
+        """Count a finished test; return whether an estimate is due."""
+        self.done += 1
+        if self.done < self._next_check:
+            return False
+        now = time.time()
+        due = now >= self._next_refresh
+        if due:
+            self._next_refresh = now + self.interval
+        rate = self.done / max(now - self._start, 1e-6)
+        self._next_check = self.done + max(
+            1, int(rate * (self._next_refresh - now)))
+        return due
+
+    def estimate(self):
+        """Return ``(seconds_left, tests_per_second)``; seconds_left is None
+        before the first test finishes."""
+        elapsed = max(time.time() - self._start, 1e-6)
+        done = min(self.done, self.total)
+        rate = done / elapsed
+        if not done:
+            return None, rate
+        if self._cumulative is not None and self._cumulative[done] > 0:
+            # scaled by how much slower or faster than before this run is
+            cumulative = self._cumulative
+            left = ((cumulative[-1] - cumulative[done]) * elapsed
+                    / cumulative[done])
+        else:
+            left = (self.total - done) / rate
+        return left, rate
+
+
+class FailureRecord(object):
+    """A failed, errored or skipped test, reduced to what the report needs.
+
+    Keeping the test itself would keep it alive until the end of the run,
+    along with whatever its fixtures attached to it.  A record stands in for
+    the test wherever only its id and description are wanted.
+    """
+
+    __slots__ = ("test_id", "description", "exc_type_name", "traceback",
+                 "is_doctest")
+
+    def __init__(self, test_id, description, exc_type_name, traceback,
+                 is_doctest=False):
+        self.test_id = test_id
+        self.description = description
+        self.exc_type_name = exc_type_name
+        self.traceback = traceback
+        self.is_doctest = is_doctest
+
+    @classmethod
+    def from_test(cls, test, traceback, exc_type, describe):
+        """Make a record of ``test``; ``traceback`` is the formatted error,
+        or the reason of a skip.  ``exc_type`` may be None if unknown."""
+        if exc_type is None:
+            exc_type_name = ""
+            is_doctest = False
+        else:
+            exc_type_name = exc_type.__name__
+            is_doctest = issubclass(exc_type, DocTestFailureException)
+        return cls(test.id(), describe(test), exc_type_name, traceback,
+                   is_doctest)
+
+    @property
+    def exc_type(self):
+        """The class to format the traceback as, or None if unknown."""
+        if self.is_doctest:
+            return DocTestFailureException
+        if self.exc_type_name:
+            return Exception
+        return None
+
+    def id(self):
+        return self.test_id
+
+    def shortDescription(self):
+        return self.description
+
+    def __str__(self):
+        return self.description
+
+    def __repr__(self):
+        return "<FailureRecord %s>" % (self.test_id,)
+
+
+def error_entry(entry):
+    """Return ``(test, err, err_type)`` for a print_error_list() entry.
+
+    Entries are FailureRecords, or ``(test, err[, err_type])`` tuples.
+    """
+    if isinstance(entry, FailureRecord):
+        return entry, entry.traceback, entry.exc_type
+    test, err = entry[:2]
+    try:
+        err_type = entry[2]
+    except IndexError:
+        err_type = None
+    return test, err, err_type
+
+
+class ResultEvent(object):
+    """What listeners are told about a test.
+
+    ``outcome`` is None while the test runs, then one of "success",
+    "failure", "error", "skip" or "cached"; ``label`` is the label the
+    report uses for it ("FAIL", "ERROR", "SKIP", ...).  ``record`` is the
+    FailureRecord of a test that didn't pass, or None.
+
+    The traceback is formatted once, for the report, and every listener
+    gets that same text; the version coloured with ANSI escape codes is
+    rendered the first time a listener asks for it and kept for the others.
+    """
+
+    __slots__ = ("test_id", "description", "outcome", "label", "duration",
+                 "record", "_start", "_render", "_colored")
+
+    def __init__(self, test_id, description, render):
+        self.test_id = test_id
+        self.description = description
+        self.outcome = None
+        self.label = None
+        self.duration = None
+        self.record = None
+        self._start = time.time()
+        self._render = render
+        self._colored = None
+
+    def finish(self):
+        self.duration = time.time() - self._start
+
+    @property
+    def traceback(self):
+        """The formatted traceback (or reason of a skip), or None."""
+        if self.record is None:
+            return None
+        return self.record.traceback
+
+    @property
+    def colored_traceback(self):
+        """The traceback in ANSI colours, whichever renderer the report
+        uses, or None."""
+        if self._colored is None and self.record is not None:
+            err_type = self.record.exc_type
+            if err_type is None:
+                return self.record.traceback
+            self._colored = self._render(self.record.traceback, err_type)
+        return self._colored
+
+    def __repr__(self):
+        return "<ResultEvent %s %s>" % (self.test_id, self.outcome)
+
+
+class RunSummary(object):
+    """What listeners are told about the whole run, once it's over.
+
+    ``counts`` maps what the summary line counts ("failures", "errors",
+    "flaky", ...) to numbers, in the order the summary shows them.
+    """
+
+    def __init__(self, success, counts, tests_run, start, stop):
+        self.success = success
+        self.counts = counts
+        self.tests_run = tests_run
+        self.start = start
+        self.stop = stop
+
+    @property
+    def duration(self):
+        return self.stop - self.start
+
+
+class Listener(object):
+    """Base class for objects given to ColorOutputPlugin.add_listener().
+
+    Listeners are called from the thread running the test, so when tests
+    run in several threads they must be safe to call from each of them.
+    Events must not be changed.
+    """
+
+    def test_started(self, event):
+        """A test has started; ``event.outcome`` is still None."""
+
+    def test_finished(self, event):
+        """A test has finished, or was skipped by --color-cache."""
+
+    def run_finished(self, summary):
+        """The run is over; ``summary`` is a RunSummary."""
+
+
+class ColorfulOutputFormatter(object):
+    """Output formatter that uses ANSI color codes.
+
+    Like syntax highlighting in your text editor, colorizing
+    test failures helps the developer.
+    """
+
+    separator1 = "=" * 70
+    separator2 = "-" * 70
+    # longer group names are cut short in print_aggregates() tables
+    max_group_width = 40
+    # colour of each flavour of print_error_list(), other than "error"
+    problem_colors = {"FAIL": "failure", "SKIP": "skip", "FLAKY": "flaky"}
+
+    doctest_template = """
+File "%s", line %s, in %s
+
+%s
+Want:
+%s
+Got:
+%s
+"""
+
+    # Map prefix character to color in diff output.  This handles ndiff and
+    # udiff correctly, but not cdiff.
+    diff_color = {"-": "expected-output",
+                  "+": "actual-output",
+                  "?": "character-diffs",
+                  "@": "diff-chunk",
+                  "*": "diff-chunk",
+                  "!": "actual-output"}
+
+    def __init__(self, verbosity, descriptions, colorscheme,
+                 stream=sys.stdout, clean_tracebacks=False, base_dir=False,
+                 renderer=None, frame_filter=None, capture_locals=None,
+                 max_report_size=None, spill_path=None, assertion_diff=None):
+        self._stream = stream
+        self._verbose = bool(verbosity)
+        self._show_all = verbosity > 1
+        self._dots = verbosity == 1
+        self._descriptions = descriptions
+        self._clean_tracebacks = clean_tracebacks
+        self._base_dir = base_dir
+        self._colorscheme = colorscheme
+        if renderer is None:
+            renderer = AnsiRenderer(colorscheme)
+        self._renderer = renderer
+        self._frame_filter = frame_filter
+        self._capture_locals = capture_locals
+        self._assertion_diff = assertion_diff
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # state of the test whose " ... " line is unfinished on the stream
+        self._open_line = None
+        self._progress = None
+        # once print_error_list() has written max_report_size characters,
+        # the rest of the report goes to a plain formatter on spill_path
+        self._max_report_size = max_report_size
+        self._spill_path = spill_path
+        self._report_size = 0
+        self._spill_formatter = None
+        self._spilled = nose.util.odict()
+
+    def set_progress(self, progress):
+        """Show estimates from ``progress`` (a Progress) as tests finish,
+        and its prediction in the summary."""
+        self._progress = progress
+
+    def _emit(self, out):
+        """Write the collected output of one event in one go."""
+        text = out.getvalue()
+        with self._lock:
+            self._stream.write(text)
+
+    def color(self, what):
+        """Pick a named color from the color scheme"""
+        return self._renderer.color(what)
+
+    def colorize(self, what, message, normal="normal"):
+        """Wrap message in color."""
+        return self._renderer.colorize(what, message, normal)
+
+    def get_description(self, test):
+        if self._descriptions:
+            return test.shortDescription() or str(test)
+        else:
+            return str(test)
+
+    def start_test(self, test):
+        if not self._show_all:
+            self._stream.flush()
+            return
+        text = self.colorize("normal", self.get_description(test) + " ... ")
+        state = self._line_state()
+        state.start_text = text
+        with self._lock:
+            # Only one test at a time can have its line open on the stream;
+            # tests that start meanwhile in other threads write their whole
+            # line when they finish.
+            if self._open_line is None:
+                self._open_line = state
+                state.line_broken = False
+                self._stream.write(text)
+            self._stream.flush()
+
+    def _line_state(self):
+        """Return the _LineState of the test this thread is running."""
+        try:
+            return self._local.line_state
+        except AttributeError:
+            state = self._local.line_state = _LineState()
+            return state
+
+    def _finish_test(self, verbose_text, dot_text):
+        if self._show_all:
+            state = self._line_state()
+            with self._lock:
+                if self._open_line is state and not state.line_broken:
+                    self._stream.write(verbose_text + "\n")
+                else:
+                    if self._open_line not in (None, state):
+                        # end the other test's line; it writes its whole line
+                        # again when it finishes
+                        self._stream.write("\n")
+                        self._open_line.line_broken = True
+                    self._stream.write(state.start_text + verbose_text
+                                       + "\n")
+                self._open_line = None
+        elif self._dots:
+            with self._lock:
+                self._stream.write(dot_text)
+
+    def test_success(self, test):
+        self._finish_test(self.colorize("pass", "ok"),
+                          self.colorize("pass", "."))
+
+    def test_cached(self, test):
+        self._finish_test(self.colorize("cached", "cached"),
+                          self.colorize("cached", "c"))
+
+    def test_error(self, test, exc_info, label):
+        self._finish_test(self.colorize("error", label),
+                          self.colorize("error", label[:1]))
+
+    def test_skip(self, label):
+        self._finish_test(self.colorize("skip", label),
+                          self.colorize("skip", label[:1]))
+
+    def start_report(self):
+        if self._dots or self._show_all:
+            self._stream.write("\n")
+
+    def test_failure(self, test, exc_info):
+        self._finish_test(self.colorize("failure", "FAIL"),
+                          self.colorize("failure", "F"))
+
+    def print_error_list(self, flavour, errors):
+        problem_color = self.problem_colors.get(flavour, "error")
+        for entry in errors:
+            if (self._max_report_size is not None
+                    and self._report_size >= self._max_report_size):
+                self._spill(flavour, entry)
+                continue
+            test, err, err_type = error_entry(entry)
+            # Handle skip message
+            skip_msg = ""
+            if flavour == "SKIP":
+                reason = getattr(err, "message", None)
+                if reason:
+                    skip_msg = " (%s)" % self.colorize("skip", reason)
+            out = OutputChunk()
+            out.writeln(self.separator1)
+            out.writeln("%s: %s%s" % (
+                self.colorize(problem_color, flavour),
+                self.colorize("testname", self.get_description(test)),
+                skip_msg
+            ))
+            if flavour != "SKIP":
+                out.writeln(self.separator2)
+                self._print_traceback(out, err, err_type)
+            if self._max_report_size is not None:
+                self._report_size += len(out.getvalue())
+            self._emit(out)
+
+    def _spill(self, flavour, entry):
+        if self._spill_formatter is None:
+            self._spill_formatter = ColorfulOutputFormatter(
+                2, self._descriptions, self._colorscheme,
+                io.open(self._spill_path, "w", encoding="utf-8"),
+                clean_tracebacks=self._clean_tracebacks,
+                base_dir=self._base_dir, renderer=PlainRenderer())
+        self._spill_formatter.print_error_list(flavour, [entry])
+        self._spilled[flavour] = self._spilled.get(flavour, 0) + 1
+
+    def _print_spill_notice(self, out):
+        if not self._spilled:
+            return
+        out.writeln(self.separator1)
+        counts = ", ".join(
+            "%s=%s" % (flavour, self.colorize(
+                self.problem_colors.get(flavour, "error"), str(count)))
+            for flavour, count in self._spilled.items())
+        out.writeln("%s more (%s) written to %s" % (
+            self.colorize("error-number", str(sum(self._spilled.values()))),
+            counts, self.colorize("filename", self._spill_path)))
+
+    def print_summary(self, success, summary, tests_run, start, stop,
+                      shard=None):
+        """Print the summary of a run.
+
+        ``shard`` is ``(label, predicted_seconds)`` when this run was one
+        shard of a suite; ``predicted_seconds`` is None if there was no
+        timing history to predict it from.
+        """
+        out = OutputChunk()
+        write = out.write
+        writeln = out.writeln
+        writelines = out.writelines
+        taken = float(stop - start)
+        plural = tests_run != 1 and "s" or ""
+        count_color = success and "ok-number" or "error-number"
+
+        self._print_spill_notice(out)
+        writeln(self.separator2)
+        writelines([
+            "Ran ",
+            self.colorize(count_color, "%s " % tests_run),
+            "test%s in " % plural,
+            self._format_seconds(taken)])
+        writeln()
+        if not success:
+            write(self.colorize("failure", "FAILED"))
+            write(" (")
+            self._write_counts(write, summary)
+            writeln(")")
+        elif any(summary.values()):
+            # e.g. flaky or cached tests
+            write(self.colorize("pass", "OK"))
+            write(" (")
+            self._write_counts(write, summary)
+            writeln(")")
+        else:
+            writeln(self.colorize("pass", "OK"))
+        if self._progress is not None and self._progress.predicted is not None:
+            writeln("Predicted %s, took %s" % (
+                self._format_seconds(self._progress.predicted),
+                self._format_seconds(taken)))
+        if shard is not None:
+            label, predicted = shard
+            if predicted is None:
+                prediction = "no timing history"
+            else:
+                prediction = "predicted " + self._format_seconds(predicted)
+            writeln("Shard %s: %s, took %s" % (
+                self.colorize("number", label), prediction,
+                self._format_seconds(taken)))
+        self._emit(out)
+
+    def test_hung(self, description, elapsed, stacks):
+        """Warn that a test has been running for ``elapsed`` seconds.
+
+        ``stacks`` is a list of ``(thread_name, formatted_stack)`` pairs, one
+        for each thread of the process.
+        """
+        out = OutputChunk()
+        out.writeln("%s: %s has been running for %s" % (
+            self.colorize("watchdog", "WATCHDOG"),
+            self.colorize("testname", description),
+            self._format_seconds(elapsed)))
+        for name, stack in stacks:
+            out.writeln("Thread %s (most recent call last):" % (
+                self.colorize("testname", name),))
+            self._print_colorized_traceback(out, stack)
+        with self._lock:
+            if self._open_line is not None:
+                # the test's line is written again in full when it finishes
+                self._open_line.line_broken = True
+                self._stream.write("\n")
+            elif self._dots:
+                self._stream.write("\n")
+            self._stream.write(out.getvalue())
+            self._stream.flush()
+
+    def print_aggregates(self, group_by, rows):
+        """Print a table of test outcomes and durations by group.
+
+        ``group_by`` is "module" or "class"; ``rows`` come from
+        Aggregates.rows().
+        """
+        if not rows:
+            return
+        width = min(max(len(row[0]) for row in rows), self.max_group_width)
+        width = max(width, len("By " + group_by))
+        out = OutputChunk()
+        out.writeln(self.separator2)
+        out.writeln("%-*s %6s %6s %6s %6s %10s %10s" % (
+            width, "By " + group_by, "tests", "fail", "error", "skip",
+            "total", "max"))
+        for key, tests, failures, errors, skips, total, longest in rows:
+            if len(key) > width:
+                key = "..." + key[len(key) - width + 3:]
+            out.writelines([
+                self.colorize("testname", "%-*s" % (width, key)),
+                " %6d " % tests,
+                self._count_cell(failures, "failure"), " ",
+                self._count_cell(errors, "error"), " ",
+                self._count_cell(skips, "skip"), " ",
+                self.colorize("number", "%9.3fs" % total), " ",
+                self.colorize("number", "%9.3fs" % longest), "\n"])
+        self._emit(out)
+
+    def _count_cell(self, count, color):
+        if count:
+            return self.colorize(color, "%6d" % count)
+        return "%6d" % count
+
+    def print_memory_report(self, growths):
+        """Print the tests that grew the process' memory the most.
+
+        ``growths`` is a list of ``(growth, description, sites)`` tuples as
+        returned by MemoryTracker.largest().
+        """
+        if not growths:
+            return
+        out = OutputChunk()
+        out.writeln(self.separator2)
+        out.writeln("Largest memory growth:")
+        for growth, description, sites in growths:
+            out.writeln("%s  %s" % (
+                self.colorize("memory-growth",
+                              "%10s" % format_bytes(growth, sign=True)),
+                self.colorize("testname", description)))
+            for filename, lineno, size in sites:
+                out.writeln("%14s%s:%s: %s" % (
+                    "", self.colorize("filename", filename),
+                    self.colorize("lineno", str(lineno)),
+                    format_bytes(size, sign=True)))
+        self._emit(out)
+
+    def _write_counts(self, write, summary):
+        any = False
+        for label, count in summary.items():
+            if not count:
+                continue
+            if any:
+                write(", ")
+            write("%s=" % label)
+            problem_color = {"failures": "failure",
+                             "flaky": "flaky",
+                             "cached": "cached"}.get(label, "error")
+            write(self.colorize(problem_color, str(count)))
+            any = True
+
+    def _format_seconds(self, n_seconds, normal="normal"):
+        """Format a time in seconds."""
+        if n_seconds >= 60:
+            n_minutes, n_seconds = divmod(n_seconds, 60)
+            return "%s minutes %s seconds" % (
+                   self.colorize("number", "%d" % n_minutes, normal),
+                   self.colorize("number", "%.3f" % n_seconds, normal))
+        else:
+            return "%s seconds" % (
+                   self.colorize("number", "%.3f" % n_seconds, normal))
+
+    def format_traceback(self, exc_info):
+        """Format the traceback."""
+        v = exc_info[1]
+        if isinstance(v, DocTestFailureException):
+            tb = v.args[0]
+        if isinstance(v, doctest.DocTestFailure):
+            tb = self.doctest_template % (
+                v.test.filename,
+                v.test.lineno + v.example.lineno + 1,
+                v.test.name,
+                v.example.source,
+                v.example.want,
+                v.got,
+            )
+        else:
+            tb = "".join(format_exception(
+                *exc_info, frame_filter=self._frame_filter,
+                capture_locals=self._capture_locals,
+                assertion_diff=self._assertion_diff))
+        return tb
+
+    def print_traceback(self, formatted_traceback, err_type):
+        """Report an error with a traceback."""
+        out = OutputChunk()
+        self._print_traceback(out, formatted_traceback, err_type)
+        self._emit(out)
+
+    def print_doctest_failure(self, formatted_failure):
+        """Report a doctest failure.
+
+        ``formatted_failure`` is a string -- that's what
+        DocTestSuite/DocFileSuite gives us.
+        """
+        out = OutputChunk()
+        self._print_doctest_failure(out, formatted_failure)
+        self._emit(out)
+
+    def render_traceback(self, formatted_traceback, err_type):
+        """Return a traceback as print_traceback() would print it."""
+        out = OutputChunk()
+        self._print_traceback(out, formatted_traceback, err_type)
+        return out.getvalue()
+
+    def print_colorized_traceback(self, formatted_traceback, indent_level=0):
+        """Report a test failure.
+
+        ``formatted_traceback`` is a string.
+        """
+        out = OutputChunk()
+        self._print_colorized_traceback(out, formatted_traceback,
+                                        indent_level)
+        self._emit(out)
+
+    def _print_traceback(self, out, formatted_traceback, err_type):
+        # err_type is None for entries nose stored itself, e.g. of error
+        # classes other plugins register
+        if err_type is not None and issubclass(err_type,
+                                               DocTestFailureException):
+            self._print_doctest_failure(out, formatted_traceback)
+        else:
+            self._print_colorized_traceback(out, formatted_traceback)
+            print(file=out)
+
+    def _print_doctest_failure(self, out, formatted_failure):
+        color_of_indented_text = 'normal'
+        colorize_diff = False
+        colorize_exception = False
+        lines = formatted_failure.splitlines()
+
+        # this first traceback in a doctest failure report is rarely
+        # interesting, but it looks funny non-colourized so let's colourize it
+        # anyway
+        exc_lines = []
+        while True:
+            line = lines.pop(0)
+            if line == self.separator2:
+                break
+            exc_lines.append(line)
+        self._print_colorized_traceback(out, "\n".join(exc_lines))
+        print(file=out)
+        print(self.separator2, file=out)
+        exc_lines = []
+
+        for line in lines:
+            if line.startswith('File '):
+                m = re.match(r'File "(.*)", line (\d*), in (.*)$', line)
+                if m:
+                    filename, lineno, test = m.groups()
+                    if self._clean_tracebacks:
+                        filename, lineno = elide_foreign_path_and_line_nr(
+                            self._base_dir, filename, lineno)
+                    out.writelines([
+                        self.color('normal'), 'File "',
+                        self.color('filename'), filename,
+                        self.color('normal'), '", line ',
+                        self.color('lineno'), lineno,
+                        self.color('normal'), ', in ',
+                        self.color('testname'), test,
+                        self.color('normal'), '\n'])
+                else:
+                    print(line, file=out)
+            elif line.startswith('    '):
+                if colorize_diff and len(line) > 4:
+                    color = self.diff_color.get(line[4],
+                                                color_of_indented_text)
+                    print(self.colorize(color, line), file=out)
+                elif colorize_exception:
+                    exc_lines.append(line[4:])
+                else:
+                    print(self.colorize(color_of_indented_text,
+                                        line), file=out)
+            else:
+                colorize_diff = False
+                if colorize_exception:
+                    self._print_colorized_traceback(out, "\n".join(exc_lines),
+                                                   indent_level=1)
+                    colorize_exception = False
+                    exc_lines = []
+                if line.startswith('Failed example'):
+                    color_of_indented_text = 'failed-example'
+                elif line.startswith('Expected:'):
+                    color_of_indented_text = 'expected-output'
+                elif line.startswith('Got:'):
+                    color_of_indented_text = 'actual-output'
+                elif line.startswith('Exception raised:'):
+                    color_of_indented_text = 'exception'
+                    colorize_exception = True
+                elif line.startswith('Differences '):
+                    if line in [
+                        "Differences (ndiff with -expected +actual):",
+                        "Differences (unified diff with -expected +actual):"
+                    ]:
+                        line = "".join([
+                            "Differences (ndiff with ",
+                            self.color("expected-output"), "-expected ",
+                            self.color("actual-output"), "+actual",
+                            self.color("normal"), "):",
+                        ])
+                    color_of_indented_text = 'normal'
+                    colorize_diff = True
+                else:
+                    color_of_indented_text = 'normal'
+                print(line, file=out)
+        print(file=out)
+
+    # local variables, as formatted by LocalsCapture
+    _local_variable_re = re.compile(r"        ([A-Za-z_][A-Za-z0-9_]*) = (.*)$")
+
+    def _print_colorized_traceback(self, out, formatted_traceback,
+                                   indent_level=0):
+        indentation = "    " * indent_level
+        rest = formatted_traceback.splitlines()
+        while rest:
+            lines, diff, rest = split_assertion_diff(rest)
+            self._print_traceback_lines(out, lines, indentation)
+            if diff:
+                self._print_assertion_diff(out, diff, indentation)
+
+    def _print_traceback_lines(self, out, lines, indentation):
+        for item in collapse_repeated_frames(split_traceback_frames(lines)):
+            if isinstance(item, tuple):
+                period, repeats = item
+                print(indentation + self.colorize(
+                    "repeated-frames",
+                    "  [previous %d frame%s repeated %d time%s]" % (
+                        period, period != 1 and "s" or "",
+                        repeats, repeats != 1 and "s" or "")), file=out)
+                continue
+            for line in item:
+                self._print_traceback_line(out, line, indentation)
+
+    def _print_assertion_diff(self, out, lines, indentation):
+        out.writelines([indentation, "Diff (",
+                        self.color("expected-output"), "-first ",
+                        self.color("actual-output"), "+second",
+                        self.color("normal"), "):\n"])
+        # in colour, the characters "? " lines mark are coloured instead
+        keep_guides = isinstance(self._renderer, PlainRenderer)
+        lines = lines[1:]
+        for index, line in enumerate(lines):
+            color = self.diff_color.get(line[:1], "normal")
+            if line.startswith("? "):
+                if keep_guides:
+                    print(indentation + line, file=out)
+                continue
+            guide = ""
+            if index + 1 < len(lines) and lines[index + 1].startswith("? "):
+                guide = lines[index + 1][2:]
+            out.write(indentation)
+            out.writelines(self._colorize_marked(color, line, guide))
+            out.write("\n")
+
+    def _colorize_marked(self, what, line, guide):
+        """Colour ``line`` as ``what``, with the characters that ``guide``
+        marks (after the two character prefix) as character-diffs."""
+        parts = [self.color(what)]
+        pos = 0
+        for m in re.finditer(r"[^ ]+", guide):
+            start = min(m.start() + 2, len(line))
+            end = min(m.end() + 2, len(line))
+            parts.extend([line[pos:start], self.color("character-diffs"),
+                          line[start:end], self.color(what)])
+            pos = end
+        parts.extend([line[pos:], self.color("normal")])
+        return parts
+
+    def _print_traceback_line(self, out, line, indentation):
+        if line.startswith("  File"):
+            m = re.match(r'  File "(.*)", line (\d*)(?:, in (.*))?$', line)
+            if m:
+                filename, lineno, test = m.groups()
+                if self._clean_tracebacks:
+                    filename, lineno = elide_foreign_path_and_line_nr(
+                        self._base_dir, filename, lineno)
+                tb_lines = [
+                    self.color("normal"), '  File "',
+                    self.color("filename"), filename,
+                    self.color("normal"), '", line ',
+                    self.color("lineno"), lineno,
+                ]
+                if test:
+                    # this is missing for the first traceback in doctest
+                    # failure report
+                    tb_lines.extend([
+                        self.color("normal"), ", in ",
+                        self.color("testname"), test,
+                    ])
+                tb_lines.extend([
+                    self.color("normal"), "\n",
+                ])
+                out.write(indentation)
+                out.writelines(tb_lines)
+            else:
+                print(indentation + line, file=out)
+        elif line.startswith("    "):
+            m = self._local_variable_re.match(line)
+            if m:
+                name, value = m.groups()
+                out.writelines([
+                    indentation, "        ",
+                    self.color("local-name"), name,
+                    self.color("normal"), " = ",
+                    self.color("local-value"), value,
+                    self.color("normal"), "\n"])
+            else:
+                print(self.colorize("failed-example",
+                                    indentation + line), file=out)
+        elif line.startswith("Traceback (most recent call last)"):
+            print(indentation + line, file=out)
+        else:
+            print(self.colorize("exception",
+                                indentation + line), file=out)
+
+    def stop_test(self, test):
+        if self._verbose > 1:
+            self._stream.write("\n")
+        progress = self._progress
+        if progress is not None and progress.test_done() and (
+                self._dots or self._show_all):
+            self._print_progress(progress)
+        self._stream.flush()
+
+    def _print_progress(self, progress):
+        left, rate = progress.estimate()
+        if left is None or progress.done >= progress.total:
+            return
+        text = "[%s %s, %s/%s tests, %s tests/s]\n" % (
+            self.colorize("eta", "ETA"), self._format_seconds(left),
+            self.colorize("number", str(progress.done)), progress.total,
+            self.colorize("number", "%.1f" % rate))
+        with self._lock:
+            if self._open_line is not None:
+                # don't cut another test's line short; try again later
+                return
+            if self._dots:
+                text = " " + text
+            self._stream.write(text)
+
+    def stop_tests(self):
+        if self._verbose == 1:
+            self._stream.write("\n")
+        self._stream.flush()
+        if self._spill_formatter is not None:
+            self._spill_formatter._stream.close()
+            self._spill_formatter = None
+
+
+class FormatterTee(object):
+    """Send formatter events to several formatters.
+
+    The first formatter is the primary one: anything that is not an output
+    event (``format_traceback``, ``get_description``, ...) is answered by it
+    alone.
+    """
+
+    events = frozenset(["start_test", "test_success", "test_cached",
+                        "test_error",
+                        "test_skip", "test_failure", "test_hung",
+                        "start_report",
+                        "print_error_list", "print_aggregates",
+                        "print_memory_report",
+                        "print_summary", "stop_test", "stop_tests"])
+
+    def __init__(self, primary, *others):
+        self._formatters = (primary,) + others
+
+    def __getattr__(self, name):
+        if name not in self.events:
+            return getattr(self._formatters[0], name)
+        methods = [getattr(formatter, name) for formatter in self._formatters]
+
+        def broadcast(*args, **kwargs):
+            for method in methods:
+                method(*args, **kwargs)
+        setattr(self, name, broadcast)
+        return broadcast
+
+
+# Binary event log (--color-record / "rudolf replay").
+#
+# The log is a magic header followed by records.  A record is one byte of
+# event kind, a varint payload length, and the payload: a sequence of
+# varint-length-prefixed UTF-8 strings.  Readers ignore trailing fields they
+# don't know about, so new fields can be appended to an event.
+#
+# The records of a test, from its start to its stop, end with a field that
+# numbers the test within the log: with tests in several threads, those of
+# different tests interleave.
+
+EVENT_LOG_MAGIC = b"RUDOLF\x00\x01"
+
+EVENT_START = 1
+EVENT_SUCCESS = 2
+EVENT_FAILURE = 3
+EVENT_ERROR = 4
+EVENT_SKIP = 5
+EVENT_STOP = 6
+EVENT_REPORT = 7
+EVENT_PROBLEM = 8
+EVENT_SUMMARY = 9
+EVENT_FINISH = 10
+EVENT_MEMORY = 11
+EVENT_HUNG = 12
+EVENT_AGGREGATES = 13
+EVENT_CACHED = 14
+
+
+class BadEventLog(ValueError):
+    """Raised for truncated or malformed event logs."""
+
+
+def _encode_varint(n):
+    out = bytearray()
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _read_varint(read):
+    shift = n = 0
+    while True:
+        byte = read(1)
+        if not byte:
+            raise BadEventLog("truncated varint")
+        byte = bytearray(byte)[0]
+        n |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return n
+        shift += 7
+
+
+def _decode_fields(payload):
+    fields = []
+    pos = 0
+    end = len(payload)
+    while pos < end:
+        shift = length = 0
+        while True:
+            if pos >= end:
+                raise BadEventLog("truncated field length")
+            byte = payload[pos]
+            pos += 1
+            length |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                break
+            shift += 7
+        if pos + length > end:
+            raise BadEventLog("truncated field")
+        fields.append(payload[pos:pos + length].decode("utf-8"))
+        pos += length
+    return fields
+
+
+def read_event_log(fileobj):
+    """Yield ``(kind, fields)`` for each record of an event log.
+
+    Records are read one at a time, so this runs in constant memory however
+    long the log is.
+    """
+    if fileobj.read(len(EVENT_LOG_MAGIC)) != EVENT_LOG_MAGIC:
+        raise BadEventLog("not a rudolf event log")
+    read = fileobj.read
+    while True:
+        kind = read(1)
+        if not kind:
+            return
+        length = _read_varint(read)
+        payload = read(length)
+        if len(payload) != length:
+            raise BadEventLog("truncated record")
+        yield bytearray(kind)[0], _decode_fields(bytearray(payload))
+
+
+class EventLogWriter(object):
+    """Formatter that writes events to a binary event log.
+
+    Implements the same event methods as ColorfulOutputFormatter, so it can
+    sit behind a FormatterTee.  ``describe`` turns a test into the
+    description that is recorded for it.
+    """
+
+    def __init__(self, fileobj, describe):
+        self._file = fileobj
+        self._describe = describe
+        self._numbers = itertools.count(1)
+        # number of the test the thread runs
+        self._local = threading.local()
+        fileobj.write(EVENT_LOG_MAGIC)
+
+    def _test_number(self):
+        return getattr(self._local, "number", "")
+
+    def _record(self, kind, *fields):
+        payload = []
+        for field in fields:
+            if not isinstance(field, bytes):
+                field = field.encode("utf-8")
+            payload.append(_encode_varint(len(field)))
+            payload.append(field)
+        payload = b"".join(payload)
+        self._file.write(b"".join([
+            bytes(bytearray([kind])), _encode_varint(len(payload)), payload]))
+
+    def start_test(self, test):
+        self._local.number = str(next(self._numbers))
+        self._record(EVENT_START, self._describe(test), self._local.number)
+
+    def test_success(self, test):
+        self._record(EVENT_SUCCESS, self._test_number())
+
+    def test_cached(self, test):
+        self._record(EVENT_CACHED, self._test_number())
+
+    def test_error(self, test, exc_info, label):
+        self._record(EVENT_ERROR, label, self._test_number())
+
+    def test_skip(self, label):
+        self._record(EVENT_SKIP, label, self._test_number())
+
+    def test_failure(self, test, exc_info):
+        self._record(EVENT_FAILURE, self._test_number())
+
+    def test_hung(self, description, elapsed, stacks):
+        fields = [description, repr(elapsed)]
+        for name, stack in stacks:
+            fields.extend([name, stack])
+        self._record(EVENT_HUNG, *fields)
+        self.flush()
+
+    def flush(self):
+        self._file.flush()
+
+    def start_report(self):
+        self._record(EVENT_REPORT)
+
+    def print_error_list(self, flavour, errors):
+        for entry in errors:
+            test, err, err_type = error_entry(entry)
+            if err_type is None:
+                type_kind = ""
+            elif issubclass(err_type, DocTestFailureException):
+                type_kind = "doctest"
+            else:
+                type_kind = "exception"
+            self._record(EVENT_PROBLEM, flavour, self._describe(test),
+                         u"%s" % (err,), type_kind)
+
+    def print_aggregates(self, group_by, rows):
+        fields = [group_by]
+        for key, tests, failures, errors, skips, total, longest in rows:
+            fields.extend([key, str(tests), str(failures), str(errors),
+                           str(skips), repr(total), repr(longest)])
+        self._record(EVENT_AGGREGATES, *fields)
+
+    def print_memory_report(self, growths):
+        fields = []
+        for growth, description, sites in growths:
+            fields.extend([str(growth), description, str(len(sites))])
+            for filename, lineno, size in sites:
+                fields.extend([filename, str(lineno), str(size)])
+        self._record(EVENT_MEMORY, *fields)
+
+    def print_summary(self, success, summary, tests_run, start, stop,
+                      shard=None):
+        fields = [success and "1" or "0", str(tests_run),
+                  repr(start), repr(stop), str(len(summary))]
+        for label, count in summary.items():
+            fields.extend([label, str(count)])
+        if shard is not None:
+            label, predicted = shard
+            fields.extend([label, predicted is not None and repr(predicted)
+                           or ""])
+        self._record(EVENT_SUMMARY, *fields)
+
+    def stop_test(self, test):
+        self._record(EVENT_STOP, self._test_number())
+        self._local.number = ""
+
+    def stop_tests(self):
+        self._record(EVENT_FINISH)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class RecordedTest(object):
+    """Stand-in for a test that only exists as a record in an event log."""
+
+    def __init__(self, description):
+        self._description = description
+
+    def shortDescription(self):
+        return self._description
+
+    def __str__(self):
+        return self._description
+
+
+def _problem_entry(fields):
+    """Return a print_error_list() entry from the fields of a problem record."""
+    description, err, type_kind = fields[1:4]
+    return FailureRecord(description, description,
+                         type_kind and "Exception" or "", err,
+                         type_kind == "doctest")
+
+
+# fields of the records of a test before its number, if the log has one
+_test_fields = {EVENT_START: 1, EVENT_SUCCESS: 0, EVENT_CACHED: 0,
+                EVENT_FAILURE: 0, EVENT_ERROR: 1, EVENT_SKIP: 1, EVENT_STOP: 0}
+
+
+def replay_event_log(fileobj, formatter):
+    """Render an event log through ``formatter``, one record at a time.
+
+    Tests that start while another one is open (tests that ran in several
+    threads) are replayed as a whole when they stop, so that each one's
+    outcome ends up on its own line.
+    """
+    # test number -> (RecordedTest, calls put off until it stops, or None
+    # for the test replayed as it goes); logs without numbers only ever
+    # have one test open, under None
+    open_tests = {}
+    current = []
+
+    def replay(number, method, *args):
+        test, pending = open_tests.get(number, (None, None))
+        if pending is None:
+            method(test, *args)
+        else:
+            pending.append((method, args))
+
+    for kind, fields in read_event_log(fileobj):
+        number = None
+        if kind in _test_fields and len(fields) > _test_fields[kind]:
+            number = fields[_test_fields[kind]]
+        if kind == EVENT_START:
+            test = RecordedTest(fields[0])
+            if current:
+                open_tests[number] = (test, [(formatter.start_test, ())])
+            else:
+                current.append(number)
+                open_tests[number] = (test, None)
+                formatter.start_test(test)
+        elif kind == EVENT_SUCCESS:
+            replay(number, formatter.test_success)
+        elif kind == EVENT_CACHED:
+            replay(number, formatter.test_cached)
+        elif kind == EVENT_FAILURE:
+            replay(number, formatter.test_failure, None)
+        elif kind == EVENT_ERROR:
+            replay(number, formatter.test_error, None, fields[0])
+        elif kind == EVENT_SKIP:
+            replay(number, lambda test, label: formatter.test_skip(label),
+                   fields[0])
+        elif kind == EVENT_STOP:
+            replay(number, formatter.stop_test)
+            test, pending = open_tests.pop(number, (None, None))
+            if pending is not None:
+                for method, args in pending:
+                    method(test, *args)
+            elif current == [number]:
+                del current[:]
+        elif kind == EVENT_REPORT:
+            formatter.start_report()
+        elif kind == EVENT_PROBLEM:
+            formatter.print_error_list(fields[0], [_problem_entry(fields)])
+        elif kind == EVENT_HUNG:
+            stacks = list(zip(fields[2::2], fields[3::2]))
+            formatter.test_hung(fields[0], float(fields[1]), stacks)
+        elif kind == EVENT_AGGREGATES:
+            rows = []
+            for pos in range(1, len(fields), 7):
+                key, tests, failures, errors, skips, total, longest = \
+                    fields[pos:pos + 7]
+                rows.append((key, int(tests), int(failures), int(errors),
+                             int(skips), float(total), float(longest)))
+            formatter.print_aggregates(fields[0], rows)
+        elif kind == EVENT_MEMORY:
+            formatter.print_memory_report(_parse_memory_report(fields))
+        elif kind == EVENT_SUMMARY:
+            args, kwargs = _parse_summary(fields)
+            formatter.print_summary(*args, **kwargs)
+        elif kind == EVENT_FINISH:
+            formatter.stop_tests()
+
+
+def _parse_memory_report(fields):
+    """Return print_memory_report() growths from a memory record."""
+    growths = []
+    pos = 0
+    while pos < len(fields):
+        growth, description, nr_sites = fields[pos:pos + 3]
+        pos += 3
+        sites = []
+        for nr in range(int(nr_sites)):
+            filename, lineno, size = fields[pos:pos + 3]
+            sites.append((filename, int(lineno), int(size)))
+            pos += 3
+        growths.append((int(growth), description, sites))
+    return growths
+
+
+def _parse_summary(fields):
+    """Return print_summary() arguments from the fields of a summary record."""
+    success, tests_run, start, stop, nr_labels = fields[:5]
+    end = 5 + 2 * int(nr_labels)
+    summary = nose.util.odict()
+    for label, count in zip(fields[5:end:2], fields[6:end:2]):
+        summary[label] = int(count)
+    shard = None
+    if len(fields) >= end + 2:
+        label, predicted = fields[end:end + 2]
+        shard = (label, predicted and float(predicted) or None)
+    args = (success == "1", summary, int(tests_run), float(start), float(stop))
+    return args, {"shard": shard}
+
+
+# order of the failure lists in a report; other labels come after these
+_flavour_rank = {"ERROR": 0, "FAIL": 1}
+
+
+def merge_event_logs(fileobjs, formatter, names=None):
+    """Render one report combining the failures and counts of several logs.
+
+    The failure lists of the logs are combined with a k-way merge, reading
+    one record at a time from each log, so memory use doesn't depend on the
+    size of the logs.  ``names`` are used in warnings about incomplete logs.
+    """
+    if names is None:
+        names = [str(index) for index in range(len(fileobjs))]
+    summaries = [None] * len(fileobjs)
+
+    def problems(index, fileobj):
+        records = read_event_log(fileobj)
+        seq = 0
+        while True:
+            try:
+                kind, fields = next(records)
+            except StopIteration:
+                return
+            except BadEventLog as exc:
+                raise BadEventLog("%s: %s" % (names[index], exc))
+            if kind == EVENT_PROBLEM:
+                flavour = fields[0]
+                # index and seq are unique, so fields are never compared
+                yield (_flavour_rank.get(flavour, 2), flavour, index, seq,
+                       fields)
+                seq += 1
+            elif kind == EVENT_SUMMARY:
+                summaries[index] = _parse_summary(fields)[0]
+
+    streams = [problems(index, fileobj)
+               for index, fileobj in enumerate(fileobjs)]
+    for rank, flavour, index, seq, fields in heapq.merge(*streams):
+        formatter.print_error_list(flavour, [_problem_entry(fields)])
+
+    success = True
+    summary = nose.util.odict()
+    tests_run = 0
+    start = stop = None
+    for name, log_summary in zip(names, summaries):
+        if log_summary is None:
+            warnings.warn("%s has no summary: that run didn't finish" % name,
+                          RuntimeWarning)
+            success = False
+            continue
+        log_success, log_counts, log_tests_run, log_start, log_stop = \
+            log_summary
+        success = success and log_success
+        for label, count in log_counts.items():
+            summary[label] = summary.get(label, 0) + count
+        tests_run += log_tests_run
+        if start is None:
+            start, stop = log_start, log_stop
+        start = min(start, log_start)
+        stop = max(stop, log_stop)
+    if start is None:
+        start = stop = 0.0
+    formatter.print_summary(success, summary, tests_run, start, stop)
+
+
+def writeln_decorator(stream):
+    """Wrap ``stream`` so it has the ``writeln`` method formatters use."""
+    # Python <= 2.6 has _WritelnDecorator at top level
+    try:
+        decorator = unittest._WritelnDecorator
+    # Python >= 2.7 has it in the runner module
+    except AttributeError:
+        decorator = unittest.runner._WritelnDecorator
+    return decorator(stream)
+
+
+class _PerThread(object):
+    """Base for containers that threads update without contending for a lock.
+
+    Each thread updates a cell of its own; cells are only combined when read.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._all_cells = []
+        self._lock = threading.Lock()
+
+    def _cell(self):
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = self._new_cell()
+            with self._lock:
+                self._all_cells.append(cell)
+            return cell
+
+    def _cells(self):
+        with self._lock:
+            return list(self._all_cells)
+
+
+class PerThreadList(_PerThread):
+    """List that threads append to without contending for a lock.
+
+    Items appended by one thread stay in order, after those of threads that
+    appended earlier.
+    """
+
+    _new_cell = list
+
+    def append(self, item):
+        self._cell().append(item)
+
+    def __iter__(self):
+        for cell in self._cells():
+            for item in cell:
+                yield item
+
+    def __len__(self):
+        return sum(len(cell) for cell in self._cells())
+
+
+class FailureList(list):
+    """List of ``(test, err)`` pairs that keeps a FailureRecord in place of
+    each test, so that it does not keep the test alive.
+
+    Records appended as they are stay as they are.  ``exc_type`` is the
+    class to format the errors of the other entries as, if known.
+    """
+
+    def __init__(self, items, describe, exc_type=None):
+        list.__init__(self)
+        self._describe = describe
+        self._exc_type = exc_type
+        for item in items:
+            self.append(item)
+
+    def append(self, item):
+        if isinstance(item, FailureRecord):
+            list.append(self, item)
+            return
+        test = item[0]
+        if not isinstance(test, FailureRecord):
+            test = FailureRecord.from_test(test, item[1], self._exc_type,
+                                           self._describe)
+        list.append(self, (test,) + tuple(item[1:]))
+
+
+class PerThreadCounter(_PerThread):
+    """Counter that threads increment without contending for a lock."""
+
+    def _new_cell(self):
+        return [0]
+
+    def add(self, n=1):
+        self._cell()[0] += n
+
+    def value(self):
+        return sum(cell[0] for cell in self._cells())
+
+
+class Aggregates(_PerThread):
+    """Running totals of test outcomes and durations, by group.
+
+    Each test costs one dict lookup, in a cell of the calling thread's own.
+    A row is ``[tests, failures, errors, skips, total_time, max_time]``.
+    """
+
+    columns = {"failure": 1, "error": 2, "skip": 3}
+
+    _new_cell = dict
+
+    def add(self, key, outcome, duration):
+        """Count a test of group ``key``; ``outcome`` is None for a pass,
+        or one of the keys of ``columns``."""
+        cell = self._cell()
+        try:
+            row = cell[key]
+        except KeyError:
+            row = cell[key] = [0, 0, 0, 0, 0.0, 0.0]
+        row[0] += 1
+        if outcome is not None:
+            row[self.columns[outcome]] += 1
+        row[4] += duration
+        if duration > row[5]:
+            row[5] = duration
+
+    def rows(self):
+        """Return ``(key, tests, failures, errors, skips, total_time,
+        max_time)`` tuples; those with most failures and errors first, then
+        the slowest."""
+        combined = {}
+        for cell in self._cells():
+            for key, row in list(cell.items()):
+                try:
+                    total = combined[key]
+                except KeyError:
+                    combined[key] = list(row)
+                    continue
+                for index in range(5):
+                    total[index] += row[index]
+                total[5] = max(total[5], row[5])
+        rows = [(key,) + tuple(row) for key, row in combined.items()]
+        rows.sort(key=lambda row: (-(row[2] + row[3]), -row[5], row[0]))
+        return rows
+
+
+def group_names(test):
+    """Return the names of the module and class to group a test under.
+
+    Tests that are functions are grouped under their module for both.
+    """
+    try:
+        module, call = test.address()[1:]
+    except (AttributeError, TypeError, ValueError):
+        # not a nose test; guess from the id
+        parts = test.id().split(".")
+        if len(parts) > 2:
+            return ".".join(parts[:-2]), ".".join(parts[:-1])
+        return parts[0], parts[0]
+    if module is None:
+        module = "?"
+    if call is not None and "." in call:
+        return module, "%s.%s" % (module, call.rsplit(".", 1)[0])
+    return module, module
+
+
+def parse_size(size_text):
+    """Parse a size such as ``500``, ``200k`` or ``10M`` (powers of 1024)."""
+    m = re.match(r"\s*(\d+)\s*([kKmMgG]?)[bB]?\s*$", size_text)
+    if not m:
+        raise ValueError("not a size: %r" % size_text)
+    number, unit = m.groups()
+    return int(number) * 1024 ** " kmg".index(unit.lower() or " ")
+
+
+def parse_shard(shard_text):
+    """Parse an ``I/N`` shard spec into ``(I, N)``; shards count from 1."""
+    try:
+        index, count = [int(part) for part in shard_text.split("/")]
+    except ValueError:
+        raise ValueError("Bad shard (expected I/N): %r" % shard_text)
+    if not 1 <= index <= count:
+        raise ValueError("Bad shard (expected 1 <= I <= N): %r" % shard_text)
+    return index, count
+
+
+def _load_json_dict(path, what):
+    try:
+        with open(path) as fileobj:
+            data = json.load(fileobj)
+    except (IOError, OSError):
+        return {}
+    except ValueError as exc:
+        warnings.warn("Ignoring bad %s file %s: %s" % (what, path, exc),
+                      RuntimeWarning)
+        return {}
+    if not isinstance(data, dict):
+        warnings.warn("Ignoring bad %s file %s" % (what, path),
+                      RuntimeWarning)
+        return {}
+    return data
+
+
+def _save_json(path, data):
+    # write then rename, so that a concurrent reader never sees half a file
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "w") as fileobj:
+        json.dump(data, fileobj, sort_keys=True, indent=0)
+    _replace(tmp_path, path)
+
+
+def _replace(src, dst):
+    """Rename ``src`` to ``dst``, even where rename won't overwrite."""
+    try:
+        replace = os.replace
+    except AttributeError:  # Python 2
+        try:
+            os.rename(src, dst)
+        except OSError:
+            # Windows: make way, at the cost of a moment without the file
+            os.remove(dst)
+            os.rename(src, dst)
+    else:
+        replace(src, dst)
+
+
+def load_durations(path):
+    """Return the per-test durations stored at ``path``: {test id: seconds}.
+
+    A missing file is just an empty history.
+    """
+    return _load_json_dict(path, "durations")
+
+
+def save_durations(path, durations):
+    _save_json(path, durations)
+
+
+class SourceHasher(object):
+    """Hash the source of a module and of the project modules it imports.
+
+    Project modules are those with a source file under ``project_dir``
+    (other than in site-packages).  A module imports those that its globals
+    refer to, either directly or through the classes and functions they
+    define; the hash covers all those that can be reached that way, and the
+    Python version.  File and module hashes are computed once.
+    """
+
+    def __init__(self, project_dir):
+        self._project_dir = os.path.join(os.path.abspath(project_dir), "")
+        self._file_hashes = {}
+        self._module_hashes = {}
+
+    def module_hash(self, name):
+        """Return the hash of module ``name``, or None if it can't be had."""
+        try:
+            return self._module_hashes[name]
+        except KeyError:
+            pass
+        digest = None
+        if self._source_path(sys.modules.get(name)) is not None:
+            digest = hashlib.sha1(sys.version.encode("utf-8"))
+            for dependency in sorted(self._dependencies(name)):
+                file_hash = self._file_hash(
+                    self._source_path(sys.modules[dependency]))
+                if file_hash is None:
+                    digest = None
+                    break
+                digest.update(("%s:%s\n" % (dependency, file_hash))
+                              .encode("utf-8"))
+            if digest is not None:
+                digest = digest.hexdigest()
+        self._module_hashes[name] = digest
+        return digest
+
+    def _source_path(self, module):
+        path = getattr(module, "__file__", None)
+        if not path:
+            return None
+        path = os.path.abspath(path)
+        if not path.startswith(self._project_dir) or (
+                "site-packages" in path):
+            return None
+        if path.endswith((".pyc", ".pyo")):
+            path = path[:-1]
+        return path
+
+    def _file_hash(self, path):
+        try:
+            return self._file_hashes[path]
+        except KeyError:
+            pass
+        try:
+            with open(path, "rb") as fileobj:
+                file_hash = hashlib.sha1(fileobj.read()).hexdigest()
+        except (IOError, OSError):
+            file_hash = None
+        self._file_hashes[path] = file_hash
+        return file_hash
+
+    def _dependencies(self, name):
+        """Return the names of the project modules ``name`` reaches."""
+        seen = set([name])
+        todo = [name]
+        while todo:
+            module = sys.modules[todo.pop()]
+            for value in list(vars(module).values()):
+                if isinstance(value, types.ModuleType):
+                    referred = value.__name__
+                else:
+                    try:
+                        referred = getattr(value, "__module__", None)
+                    except Exception:
+                        continue
+                if (referred in seen or not isinstance(referred, str)
+                        or self._source_path(sys.modules.get(referred))
+                        is None):
+                    continue
+                seen.add(referred)
+                todo.append(referred)
+        return seen
+
+
+def load_result_cache(path):
+    """Return the result cache stored at ``path``: {test id: source hash}.
+
+    A missing file is just an empty cache.
+    """
+    return _load_json_dict(path, "result cache")
+
+
+def save_result_cache(path, cache):
+    _save_json(path, cache)
+
+
+def stable_hash(text):
+    """Hash of ``text`` that is the same in every process and Python version."""
+    return zlib.crc32(text.encode("utf-8")) & 0xffffffff
+
+
+def partition_tests(test_ids, count, durations):
+    """Deterministically split ``test_ids`` into ``count`` shards.
+
+    If any of the tests have a duration in ``durations``, shards are
+    balanced by giving each test, longest first, to the shard with the least
+    predicted time; tests without history are predicted to take the mean
+    known duration.  Otherwise tests are placed by a stable hash of their id.
+
+    Returns ``(shards, predicted)``: a list of sets of test ids, and a list of
+    the predicted seconds for each shard (None without history).
+    """
+    shards = [set() for index in range(count)]
+    known = [durations[test_id] for test_id in test_ids
+             if test_id in durations]
+    if not known:
+        for test_id in test_ids:
+            shards[stable_hash(test_id) % count].add(test_id)
+        return shards, None
+    default = sum(known) / len(known)
+    weighted = sorted((-durations.get(test_id, default), test_id)
+                      for test_id in test_ids)
+    loads = [(0.0, index) for index in range(count)]
+    for negative_duration, test_id in weighted:
+        load, index = heapq.heappop(loads)
+        shards[index].add(test_id)
+        heapq.heappush(loads, (load - negative_duration, index))
+    predicted = [0.0] * count
+    for load, index in loads:
+        predicted[index] = load
+    return shards, predicted
+
+
+def iter_tests(suite):
+    """Yield the tests in ``suite`` in run order, loading them as it goes.
+
+    nose loads tests from generators that can only be iterated over once, so
+    this uses ``suite`` up.
+    """
+    for child in suite:
+        if isinstance(child, unittest.TestSuite):
+            for test in iter_tests(child):
+                yield test
+        else:
+            yield child
+
+
+def filter_suite(suite, keep):
+    """Make ``suite`` drop the tests for which ``keep(test)`` is false, as
+    it loads them.
+
+    Suites left empty are dropped too, so their fixtures don't run; that
+    takes loading each suite up to its first kept test before it runs.
+    """
+    _set_tests(suite, _kept_tests(_take_tests(suite), keep))
+
+
+def _kept_tests(tests, keep):
+    for test in tests:
+        if not isinstance(test, unittest.TestSuite):
+            if keep(test):
+                yield test
+            continue
+        children = _kept_tests(_take_tests(test), keep)
+        for first in children:
+            _set_tests(test, itertools.chain([first], children))
+            yield test
+            break
+
+
+def _take_tests(suite):
+    """Return an iterator over the tests of ``suite`` that doesn't change
+    when they are replaced."""
+    if isinstance(suite, nose.suite.LazySuite):
+        # iter(suite) would only look up the generator once it gets there
+        return itertools.chain(suite._precache, suite.test_generator or ())
+    return iter(suite._tests)
+
+
+def _set_tests(suite, tests):
+    if isinstance(suite, nose.suite.LazySuite):
+        suite._tests = lambda: tests
+    else:
+        # unittest's suites count their tests, so they need a list
+        suite._tests = list(tests)
+
+
+try:
+    _PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+
+
+def read_rss():
+    """Return the resident set size of this process in bytes.
+
+    Returns None where /proc/self/statm is not available.
+    """
+    try:
+        with open("/proc/self/statm", "rb") as statm:
+            fields = statm.read().split()
+    except (IOError, OSError):
+        return None
+    return int(fields[1]) * _PAGE_SIZE
+
+
+class MemoryTracker(object):
+    """Find the tests that grow the memory of the process the most.
+
+    ``start`` and ``stop`` bracket each test, which costs two reads of
+    /proc/self/statm.  Only the ``top`` largest growths are kept.  If
+    ``trace_sites`` is non-zero, tracemalloc snapshots are also taken around
+    each test -- which is much slower -- and that many of the allocation
+    sites that grew most are kept for each of the top tests.
+
+    RSS is per process, so with tests running in several threads the growth
+    of a test includes that of the tests that ran alongside it.
+    """
+
+    def __init__(self, top=10, trace_sites=0):
+        self._top = top
+        self._trace_sites = trace_sites
+        # min-heap of (growth, seq, description, sites)
+        self._heap = []
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._started_tracing = False
+        if trace_sites and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def start(self):
+        if self._trace_sites:
+            self._local.snapshot = self._snapshot()
+        self._local.rss = read_rss()
+
+    def stop(self, describe, test):
+        rss = read_rss()
+        start_rss = self._local.rss
+        if rss is None or start_rss is None:
+            return
+        growth = rss - start_rss
+        heap = self._heap
+        if growth <= 0 or (len(heap) >= self._top and growth <= heap[0][0]):
+            return
+        sites = []
+        if self._trace_sites:
+            stats = self._snapshot().compare_to(
+                self._local.snapshot, "lineno")
+            for stat in stats[:self._trace_sites]:
+                frame = stat.traceback[0]
+                sites.append((frame.filename, frame.lineno, stat.size_diff))
+        with self._lock:
+            self._seq += 1
+            entry = (growth, self._seq, describe(test), sites)
+            if len(heap) < self._top:
+                heapq.heappush(heap, entry)
+            elif growth > heap[0][0]:
+                heapq.heapreplace(heap, entry)
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def largest(self):
+        """Return ``(growth, description, sites)`` tuples, largest first.
+
+        ``sites`` is a list of ``(filename, lineno, growth)`` tuples.
+        """
+        return [(growth, description, sites) for growth, seq, description,
+                sites in sorted(self._heap, reverse=True)]
+
+    def close(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+
+
+class WatchdogTimeout(Exception):
+    """Raised in a test that ran for longer than --color-watchdog allows."""
+
+
+def format_thread_stacks(skip=()):
+    """Return ``(thread_name, formatted_stack)`` for each running thread,
+    except for the thread ids in ``skip``."""
+    names = dict((thread.ident, thread.name)
+                 for thread in threading.enumerate())
+    stacks = []
+    for ident, frame in sys._current_frames().items():
+        if ident in skip:
+            continue
+        stacks.append((names.get(ident, str(ident)),
+                       "".join(traceback.format_stack(frame))))
+    del frame
+    return stacks
+
+
+# Python < 3.3 and Windows can't send a signal to a thread
+_watchdog_signal = (hasattr(signal, "pthread_kill")
+                    and getattr(signal, "SIGUSR2", None) or None)
+
+
+def in_result_hooks(frame):
+    """Return whether ``frame`` runs inside nose's result proxy or plugin
+    hooks, so that the test it belongs to has already finished."""
+    while frame is not None:
+        if frame.f_globals.get("__name__") in ("nose.proxy",
+                                              "nose.plugins.manager"):
+            return True
+        frame = frame.f_back
+    return False
+
+
+def raise_in_thread(ident, exc_type):
+    """Raise ``exc_type`` in the thread ``ident`` the next time it runs
+    Python code.  Returns whether that could be arranged (CPython only)."""
+    try:
+        import ctypes
+        set_async_exc = ctypes.pythonapi.PyThreadState_SetAsyncExc
+    except (ImportError, AttributeError):
+        return False
+    return set_async_exc(ctypes.c_ulong(ident),
+                         ctypes.py_object(exc_type)) == 1
+
+
+class Watchdog(object):
+    """Notice tests that run for longer than ``timeout`` seconds.
+
+    ``arm`` and ``disarm`` bracket a test, in the thread that runs it.  A
+    daemon thread sleeps until the earliest deadline and calls
+    ``on_timeout(description, elapsed, thread_id, token)`` once for each
+    test still running at its deadline; ``token`` tells that test apart
+    from later ones in the same thread, for ``interrupt``.  Arming and
+    disarming only take a lock and update dicts.
+    """
+
+    def __init__(self, timeout, on_timeout):
+        self.timeout = timeout
+        self._on_timeout = on_timeout
+        self._cond = threading.Condition()
+        # thread id -> (deadline, start, description, token), until the
+        # deadline has passed
+        self._running = {}
+        # thread id -> token of the test it runs, until disarmed
+        self._tokens = {}
+        self._next_token = 0
+        self._closed = False
+        # thread that catch_signal() set up, and what its handler raises
+        self._signal_ident = None
+        self._old_handler = None
+        self._pending = None
+        self._thread = threading.Thread(target=self._run,
+                                        name="rudolf-watchdog")
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def ident(self):
+        return self._thread.ident
+
+    def arm(self, description):
+        start = time.time()
+        ident = threading.current_thread().ident
+        with self._cond:
+            self._next_token += 1
+            self._tokens[ident] = self._next_token
+            self._running[ident] = (start + self.timeout, start, description,
+                                    self._next_token)
+            if len(self._running) == 1:
+                # every other deadline is earlier, so only a watchdog with
+                # nothing to watch needs waking
+                self._cond.notify()
+
+    def disarm(self):
+        ident = threading.current_thread().ident
+        with self._cond:
+            self._running.pop(ident, None)
+            self._tokens.pop(ident, None)
+
+    def catch_signal(self):
+        """Interrupt tests in the calling thread, which must be the main
+        one, with a signal: unlike an asynchronous exception, that also
+        breaks out of sleeps and blocking calls.  Return whether that is
+        possible here; ``close`` restores the old handler."""
+        if _watchdog_signal is None:
+            return False
+        try:
+            self._old_handler = signal.signal(_watchdog_signal,
+                                              self._on_signal)
+        except ValueError:  # not the main thread
+            return False
+        self._signal_ident = threading.current_thread().ident
+        return True
+
+    def interrupt(self, ident, token, exc_type, before=None):
+        """Raise ``exc_type`` in thread ``ident`` if it is still running
+        the test of ``token``; return whether it was.
+
+        ``before`` is called first, if given.  Both happen under the lock
+        disarm() takes, so a test that finishes meanwhile either gets the
+        exception or sees what ``before`` did.  A test that already went
+        on to report its outcome to nose isn't interrupted.
+        """
+        with self._cond:
+            if self._tokens.get(ident) != token:
+                return False
+            frame = sys._current_frames().get(ident)
+            if frame is None or in_result_hooks(frame):
+                return False
+            del frame
+            if before is not None:
+                before()
+            if ident == self._signal_ident:
+                self._pending = (token, exc_type)
+                signal.pthread_kill(ident, _watchdog_signal)
+            else:
+                raise_in_thread(ident, exc_type)
+            return True
+
+    def _on_signal(self, signum, frame):
+        __tracebackhide__ = True
+        pending, self._pending = self._pending, None
+        if pending is None:
+            return
+        token, exc_type = pending
+        # runs in the test's thread, so disarm() can't run meanwhile; no
+        # need for the lock, which that thread may hold already
+        if (self._tokens.get(self._signal_ident) == token
+                and not in_result_hooks(frame)):
+            raise exc_type()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        if self._signal_ident is not None:
+            signal.signal(_watchdog_signal, self._old_handler)
+            self._signal_ident = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                expired = self._wait()
+            if expired is None:
+                return
+            now = time.time()
+            for ident, (deadline, start, description, token) in expired:
+                self._on_timeout(description, now - start, ident, token)
+
+    def _wait(self):
+        """Wait for deadlines to pass and return the expired entries, or
+        None once closed."""
+        while not self._closed:
+            now = time.time()
+            expired = [(ident, entry) for ident, entry in
+                       self._running.items() if entry[0] <= now]
+            if expired:
+                for ident, entry in expired:
+                    del self._running[ident]
+                return expired
+            if self._running:
+                self._cond.wait(min(entry[0] for entry in
+                                    self._running.values()) - now)
+            else:
+                self._cond.wait()
+        return None
+
+
+class FlakyTest(Exception):
+    """Error class of tests that failed, but passed when run again."""
+
+
+def loadable_name(test):
+    """Return the name nose's loader can load ``test`` again from, or None."""
+    try:
+        filename, module, call = test.address()
+    except (AttributeError, TypeError, ValueError):
+        return None
+    name = module or filename
+    if name and call:
+        name = "%s:%s" % (name, call)
+    return name
+
+
+def passes_when_rerun(loader, name):
+    """Load the tests called ``name`` afresh and say whether they pass."""
+    suite = loader.loadTestsFromName(name)
+    result = unittest.TestResult()
+    suite(result)
+    return bool(result.testsRun and result.wasSuccessful()
+                and not getattr(result, "skipped", ()))
+
+
+class ColorOutputPlugin(nose.plugins.Plugin):
+
+    """Output test results in colour to terminal."""
+
+    name = "color"
+
+    formatter_class = ColorfulOutputFormatter
+    clean_tracebacks = False
+    base_dir = None
+
+    # These colors are carefully chosen to have enough contrast
+    # on terminals with both black and white background.
+    default_colorscheme = {"normal": "normal",
+                           "pass": "green",
+                           "failure": "magenta",
+                           "error": "brightred",
+                           "number": "green",
+                           "ok-number": "green",
+                           "error-number": "brightred",
+                           "filename": "lightblue",
                            "lineno": "lightred",
                            "testname": "lightcyan",
                            "failed-example": "cyan",
@@ -610,7 +3451,15 @@ class ColorOutputPlugin(nose.plugins.Plugin):
                            "character-diffs": "magenta",
                            "diff-chunk": "magenta",
                            "exception": "red",
-                           "skip": "yellow"}
+                           "skip": "yellow",
+                           "local-name": "lightyellow",
+                           "local-value": "normal",
+                           "memory-growth": "brightred",
+                           "watchdog": "brightyellow",
+                           "flaky": "brightmagenta",
+                           "cached": "lightgreen",
+                           "eta": "cyan",
+                           "repeated-frames": "yellow"}
     default_colorscheme = dict((name, parse_color(color)) for name, color in
                                default_colorscheme.items())
 
@@ -624,10 +3473,35 @@ class ColorOutputPlugin(nose.plugins.Plugin):
     def __init__(self):
         nose.plugins.Plugin.__init__(self)
         self._result = None
+        # state of the test running in each thread
+        self._local = threading.local()
+        # replaced, never changed in place, so a run can go on iterating
+        # over the old list
+        self._listeners = []
         # for debugging
 #         self.base_dir = os.path.dirname(__file__)
 #     clean_tracebacks = True
 
+    @classmethod
+    def find(cls, conf):
+        """Return the enabled ColorOutputPlugin of a nose config, or None.
+
+        For other plugins to add listeners to, from their begin() or later
+        (in configure() it may not have been enabled yet).
+        """
+        for plugin in conf.plugins.plugins:
+            if isinstance(plugin, cls) and plugin.enabled:
+                return plugin
+        return None
+
+    def add_listener(self, listener):
+        """Tell ``listener`` about each test and the run; see Listener."""
+        self._listeners = self._listeners + [listener]
+
+    def remove_listener(self, listener):
+        self._listeners = [each for each in self._listeners
+                           if each is not listener]
+
     def options(self, parser, env=os.environ):
         nose.plugins.Plugin.options(self, parser, env)
         parser.add_option("--no-color", action="store_false",
@@ -658,6 +3532,243 @@ class ColorOutputPlugin(nose.plugins.Plugin):
                                "colour 'normal'.  Example: "
                                "--colors='fail=red,pass=rgb(00ff00),error=45' "
                                + "[%s]" % env_opt)
+        env_opt = "NOSE_COLOR_THEME"
+        parser.add_option("--color-theme", action="store",
+                          type="string",
+                          dest="color_theme",
+                          default=env.get(env_opt, ""),
+                          metavar="NAME",
+                          help="Take the colour scheme from the theme file "
+                               "NAME.theme in .rudolf/themes in the project "
+                               "or in ~/.config/rudolf/themes (or from the "
+                               "file NAME, if it's a path).  Theme files "
+                               "have one name = colour per line, in the "
+                               "--colors colour format; --colors overrides "
+                               "them.  Compiled themes are cached in "
+                               "~/.cache/rudolf [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_RECORD"
+        parser.add_option("--color-record", action="store",
+                          type="string",
+                          dest="color_record",
+                          default=env.get(env_opt, ""),
+                          metavar="PATH",
+                          help="Also write the stream of output events to "
+                               "a compact binary log at PATH, which "
+                               "'rudolf replay PATH' renders later with any "
+                               "colour scheme or verbosity "
+                               "[%s]" % env_opt)
+        env_opt = "NOSE_COLOR_RENDERER"
+        parser.add_option("--color-renderer", action="store",
+                          type="string",
+                          dest="color_renderer",
+                          default=env.get(env_opt, "ansi256"),
+                          metavar="NAME",
+                          help="How to render colours: 'ansi256' (xterm 256 "
+                               "colour codes), 'ansi16' (basic ANSI colours "
+                               "only), 'plain' (no colour), 'html', or "
+                               "'auto' (ansi256 on a terminal, plain "
+                               "otherwise) [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_HTML"
+        parser.add_option("--color-html", action="store",
+                          type="string",
+                          dest="color_html",
+                          default=env.get(env_opt, ""),
+                          metavar="PATH",
+                          help="Also write a verbose HTML report to PATH, "
+                               "as the tests run [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_HIDE_FRAMES"
+        parser.add_option("--color-hide-frames", action="store",
+                          type="string",
+                          dest="color_hide_frames",
+                          default=env.get(env_opt, ""),
+                          metavar="FILTERS",
+                          help="Leave frames out of tracebacks.  Format is "
+                               "a comma-separated list of module:PREFIX "
+                               "(frames in that module or package), "
+                               "path:GLOB (frames in matching files) and "
+                               "marker:NAME (frames with that local or "
+                               "global variable; __tracebackhide__ is "
+                               "always honoured).  Example: "
+                               "--color-hide-frames='module:nose,"
+                               "path:*/site-packages/mock/*' "
+                               "[%s]" % env_opt)
+        env_opt = "NOSE_COLOR_LOCALS"
+        parser.add_option("--color-locals", action="store_true",
+                          dest="color_locals",
+                          default=bool(env.get(env_opt)),
+                          help="Show the local variables of each frame in "
+                               "tracebacks, with size-limited reprs "
+                               "[%s]" % env_opt)
+        env_opt = "NOSE_COLOR_LOCALS_BUDGET"
+        parser.add_option("--color-locals-budget", action="store",
+                          type="float",
+                          dest="color_locals_budget",
+                          default=float(env.get(env_opt, 0.1)),
+                          metavar="SECONDS",
+                          help="Stop capturing local variables for a "
+                               "failure after this long (default 0.1) "
+                               "[%s]" % env_opt)
+        env_opt = "NOSE_COLOR_DIFF_BUDGET"
+        parser.add_option("--color-diff-budget", action="store",
+                          type="float",
+                          dest="color_diff_budget",
+                          default=float(env.get(env_opt, 0.5)),
+                          metavar="SECONDS",
+                          help="Show failed assertEqual()s of long strings "
+                               "and containers as a line and character "
+                               "diff, and give up on diffing after this "
+                               "long (default 0.5; 0 leaves unittest's "
+                               "message as it is) [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_DIFF_MAX_SIZE"
+        parser.add_option("--color-diff-max-size", action="store",
+                          type="string",
+                          dest="color_diff_max_size",
+                          default=env.get(env_opt, "1M"),
+                          metavar="SIZE",
+                          help="Only show where values first differ when "
+                               "they are longer than this together, e.g. "
+                               "500k (default 1M) [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_SHARD"
+        parser.add_option("--color-shard", action="store",
+                          type="string",
+                          dest="color_shard",
+                          default=env.get(env_opt, ""),
+                          metavar="I/N",
+                          help="Only run shard I of N (counting from 1) of "
+                               "the collected tests.  Shards are balanced "
+                               "using --color-durations history if there "
+                               "is any [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_DURATIONS"
+        parser.add_option("--color-durations", action="store",
+                          type="string",
+                          dest="color_durations",
+                          default=env.get(env_opt, ""),
+                          metavar="PATH",
+                          help="File in which to keep the duration of each "
+                               "test, updated after every run "
+                               "[%s]" % env_opt)
+
+        env_opt = "NOSE_COLOR_MEMORY"
+        parser.add_option("--color-memory", action="store_true",
+                          dest="color_memory",
+                          default=bool(env.get(env_opt)),
+                          help="Measure how much each test grows the "
+                               "resident memory of the process, and list "
+                               "the tests that grew it most after the "
+                               "failures [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_MEMORY_TOP"
+        parser.add_option("--color-memory-top", action="store",
+                          type="int",
+                          dest="color_memory_top",
+                          default=int(env.get(env_opt, 10)),
+                          metavar="N",
+                          help="Number of tests listed by --color-memory "
+                               "(default 10) [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_MEMORY_TRACE"
+        parser.add_option("--color-memory-trace", action="store",
+                          type="int",
+                          dest="color_memory_trace",
+                          default=int(env.get(env_opt, 0)),
+                          metavar="N",
+                          help="Also show the N source lines that allocated "
+                               "most during each listed test.  Uses "
+                               "tracemalloc snapshots, which slows the run "
+                               "down a lot [%s]" % env_opt)
+
+        env_opt = "NOSE_COLOR_WATCHDOG"
+        parser.add_option("--color-watchdog", action="store",
+                          type="float",
+                          dest="color_watchdog",
+                          default=float(env.get(env_opt, 0)),
+                          metavar="SECONDS",
+                          help="Warn about tests still running after this "
+                               "long, and show the stacks of all threads "
+                               "[%s]" % env_opt)
+        env_opt = "NOSE_COLOR_WATCHDOG_ABORT"
+        parser.add_option("--color-watchdog-abort", action="store_true",
+                          dest="color_watchdog_abort",
+                          default=bool(env.get(env_opt)),
+                          help="Make --color-watchdog also raise "
+                               "WatchdogTimeout in a test it warns about.  "
+                               "If the test is still running after as long "
+                               "again, exit [%s]" % env_opt)
+
+        env_opt = "NOSE_COLOR_SUMMARY_BY"
+        parser.add_option("--color-summary-by", action="store",
+                          type="string",
+                          dest="color_summary_by",
+                          default=env.get(env_opt, ""),
+                          metavar="module|class",
+                          help="Before the summary, show a table of the "
+                               "number of tests, failures, errors and skips "
+                               "and the total and longest test time of "
+                               "each module or class, those with most "
+                               "problems first, then the slowest "
+                               "[%s]" % env_opt)
+
+        env_opt = "NOSE_COLOR_RERUN_FAILURES"
+        parser.add_option("--color-rerun-failures", action="store",
+                          type="int",
+                          dest="color_rerun_failures",
+                          default=int(env.get(env_opt, 0)),
+                          metavar="N",
+                          help="After the run, run each failed or errored "
+                               "test again, up to N times.  Tests that pass "
+                               "are reported as FLAKY rather than as "
+                               "failures [%s]" % env_opt)
+
+        env_opt = "NOSE_COLOR_CACHE"
+        parser.add_option("--color-cache", action="store",
+                          type="string",
+                          dest="color_cache",
+                          default=env.get(env_opt, ""),
+                          metavar="PATH",
+                          help="Keep a cache of passing tests at PATH, with "
+                               "a hash of the source of each test's module "
+                               "and of the project modules it imports.  "
+                               "Tests whose hash is unchanged are reported "
+                               "as cached instead of being run.  Only "
+                               "Python source is hashed [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_CACHE_REFRESH"
+        parser.add_option("--color-cache-refresh", action="store_true",
+                          dest="color_cache_refresh",
+                          default=bool(env.get(env_opt)),
+                          help="Run every test, even those --color-cache "
+                               "would skip, and refresh the cache "
+                               "[%s]" % env_opt)
+
+        env_opt = "NOSE_COLOR_ETA"
+        parser.add_option("--color-eta", action="store",
+                          type="float",
+                          dest="color_eta",
+                          default=float(env.get(env_opt, 0)),
+                          metavar="SECONDS",
+                          help="Every SECONDS or so, show an estimate of the "
+                               "time left and the tests run per second, "
+                               "from --color-durations history if there is "
+                               "any.  The summary then shows the predicted "
+                               "time of the run [%s]" % env_opt)
+
+        env_opt = "NOSE_COLOR_MAX_OUTPUT"
+        parser.add_option("--color-max-output", action="store",
+                          type="string",
+                          dest="color_max_output",
+                          default=env.get(env_opt, ""),
+                          metavar="SIZE",
+                          help="Once the failures and errors reported have "
+                               "taken SIZE characters (e.g. 500000, 200k or "
+                               "10M), write the rest only to "
+                               "--color-spill-file, and say how many went "
+                               "there [%s]" % env_opt)
+        env_opt = "NOSE_COLOR_SPILL_FILE"
+        parser.add_option("--color-spill-file", action="store",
+                          type="string",
+                          dest="color_spill_file",
+                          default=env.get(env_opt, "rudolf-report.txt"),
+                          metavar="PATH",
+                          help="Where --color-max-output writes the rest of "
+                               "the report, without colour (default "
+                               "rudolf-report.txt) [%s]" % env_opt)
 
     def configure(self, options, conf):
         nose.plugins.Plugin.configure(self, options, conf)
@@ -666,6 +3777,27 @@ class ColorOutputPlugin(nose.plugins.Plugin):
 
         self._verbosity = conf.verbosity
         cs = dict(self.default_colorscheme)
+        isatty = getattr(conf.stream, "isatty", None)
+        renderer_name = resolve_renderer_name(options.color_renderer,
+                                              isatty is not None and isatty())
+        theme = {}
+        if options.color_theme:
+            # only compile the theme for the renderers that will use it
+            capabilities = set([renderer_name in renderers and renderer_name
+                                or "ansi256"])
+            if options.color_html:
+                capabilities.add("html")
+            try:
+                theme = load_theme(options.color_theme, capabilities,
+                                   conf.workingDir)
+            except ValueError as exc:
+                warnings.warn("Bad --color-theme: %s" % exc, RuntimeWarning)
+            unknown_names = set(theme.keys()) - set(cs.keys())
+            if unknown_names:
+                warnings.warn("Invalid colorscheme names in theme %s: %s" %
+                              (options.color_theme,
+                               ", ".join(sorted(unknown_names))))
+            cs.update(theme)
         try:
             user_colorscheme = parse_colorscheme(options.colors)
         except ValueError as exc:
@@ -682,6 +3814,97 @@ class ColorOutputPlugin(nose.plugins.Plugin):
                           (", ".join(unknown_names)))
         cs.update(user_colorscheme)
         self._colorscheme = cs
+        try:
+            self._renderer = make_renderer(renderer_name, cs)
+        except ValueError as exc:
+            warnings.warn("Bad --color-renderer: %s" % exc, RuntimeWarning)
+            self._renderer = make_renderer("ansi256", cs)
+        try:
+            self._frame_filter = parse_frame_filters(options.color_hide_frames)
+        except ValueError as exc:
+            warnings.warn("Bad --color-hide-frames: %s" % exc, RuntimeWarning)
+            self._frame_filter = parse_frame_filters("")
+        self._capture_locals = None
+        if options.color_locals:
+            self._capture_locals = LocalsCapture(
+                budget=options.color_locals_budget)
+        self._assertion_diff = None
+        if options.color_diff_budget > 0:
+            try:
+                max_size = parse_size(options.color_diff_max_size)
+            except ValueError as exc:
+                warnings.warn("Bad --color-diff-max-size: %s" % exc,
+                              RuntimeWarning)
+                max_size = AssertionDiff().max_size
+            self._assertion_diff = AssertionDiff(
+                budget=options.color_diff_budget, max_size=max_size)
+        self._html_path = options.color_html
+        self._record_path = options.color_record
+        self._shard = None
+        if options.color_shard:
+            try:
+                self._shard = parse_shard(options.color_shard)
+            except ValueError as exc:
+                warnings.warn("Bad --color-shard: %s" % exc, RuntimeWarning)
+        self._shard_predicted = None
+        self._durations_path = options.color_durations
+        self._history = {}
+        # durations of this run's tests, only kept when there's a history file
+        self._durations = None
+        if self._durations_path:
+            self._history = load_durations(self._durations_path)
+            self._durations = {}
+        self._memory = None
+        if options.color_memory:
+            trace_sites = options.color_memory_trace
+            if trace_sites and tracemalloc is None:
+                warnings.warn("--color-memory-trace needs tracemalloc "
+                              "(Python 3.4 or later)", RuntimeWarning)
+                trace_sites = 0
+            if read_rss() is None:
+                warnings.warn("--color-memory needs /proc/self/statm",
+                              RuntimeWarning)
+            else:
+                self._memory = MemoryTracker(options.color_memory_top,
+                                             trace_sites)
+        self._rerun = options.color_rerun_failures
+        self._max_report_size = None
+        if options.color_max_output:
+            try:
+                self._max_report_size = parse_size(options.color_max_output)
+            except ValueError as exc:
+                warnings.warn("Bad --color-max-output: %s" % exc,
+                              RuntimeWarning)
+        self._spill_path = options.color_spill_file
+        self._eta = options.color_eta
+        # predicted durations of the tests to run, for --color-eta
+        self._predictions = []
+        self._cache_path = options.color_cache
+        self._cache_refresh = options.color_cache_refresh
+        self._cache = None
+        if self._cache_path:
+            self._cache = load_result_cache(self._cache_path)
+            # source hashes of the tests that run, and which of them pass
+            self._cache_hashes = {}
+            self._cache_passed = set()
+            self._hasher = SourceHasher(self.conf.workingDir)
+            self._nr_cached = 0
+        self._summary_by = options.color_summary_by
+        self._aggregates = None
+        if self._summary_by in ("module", "class"):
+            self._aggregates = Aggregates()
+        elif self._summary_by:
+            warnings.warn("Bad --color-summary-by: %r (use 'module' or "
+                          "'class')" % self._summary_by, RuntimeWarning)
+        self._time_tests = (self._durations is not None
+                            or self._aggregates is not None)
+        self._watchdog_timeout = options.color_watchdog
+        self._watchdog_abort = options.color_watchdog_abort
+        self._watchdog = None
+        # renders the coloured tracebacks listeners ask for
+        self._listener_formatter = None
+        # thread of the test faulthandler exits the process for, if any
+        self._escalated = None
         self._show_all = self._verbosity > 1
         self._dots = self._verbosity == 1
 
@@ -690,7 +3913,88 @@ class ColorOutputPlugin(nose.plugins.Plugin):
         # monkeypatch!
         doctest.DocTestCase.failureException = DocTestFailureException
 
+    def prepareTest(self, test):
+        keeps = []
+        # (test id, source hash) of every test, if anything needs them all
+        # before the run; they come from loading the tests again, so that
+        # the suite that runs still only loads its tests as they run
+        everything = None
+        if self._eta > 0 or (self._shard is not None and self._history):
+            everything = [(case.id(), self._cache is not None
+                           and self._source_hash(case) or None)
+                          for case in iter_tests(self._load_again())]
+        in_shard = None
+        if self._shard is not None:
+            in_shard = self._shard_filter(
+                everything and [test_id for test_id, h in everything])
+            keeps.append(lambda case: in_shard(case.id()))
+        if self._cache is not None:
+            keeps.append(self._keep_uncached)
+        if keeps:
+            filter_suite(test, lambda case: all(keep(case)
+                                                for keep in keeps))
+        if self._eta > 0:
+            self._predictions = [
+                self._history.get(test_id)
+                for test_id, source_hash in everything
+                if (in_shard is None or in_shard(test_id))
+                and not self._is_cached(test_id, source_hash)]
+
+    def _load_again(self):
+        loader = nose.loader.TestLoader(config=self.conf)
+        return loader.loadTestsFromNames(self.conf.testNames
+                                         or [self.conf.workingDir])
+
+    def _shard_filter(self, test_ids):
+        """Return a function telling whether a test id is in this shard.
+
+        Balancing shards by duration takes ``test_ids``, all of them;
+        without those, tests are placed by the hash of their id.
+        """
+        index, count = self._shard
+        if test_ids is None:
+            return lambda test_id: stable_hash(test_id) % count == index - 1
+        shards, predicted = partition_tests(test_ids, count, self._history)
+        if predicted is not None:
+            self._shard_predicted = predicted[index - 1]
+        wanted = shards[index - 1]
+        return wanted.__contains__
+
+    def _source_hash(self, case):
+        try:
+            module = case.address()[1]
+        except (AttributeError, TypeError, ValueError):
+            return None
+        return module and self._hasher.module_hash(module)
+
+    def _is_cached(self, test_id, source_hash):
+        return bool(source_hash and not self._cache_refresh
+                    and self._cache.get(test_id) == source_hash)
+
+    def _keep_uncached(self, case):
+        test_id = case.id()
+        source_hash = self._source_hash(case)
+        if not self._is_cached(test_id, source_hash):
+            self._cache_hashes[test_id] = source_hash
+            return True
+        # it is never run, so report it here, as the run gets to it
+        self._nr_cached += 1
+        self._formatter.start_test(case)
+        self._formatter.test_cached(case)
+        self._formatter.stop_test(case)
+        if self._listeners:
+            event = self._start_event(case)
+            event.outcome, event.label = "cached", "CACHED"
+            self._finish_event(event)
+        return False
+
     def setOutputStream(self, stream):
+        # things to close when the run is over
+        self._to_close = []
+        if isinstance(self._renderer, HtmlRenderer):
+            stream = writeln_decorator(HtmlReportStream(stream,
+                                                        self._colorscheme))
+            self._to_close.append(stream.stream)
         self._stream = stream
         self._formatter = self.formatter_class(
             self._verbosity,
@@ -698,19 +4002,102 @@ class ColorOutputPlugin(nose.plugins.Plugin):
             self._colorscheme,
             self._stream,
             clean_tracebacks=self.clean_tracebacks,
-            base_dir=self.base_dir)
+            base_dir=self.base_dir,
+            renderer=self._renderer,
+            frame_filter=self._frame_filter,
+            capture_locals=self._capture_locals,
+            assertion_diff=self._assertion_diff,
+            max_report_size=self._max_report_size,
+            spill_path=self._spill_path)
+        others = []
+        if self._html_path:
+            html = HtmlReportStream(io.open(self._html_path, "w",
+                                            encoding="utf-8"),
+                                    self._colorscheme)
+            self._to_close.extend([html, html._stream])
+            others.append(self.formatter_class(
+                max(self._verbosity, 2),
+                True,
+                self._colorscheme,
+                html,
+                clean_tracebacks=self.clean_tracebacks,
+                base_dir=self.base_dir,
+                renderer=HtmlRenderer(),
+                frame_filter=self._frame_filter,
+                capture_locals=self._capture_locals,
+                assertion_diff=self._assertion_diff))
+        if self._record_path:
+            event_log = EventLogWriter(open(self._record_path, "wb"),
+                                       self._formatter.get_description)
+            self._to_close.append(event_log)
+            others.append(event_log)
+        if others:
+            self._formatter = FormatterTee(self._formatter, *others)
+        if self._watchdog_timeout > 0:
+            self._watchdog = Watchdog(self._watchdog_timeout, self._test_hung)
+            if self._watchdog_abort:
+                self._watchdog.catch_signal()
+
+    def _test_hung(self, description, elapsed, ident, token):
+        self._formatter.test_hung(
+            description, elapsed,
+            format_thread_stacks(skip=(self._watchdog.ident,)))
+        if not self._watchdog_abort:
+            return
+
+        def escalate():
+            # a test stuck outside Python code, other than in a sleep or
+            # blocking call of the main thread, never sees the exception;
+            # faulthandler's timer works even if this thread can't run.
+            # stopTest() cancels it, once it can take the watchdog's lock.
+            if faulthandler is None or self._escalated is not None:
+                return
+            # what was written so far is all an exit leaves
+            self._flush_outputs()
+            try:
+                faulthandler.dump_traceback_later(
+                    self._watchdog.timeout, exit=True, file=sys.__stderr__)
+            except (AttributeError, ValueError, RuntimeError):
+                return
+            self._escalated = ident
+        # the test may have finished while its stacks were written
+        self._watchdog.interrupt(ident, token, WatchdogTimeout, escalate)
+
+    def _flush_outputs(self):
+        self._stream.flush()
+        for to_close in self._to_close:
+            flush = getattr(to_close, "flush", None)
+            if flush is not None:
+                flush()
 
     def prepareTestResult(self, result):
-        result.__failures = []
-        result.__errors = []
-        result.__tests_run = 0
+        result.__failures = PerThreadList()
+        result.__errors = PerThreadList()
+        # The result keeps failures and errors of its own, which it only
+        # counts; don't let those keep the tests alive either.
+        result.failures = FailureList(result.failures,
+                                      self._formatter.get_description)
+        result.errors = FailureList(result.errors,
+                                    self._formatter.get_description)
+        result.__tests_run = PerThreadCounter()
         result.__start_time = time.time()
-        # Python <= 2.6 has _WritelnDecorator at top level
-        try:
-            writeln_decorator = unittest._WritelnDecorator
-        # Python >= 2.7 has it in the runner module
-        except AttributeError:
-            writeln_decorator = unittest.runner._WritelnDecorator
+        if self._rerun > 0:
+            self._flaky = []
+            result.errorClasses[FlakyTest] = (self._flaky, "FLAKY", False)
+            # test id -> name to load the test again from
+            self._rerun_names = {}
+        # and the lists of error classes; the result fills those itself,
+        # and may also know them by another name (result.skipped, ...)
+        for cls, (storage, label, isfail) in list(
+                result.errorClasses.items()):
+            records = FailureList(storage, self._formatter.get_description,
+                                  cls)
+            result.errorClasses[cls] = (records, label, isfail)
+            for name, value in list(vars(result).items()):
+                if value is storage:
+                    setattr(result, name, records)
+            if cls is FlakyTest:
+                self._flaky = records
         # This neuters any default or plugin defined output streams,
         # effectively forcing all output through Rudolf.
         result.stream = writeln_decorator(open(os.devnull, 'w'))
@@ -722,21 +4109,44 @@ class ColorOutputPlugin(nose.plugins.Plugin):
         def new_addSkip(test, reason):
             old_addSkip(test, reason)
             label = result.errorClasses[nose.plugins.skip.SkipTest][1]
+            self._set_outcome("skip", label, test, reason)
             self._formatter.test_skip(label)
         result.addSkip = new_addSkip
 
         self._result = result
+        if self._eta > 0:
+            self._formatter.set_progress(Progress(self._predictions,
+                                                  self._eta))
+            self._predictions = None
 
     def startTest(self, test):
-        self._result.__tests_run = self._result.__tests_run + 1
+        self._result.__tests_run.add()
         self._formatter.start_test(test)
+        if self._time_tests:
+            self._local.test_start_time = time.time()
+        self._local.outcome = None
+        if self._listeners:
+            self._local.event = self._start_event(test)
+        else:
+            self._local.event = None
+        if self._memory is not None:
+            self._memory.start()
+        if self._watchdog is not None:
+            self._watchdog.arm(self._formatter.get_description(test))
 
     def addSuccess(self, test):
+        if self._cache is not None:
+            self._cache_passed.add(test.id())
+        self._set_outcome("success", "ok")
         self._formatter.test_success(test)
 
     def addFailure(self, test, err):
         formatted_failure = self._exc_info_to_string(err, test)
-        self._result.__failures.append((test, formatted_failure, err[0]))
+        record = self._record(test, formatted_failure, err[0])
+        self._result.__failures.append(record)
+        if self._rerun > 0:
+            self._rerun_names[test.id()] = loadable_name(test)
+        self._set_outcome("failure", "FAIL", record=record)
         self._formatter.test_failure(test, err)
 
     def addError(self, test, err):
@@ -745,33 +4155,166 @@ class ColorOutputPlugin(nose.plugins.Plugin):
         formatted_err = self._formatter.format_traceback(err)
         for cls, (storage, label, isfail) in self._result.errorClasses.items():
             if issubclass(err[0], cls):
-                storage.append((test, formatted_err, err[0]))
+                # the result adds it to ``storage``
+                record = self._record(test, formatted_err, err[0])
+                self._set_outcome(isfail and "error" or "skip", label,
+                                  record=record)
                 self._formatter.test_error(test, err, label)
                 return
-        self._result.__errors.append((test, formatted_err, err[0]))
+        record = self._record(test, formatted_err, err[0])
+        self._result.__errors.append(record)
+        if self._rerun > 0:
+            self._rerun_names[test.id()] = loadable_name(test)
+        self._set_outcome("error", "ERROR", record=record)
         self._formatter.test_error(test, err, "ERROR")
 
+    def _record(self, test, formatted_err, exc_type):
+        return FailureRecord.from_test(test, formatted_err, exc_type,
+                                       self._formatter.get_description)
+
+    def _set_outcome(self, outcome, label, test=None, reason=None,
+                     record=None):
+        """Note how the current test ended, for aggregates and listeners.
+
+        Skips pass ``test`` and ``reason``, which only become a record if a
+        listener will see it.
+        """
+        self._local.outcome = outcome
+        event = getattr(self._local, "event", None)
+        if event is not None:
+            if record is None and reason is not None:
+                record = self._record(test, str(reason), None)
+            event.outcome = outcome
+            event.label = label
+            event.record = record
+
+    def _start_event(self, test):
+        if self._listener_formatter is None:
+            # listeners get the same ANSI colours whatever the report is
+            # rendered with
+            self._listener_formatter = self.formatter_class(
+                2,
+                True,
+                self._colorscheme,
+                writeln_decorator(io.StringIO()),
+                clean_tracebacks=self.clean_tracebacks,
+                base_dir=self.base_dir,
+                renderer=AnsiRenderer(self._colorscheme),
+                assertion_diff=self._assertion_diff)
+        event = ResultEvent(test.id(), self._formatter.get_description(test),
+                            self._listener_formatter.render_traceback)
+        for listener in self._listeners:
+            listener.test_started(event)
+        return event
+
+    def _finish_event(self, event):
+        event.finish()
+        for listener in self._listeners:
+            listener.test_finished(event)
+
     def stopTest(self, test):
+        if self._watchdog is not None:
+            self._watchdog.disarm()
+            if self._escalated == threading.current_thread().ident:
+                faulthandler.cancel_dump_traceback_later()
+                self._escalated = None
+        if self._memory is not None:
+            self._memory.stop(self._formatter.get_description, test)
         self._formatter.stop_test(test)
+        event = getattr(self._local, "event", None)
+        if event is not None:
+            self._local.event = None
+            self._finish_event(event)
+        if self._time_tests:
+            duration = time.time() - self._local.test_start_time
+            if self._durations is not None:
+                self._durations[test.id()] = duration
+            if self._aggregates is not None:
+                module, cls = group_names(test)
+                key = self._summary_by == "module" and module or cls
+                self._aggregates.add(key, self._local.outcome, duration)
 
     def report(self, stream):
+        if self._rerun > 0:
+            self._rerun_failures()
         self._print_errors()
+        if self._aggregates is not None:
+            self._formatter.print_aggregates(self._summary_by,
+                                             self._aggregates.rows())
+        if self._memory is not None:
+            self._formatter.print_memory_report(self._memory.largest())
         self._print_summary(self._result.__start_time,
                             time.time())
         self._result = None
 
     def finalize(self, result):
         self._formatter.stop_tests()
+        for to_close in self._to_close:
+            to_close.close()
+        if self._durations:
+            self._history.update(self._durations)
+            save_durations(self._durations_path, self._history)
+        if self._cache is not None:
+            self._save_cache()
+        if self._memory is not None:
+            self._memory.close()
+        if self._watchdog is not None:
+            self._watchdog.close()
         # remove monkeypatch
         doctest.DocTestCase.failureException = self._old_failure_exception
 
+    def _rerun_failures(self):
+        """Run failed tests again, and move those that pass to FLAKY."""
+        loader = nose.loader.TestLoader(config=self.conf)
+        # run the tests without result proxies, so that plugins (this one
+        # included) don't see them
+        loader.suiteClass = nose.suite.ContextSuiteFactory(config=self.conf,
+                                                           resultProxy=None)
+        passed = set()
+        for test_id, name in self._rerun_names.items():
+            if name is None:
+                continue
+            for attempt in range(self._rerun):
+                if passes_when_rerun(loader, name):
+                    passed.add(test_id)
+                    break
+        if not passed:
+            return
+        result = self._result
+        result.__failures = self._move_flaky(result.__failures, passed)
+        result.__errors = self._move_flaky(result.__errors, passed)
+        # the result's own lists decide whether the run was successful
+        for entries in (result.failures, result.errors):
+            entries[:] = [entry for entry in entries
+                          if entry[0].id() not in passed]
+
+    def _save_cache(self):
+        for test_id, source_hash in self._cache_hashes.items():
+            if source_hash and test_id in self._cache_passed:
+                self._cache[test_id] = source_hash
+            else:
+                self._cache.pop(test_id, None)
+        save_result_cache(self._cache_path, self._cache)
+
+    def _move_flaky(self, records, passed):
+        """Move the records of the tests in ``passed`` to FLAKY; return the
+        others."""
+        kept = []
+        for record in records:
+            if record.test_id in passed:
+                self._flaky.append(record)
+            else:
+                kept.append(record)
+        return kept
+
     def _print_errors(self):
-        if self._dots or self._show_all:
-            self._stream.writeln()
+        self._formatter.start_report()
         self._formatter.print_error_list("ERROR", self._result.__errors)
         self._formatter.print_error_list("FAIL", self._result.__failures)
-        for cls in self._result.errorClasses.keys():
-            storage, label, isfail = self._result.errorClasses[cls]
+        # in the same order in every run, which merge_event_logs() relies on
+        error_classes = sorted(self._result.errorClasses.values(),
+                               key=lambda error_class: error_class[1])
+        for storage, label, isfail in error_classes:
             self._formatter.print_error_list(label, storage)
 
     def _print_summary(self, start, stop):
@@ -785,23 +4328,38 @@ class ColorOutputPlugin(nose.plugins.Plugin):
                 if not isfail:
                     continue
                 summary[label] = len(storage)
-        self._formatter.print_summary(success, summary,
-                                      self._result.__tests_run, start, stop)
+        if self._rerun > 0:
+            summary["flaky"] = len(self._flaky)
+        if self._cache is not None:
+            summary["cached"] = self._nr_cached
+        shard = None
+        if self._shard is not None:
+            shard = ("%d/%d" % self._shard, self._shard_predicted)
+        tests_run = self._result.__tests_run.value()
+        self._formatter.print_summary(success, summary, tests_run,
+                                      start, stop,
+                                      shard=shard)
+        if self._listeners:
+            run = RunSummary(success, summary, tests_run, start, stop)
+            for listener in self._listeners:
+                listener.run_finished(run)
 
     def _exc_info_to_string(self, err, test):
         exctype, value, tb = err
         # Skip test runner traceback levels
         while tb and self._is_relevant_tb_level(tb):
             tb = tb.tb_next
+        length = None
         if exctype is test.failureException:
             # Skip assert*() traceback levels
             length = self._count_relevant_tb_levels(tb)
-            return ''.join(traceback.format_exception(exctype, value, tb,
-                                                      length))
-        return ''.join(traceback.format_exception(exctype, value, tb))
+        return ''.join(format_exception(exctype, value, tb, length,
+                                        self._frame_filter,
+                                        self._capture_locals,
+                                        self._assertion_diff))
 
     def _is_relevant_tb_level(self, tb):
-        return '__unittest' in tb.tb_frame.f_globals
+        return self._frame_filter.in_unittest(tb.tb_frame)
 
     def _count_relevant_tb_levels(self, tb):
         length = 0
@@ -812,3 +4370,119 @@ class ColorOutputPlugin(nose.plugins.Plugin):
         # usually happens after plugin output.  If this were >= default
         # score, then e.g. core plugin testid output would come out in
         return length
+
+
+def _add_output_options(parser):
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      default=1, help="Be more verbose")
+    parser.add_option("--verbosity", action="store", type="int",
+                      dest="verbosity", help="Set verbosity")
+    parser.add_option("-q", "--quiet", action="store_const", const=0,
+                      dest="verbosity", help="Be less verbose")
+    parser.add_option("--colors", action="store", type="string",
+                      dest="colors", default=os.environ.get("NOSE_COLORS", ""),
+                      help="Colour scheme, in the same format as nosetests "
+                           "--colors [NOSE_COLORS]")
+    parser.add_option("--theme", action="store", type="string",
+                      dest="theme", default=os.environ.get("NOSE_COLOR_THEME",
+                                                           ""),
+                      help="Colour theme, as for nosetests --color-theme "
+                           "[NOSE_COLOR_THEME]")
+    parser.add_option("--renderer", action="store", type="string",
+                      dest="renderer", default="ansi256",
+                      help="How to render colours: ansi256, ansi16, plain "
+                           "or html (default ansi256)")
+    parser.add_option("--no-color", action="store_const", const="plain",
+                      dest="renderer", help="Output plain text")
+
+
+def _make_output_formatter(parser, options, title):
+    """Return ``(formatter, finish)`` for the output options of a command.
+
+    ``finish`` must be called once the output is complete.
+    """
+    colorscheme = dict(ColorOutputPlugin.default_colorscheme)
+    if options.theme:
+        try:
+            colorscheme.update(load_theme(options.theme, [options.renderer],
+                                          os.getcwd()))
+        except ValueError as exc:
+            parser.error("bad theme: %s" % exc)
+    try:
+        colorscheme.update(parse_colorscheme(options.colors))
+    except ValueError as exc:
+        parser.error("bad colour scheme: %s" % exc)
+    try:
+        renderer = make_renderer(options.renderer, colorscheme)
+    except ValueError as exc:
+        parser.error(str(exc))
+    stream = sys.stdout
+    finish = stream.flush
+    if isinstance(renderer, HtmlRenderer):
+        stream = HtmlReportStream(stream, colorscheme, title=title)
+        finish = stream.close
+    formatter = ColorfulOutputFormatter(options.verbosity, True, colorscheme,
+                                        writeln_decorator(stream),
+                                        renderer=renderer)
+    return formatter, finish
+
+
+def _replay_command(argv):
+    parser = optparse.OptionParser(
+        usage="%prog replay [options] LOG",
+        description="Render an event log written by --color-record.")
+    _add_output_options(parser)
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("expected exactly one event log")
+    formatter, finish = _make_output_formatter(parser, options, args[0])
+    with open(args[0], "rb") as fileobj:
+        try:
+            replay_event_log(fileobj, formatter)
+        except BadEventLog as exc:
+            sys.stderr.write("rudolf: %s: %s\n" % (args[0], exc))
+            return 1
+    finish()
+    return 0
+
+
+def _merge_command(argv):
+    parser = optparse.OptionParser(
+        usage="%prog merge [options] LOG...",
+        description="Render one report of the failures and counts in event "
+                    "logs written by --color-record, e.g. by the shards of "
+                    "a --color-shard run.")
+    _add_output_options(parser)
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error("expected at least one event log")
+    formatter, finish = _make_output_formatter(parser, options,
+                                               ", ".join(args))
+    fileobjs = [open(path, "rb") for path in args]
+    try:
+        merge_event_logs(fileobjs, formatter, names=args)
+    except BadEventLog as exc:
+        sys.stderr.write("rudolf: %s\n" % exc)
+        return 1
+    finally:
+        for fileobj in fileobjs:
+            fileobj.close()
+    finish()
+    return 0
+
+
+_commands = {"replay": _replay_command, "merge": _merge_command}
+
+
+def main(argv=None):
+    """Entry point of the ``rudolf`` command."""
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or argv[0] not in _commands:
+        sys.stderr.write("usage: rudolf {%s} ...\n" % ",".join(sorted(_commands)))
+        return 2
+    return _commands[argv[0]](argv[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
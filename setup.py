@@ -35,7 +35,8 @@ through inclement weather.
 
     py_modules=["rudolf"],
     entry_points={
-        "nose.plugins.0.10": ["color=rudolf:ColorOutputPlugin"]
+        "nose.plugins.0.10": ["color=rudolf:ColorOutputPlugin"],
+        "console_scripts": ["rudolf=rudolf:main"],
     },
     zip_safe=True,
     classifiers=[
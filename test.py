@@ -1,12 +1,27 @@
 from __future__ import absolute_import, print_function
 
+import collections
+import gc
+import io
+import optparse
 import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
 import unittest
+import warnings
+import weakref
 from nose.tools import raises
 from nose.config import Config
+from nose.plugins.deprecated import Deprecated, DeprecatedTest
 from nose.plugins.doctests import Doctest
 from nose.plugins.manager import PluginManager
 from nose.plugins.skip import Skip, SkipTest
+import rudolf
 from rudolf import *  # noqa
 
 BASE_PATH = os.path.normpath(os.path.join(os.path.dirname(__file__)))
@@ -158,6 +173,1330 @@ class TestParseColorScheme(DictComparision):
         parse_colorscheme("fail=")
 
 
+class FakeTest(object):
+    def __init__(self, name):
+        self.name = name
+
+    def id(self):
+        return self.name
+
+    def shortDescription(self):
+        return None
+
+    def __str__(self):
+        return self.name
+
+
+def make_formatter(verbosity=2, renderer=None, stream=None, **kwargs):
+    colorscheme = ColorOutputPlugin.default_colorscheme
+    if stream is None:
+        stream = io.StringIO()
+    formatter = ColorfulOutputFormatter(verbosity, True, colorscheme,
+                                        writeln_decorator(stream),
+                                        renderer=renderer, **kwargs)
+    return formatter, stream
+
+
+def drive_formatter(formatter):
+    test = FakeTest("test.spam")
+    formatter.start_test(test)
+    formatter.test_failure(test, None)
+    formatter.stop_test(test)
+    formatter.start_report()
+    formatter.print_error_list("FAIL", [
+        (test, u"Traceback (most recent call last):\n"
+               u"  File \"spam.py\", line 1, in spam\n"
+               u"    assert False\n"
+               u"AssertionError: \u2603\n", AssertionError)])
+    summary = nose.util.odict()
+    summary["failures"] = 1
+    formatter.print_summary(False, summary, 1, 0.0, 1.5)
+    formatter.stop_tests()
+
+
+class TestEventLog(unittest.TestCase):
+    def test_replay_matches_live_output(self):
+        formatter, live = make_formatter()
+        log = io.BytesIO()
+        writer = EventLogWriter(log, formatter.get_description)
+        drive_formatter(FormatterTee(formatter, writer))
+
+        replayed, output = make_formatter()
+        replay_event_log(io.BytesIO(log.getvalue()), replayed)
+        self.assertEqual(output.getvalue(), live.getvalue())
+
+    def test_replay_plain(self):
+        formatter, live = make_formatter()
+        log = io.BytesIO()
+        drive_formatter(EventLogWriter(log, formatter.get_description))
+
+        replayed, output = make_formatter(verbosity=1,
+                                          renderer=PlainRenderer())
+        replay_event_log(io.BytesIO(log.getvalue()), replayed)
+        self.assertTrue(output.getvalue().startswith("F\n"))
+        self.assertTrue("\033" not in output.getvalue())
+
+    def test_replay_threads(self):
+        log = io.BytesIO()
+        writer = EventLogWriter(log, str)
+        a, b = FakeTest("test.a"), FakeTest("test.b")
+        # (thread, call), in the order the calls happen
+        steps = [(0, lambda: writer.start_test(a)),
+                 (1, lambda: writer.start_test(b)),
+                 (1, lambda: writer.test_success(b)),
+                 (0, lambda: writer.test_failure(a, None)),
+                 (1, lambda: writer.stop_test(b)),
+                 (0, lambda: writer.stop_test(a))]
+        turn = [0]
+        cond = threading.Condition()
+
+        def run(thread_nr):
+            for nr, (owner, call) in enumerate(steps):
+                if owner != thread_nr:
+                    continue
+                with cond:
+                    while turn[0] != nr:
+                        cond.wait()
+                    call()
+                    turn[0] += 1
+                    cond.notify_all()
+        threads = [threading.Thread(target=run, args=(nr,))
+                   for nr in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        formatter, output = make_formatter(renderer=PlainRenderer())
+        replay_event_log(io.BytesIO(log.getvalue()), formatter)
+        self.assertEqual(output.getvalue(),
+                         "test.a ... FAIL\ntest.b ... ok\n")
+
+    def test_replay_unnumbered(self):
+        # logs from before tests were numbered
+        log = io.BytesIO()
+        writer = EventLogWriter(log, str)
+        writer._record(EVENT_START, "test.old")
+        writer._record(EVENT_SKIP, "SKIP")
+        writer._record(EVENT_STOP)
+        formatter, output = make_formatter(renderer=PlainRenderer())
+        replay_event_log(io.BytesIO(log.getvalue()), formatter)
+        self.assertEqual(output.getvalue(), "test.old ... SKIP\n")
+
+    @raises(BadEventLog)
+    def test_ko_not_a_log(self):
+        list(read_event_log(io.BytesIO(b"spam")))
+
+    @raises(BadEventLog)
+    def test_ko_truncated(self):
+        log = io.BytesIO()
+        EventLogWriter(log, str).test_skip("SKIP")
+        list(read_event_log(io.BytesIO(log.getvalue()[:-1])))
+
+    def test_main_usage(self):
+        self.assertEqual(main(["spam"]), 2)
+
+
+class TestRenderers(unittest.TestCase):
+    def test_ansi256(self):
+        renderer = AnsiRenderer({"normal": parse_color("normal"),
+                                 "pass": parse_color("rgb(ff0000)")})
+        self.assertEqual(renderer.colorize("pass", "ok"),
+                         "\x1b[38;5;196mok\x1b[0m")
+
+    def test_ansi16(self):
+        renderer = Ansi16Renderer({"normal": parse_color("normal"),
+                                   "pass": parse_color("rgb(ff0000)"),
+                                   "fail": parse_color("2")})
+        self.assertEqual(renderer.colorize("pass", "ok"),
+                         "\x1b[1;31mok\x1b[0m")
+        self.assertEqual(renderer.color("fail"), "\x1b[0;32m")
+
+    def test_plain(self):
+        formatter, output = make_formatter(renderer=PlainRenderer())
+        drive_formatter(formatter)
+        self.assertTrue("\033" not in output.getvalue())
+        self.assertTrue("FAIL: test.spam" in output.getvalue())
+
+    def test_html(self):
+        output = io.StringIO()
+        stream = HtmlReportStream(output, ColorOutputPlugin.default_colorscheme)
+        formatter, _ = make_formatter(renderer=HtmlRenderer(), stream=stream)
+        drive_formatter(formatter)
+        stream.close()
+        html = output.getvalue()
+        self.assertTrue(html.startswith("<!DOCTYPE html>"))
+        self.assertTrue(html.endswith("</html>\n"))
+        self.assertTrue('<span class="c-failure">FAIL</span>' in html)
+        self.assertTrue("\0" not in html)
+
+    def test_html_escapes(self):
+        output = io.StringIO()
+        stream = HtmlReportStream(output, {})
+        stream.write(HtmlRenderer().colorize("exception", "<&>"))
+        stream.write(HtmlRenderer().colorize("exception", "!"))
+        self.assertTrue(output.getvalue().endswith(
+            '<pre><span class="c-normal"></span>'
+            '<span class="c-exception">&lt;&amp;&gt;!'))
+
+    def test_auto(self):
+        scheme = ColorOutputPlugin.default_colorscheme
+        self.assertTrue(isinstance(make_renderer("auto", scheme, False),
+                                   PlainRenderer))
+        self.assertTrue(isinstance(make_renderer("auto", scheme, True),
+                                   AnsiRenderer))
+
+    @raises(ValueError)
+    def test_ko_unknown(self):
+        make_renderer("spam", {})
+
+
+class TestSharding(unittest.TestCase):
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard("2/3"), (2, 3))
+
+    @raises(ValueError)
+    def test_ko_shard_zero(self):
+        parse_shard("0/3")
+
+    @raises(ValueError)
+    def test_ko_shard_format(self):
+        parse_shard("2-3")
+
+    def test_partition_by_hash(self):
+        ids = ["test.t%d" % i for i in range(100)]
+        shards, predicted = partition_tests(ids, 3, {})
+        self.assertEqual(predicted, None)
+        self.assertEqual(sorted(set.union(*shards)), sorted(ids))
+        self.assertEqual(sum(len(shard) for shard in shards), 100)
+        self.assertEqual(partition_tests(list(reversed(ids)), 3, {})[0],
+                         shards)
+
+    def test_partition_by_duration(self):
+        durations = {"a": 4.0, "b": 3.0, "c": 2.0, "d": 2.0, "e": 1.0}
+        shards, predicted = partition_tests(sorted(durations) + ["f"], 2,
+                                            durations)
+        self.assertEqual(shards, [set(["a", "c", "e"]),
+                                  set(["b", "d", "f"])])
+        self.assertEqual(predicted, [7.0, 7.4])
+
+    def test_filter_suite(self):
+        class Case(unittest.TestCase):
+            def test_a(self):
+                pass
+
+            def test_b(self):
+                pass
+
+        loaded = []
+
+        def load(*names):
+            for name in names:
+                loaded.append(name)
+                yield Case(name)
+        suite = nose.suite.LazySuite(lambda: iter([
+            nose.suite.LazySuite(lambda: load("test_a", "test_b")),
+            nose.suite.LazySuite(lambda: load("test_a")),
+            unittest.TestSuite([Case("test_b"), Case("test_a")])]))
+        filter_suite(suite, lambda test: test.id().endswith("test_b"))
+        self.assertEqual(loaded, [])
+        first = next(iter(suite))
+        # only as far as the first test kept
+        self.assertEqual(loaded, ["test_a", "test_b"])
+        self.assertEqual([test.id() for test in iter_tests(first)],
+                         [Case("test_b").id()])
+        # the suite with nothing left is left out
+        rest = list(iter(suite))
+        self.assertEqual(len(rest), 1)
+        self.assertEqual(rest[0].countTestCases(), 1)
+
+    def test_summary(self):
+        formatter, output = make_formatter(renderer=PlainRenderer())
+        formatter.print_summary(True, {}, 3, 0.0, 1.5, shard=("2/4", 1.25))
+        self.assertTrue(output.getvalue().endswith(
+            "Shard 2/4: predicted 1.250 seconds, took 1.500 seconds\n"))
+
+    def test_summary_replay(self):
+        log = io.BytesIO()
+        writer = EventLogWriter(log, str)
+        writer.print_summary(True, {}, 3, 0.0, 1.5, shard=("2/4", None))
+        formatter, output = make_formatter(renderer=PlainRenderer())
+        replay_event_log(io.BytesIO(log.getvalue()), formatter)
+        self.assertTrue(output.getvalue().endswith(
+            "Shard 2/4: no timing history, took 1.500 seconds\n"))
+
+    def test_save_durations_again(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, "durations.json")
+        save_durations(path, {"a": 1.0})
+        save_durations(path, {"a": 2.0})
+        self.assertEqual(load_durations(path), {"a": 2.0})
+
+        # no os.replace, and a rename that won't overwrite, as on Windows
+        # with Python 2
+        def rename(src, dst):
+            if os.path.exists(dst):
+                raise OSError("exists")
+            real_rename(src, dst)
+        real_rename, real_replace = os.rename, getattr(os, "replace", None)
+        os.rename = rename
+        if real_replace is not None:
+            del os.replace
+        try:
+            save_durations(path, {"a": 3.0})
+        finally:
+            os.rename = real_rename
+            if real_replace is not None:
+                os.replace = real_replace
+        self.assertEqual(load_durations(path), {"a": 3.0})
+        self.assertEqual(os.listdir(tmp_dir), ["durations.json"])
+
+
+def write_log(problems, tests_run, start, stop):
+    log = io.BytesIO()
+    writer = EventLogWriter(log, str)
+    for flavour, name in problems:
+        writer.print_error_list(flavour, [(FakeTest(name), "%s\n" % name,
+                                           AssertionError)])
+    flavours = [flavour for flavour, name in problems]
+    summary = nose.util.odict()
+    summary["failures"] = flavours.count("FAIL")
+    summary["errors"] = flavours.count("ERROR")
+    writer.print_summary(not problems, summary, tests_run, start, stop)
+    return io.BytesIO(log.getvalue())
+
+
+class TestMerge(unittest.TestCase):
+    def test_merge(self):
+        logs = [write_log([("ERROR", "a.e"), ("FAIL", "a.f")], 3, 10.0, 12.0),
+                write_log([], 2, 9.0, 11.0),
+                write_log([("ERROR", "c.e"), ("FAIL", "c.f1"),
+                           ("FAIL", "c.f2")], 4, 11.0, 14.0)]
+        formatter, output = make_formatter(renderer=PlainRenderer())
+        merge_event_logs(logs, formatter)
+        lines = output.getvalue().splitlines()
+        self.assertEqual([line for line in lines if ": " in line],
+                         ["ERROR: a.e", "ERROR: c.e", "FAIL: a.f",
+                          "FAIL: c.f1", "FAIL: c.f2"])
+        self.assertEqual(lines[-2:], ["Ran 9 tests in 5.000 seconds",
+                                      "FAILED (failures=3, errors=2)"])
+
+    def test_merge_error_classes(self):
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        paths = [os.path.join(log_dir, "%d.log" % nr) for nr in range(2)]
+        for path in paths:
+            nose.core.run(
+                argv=["nosetests", "--with-color", "--color-renderer=plain",
+                      "--color-record=" + path, "test:LabelResults"],
+                config=Config(stream=io.StringIO(), plugins=PluginManager(
+                    plugins=[ColorOutputPlugin(), Skip(), Deprecated()])))
+        formatter, output = make_formatter(renderer=PlainRenderer())
+        logs = [open(path, "rb") for path in paths]
+        try:
+            merge_event_logs(logs, formatter)
+        finally:
+            for log in logs:
+                log.close()
+        lines = output.getvalue().splitlines()
+        self.assertEqual([line for line in lines
+                          if re.match("[A-Z]+: test[.]", line)],
+                         ["DEPRECATED: test.LabelResults.test_deprecated"] * 2
+                         + ["SKIP: test.LabelResults.test_skip"] * 2)
+
+    def test_merge_incomplete(self):
+        log = io.BytesIO()
+        EventLogWriter(log, str).test_skip("SKIP")
+        formatter, output = make_formatter(renderer=PlainRenderer())
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            merge_event_logs([write_log([], 2, 0.0, 1.0),
+                              io.BytesIO(log.getvalue())], formatter)
+        # other tests may leave garbage that warns when collected
+        self.assertEqual(len([warning for warning in caught if issubclass(
+            warning.category, RuntimeWarning)]), 1)
+        self.assertTrue(output.getvalue().endswith("FAILED ()\n"))
+
+
+def hidden_helper():
+    __tracebackhide__ = True  # noqa
+    raise ValueError("spam")
+
+
+def visible_caller():
+    hidden_helper()
+
+
+def exc_info_of(function):
+    try:
+        function()
+    except Exception:
+        return sys.exc_info()
+
+
+class TestFrameFilter(unittest.TestCase):
+    def format(self, exc_info, frame_filter):
+        return "".join(format_exception(*exc_info, frame_filter=frame_filter))
+
+    def test_marker(self):
+        text = self.format(exc_info_of(visible_caller), FrameFilter())
+        self.assertTrue("in visible_caller" in text)
+        self.assertTrue("in hidden_helper" not in text)
+        self.assertTrue(text.endswith("ValueError: spam\n"))
+
+    def test_module_prefix(self):
+        frame_filter = parse_frame_filters("module:test")
+        text = self.format(exc_info_of(visible_caller), frame_filter)
+        # with no frames left, there's no traceback header either
+        self.assertEqual(text.splitlines()[-1], "ValueError: spam")
+        self.assertFalse("  File" in text)
+        self.assertFalse(parse_frame_filters("module:tes").is_hidden(
+            sys._getframe()))
+
+    def test_path_glob(self):
+        frame_filter = parse_frame_filters("path:*/test.py,marker:spam")
+        self.assertTrue(frame_filter.is_hidden(sys._getframe()))
+        self.assertTrue(sys._getframe().f_code in frame_filter._hidden)
+
+    def test_chained(self):
+        def chained():
+            try:
+                visible_caller()
+            except ValueError:
+                raise KeyError("eggs")
+
+        text = self.format(exc_info_of(chained), FrameFilter())
+        if sys.version_info[0] >= 3:
+            self.assertTrue("ValueError: spam" in text)
+            self.assertTrue("During handling" in text)
+        self.assertTrue(text.endswith("KeyError: 'eggs'\n"))
+
+    def test_exception_group(self):
+        try:
+            group_class = ExceptionGroup  # noqa
+        except NameError:
+            return  # Python < 3.11
+
+        def grouped():
+            errors = []
+            for function in [visible_caller, lambda: {}["eggs"]]:
+                try:
+                    function()
+                except Exception as exc:
+                    errors.append(exc)
+            raise group_class("many", errors)
+
+        text = self.format(exc_info_of(grouped), FrameFilter())
+        self.assertTrue("ExceptionGroup: many (2 sub-exceptions)" in text)
+        self.assertTrue("| ValueError: spam" in text)
+        self.assertTrue("| KeyError: 'eggs'" in text)
+        self.assertTrue("in visible_caller" in text)
+        self.assertFalse("in hidden_helper" in text)
+
+    def test_hidden_frames_not_looked_up(self):
+        frame_filter = FrameFilter()
+        exc_info = exc_info_of(visible_caller)
+        old_extract_tb = traceback.extract_tb
+        extracted = []
+
+        def extract_tb(tb, limit=None):
+            extracted.append(tb.tb_frame.f_code.co_name)
+            return old_extract_tb(tb, limit)
+        traceback.extract_tb = extract_tb
+        try:
+            kept = frame_filter.extract_frames(exc_info[2])
+        finally:
+            traceback.extract_tb = old_extract_tb
+        self.assertEqual([entry[2] for entry, frame in kept],
+                         ["exc_info_of", "visible_caller"])
+        self.assertEqual(extracted, ["exc_info_of", "visible_caller"])
+
+    @raises(ValueError)
+    def test_ko_kind(self):
+        parse_frame_filters("module:nose,spam:eggs")
+
+    @raises(ValueError)
+    def test_ko_empty(self):
+        parse_frame_filters("path:")
+
+
+class Big(object):
+    pass
+
+
+def fails_with_locals():
+    big = Big()
+    text = "x" * 10000
+    nested = [[[[1]]]]
+    raise ValueError("spam")
+
+
+class TestLocalsCapture(unittest.TestCase):
+    def test_bounded_reprs(self):
+        text = "".join(format_exception(*exc_info_of(fails_with_locals),
+                                        capture_locals=LocalsCapture()))
+        lines = text.splitlines()
+        self.assertTrue("        nested = [[[...]]]" in lines)
+        text_line = [line for line in lines if "text = " in line][0]
+        self.assertTrue(len(text_line) < 100)
+
+    def test_big_values(self):
+        class Huge(object):
+            def __len__(self):
+                return 10 ** 9
+
+            def __repr__(self):
+                raise AssertionError("repr() of a big value")
+
+        safe_repr = LocalsCapture()._safe_repr
+        self.assertEqual(safe_repr(Huge()), "<Huge len=1000000000>")
+        big_bytes = b"x" * (10 ** 7)
+        self.assertTrue(len(safe_repr(big_bytes)) < 100)
+        self.assertTrue(safe_repr(bytearray(big_bytes)).startswith(
+            "bytearray(b'xx"))
+        self.assertEqual(safe_repr(collections.OrderedDict(
+            (nr, nr) for nr in range(100))),
+            "OrderedDict({0: 0, 1: 1, 2: 2, 3: 3, ...})")
+        self.assertEqual(safe_repr(collections.defaultdict(list)),
+                         "defaultdict({})")
+
+    def test_budget(self):
+        text = "".join(format_exception(*exc_info_of(fails_with_locals),
+                                        capture_locals=LocalsCapture(-1)))
+        self.assertTrue("time budget exceeded" in text)
+        self.assertTrue("text = " not in text)
+
+    def test_releases_frames(self):
+        exc_info = exc_info_of(fails_with_locals)
+        big = weakref.ref(exc_info[2].tb_next.tb_frame.f_locals["big"])
+        format_exception(*exc_info, capture_locals=LocalsCapture())
+        del exc_info
+        gc.collect()
+        self.assertEqual(big(), None)
+
+    def test_no_frames_kept(self):
+        exctype, value, tb = exc_info_of(hidden_helper)
+        # leave out exc_info_of()'s frame; hidden_helper()'s is hidden
+        exc_info = exctype, value, tb.tb_next
+        for limit, frame_filter in [(0, None), (None, FrameFilter())]:
+            text = "".join(format_exception(*exc_info, limit=limit,
+                                            frame_filter=frame_filter,
+                                            capture_locals=LocalsCapture()))
+            self.assertEqual(text.splitlines()[-1], "ValueError: spam")
+            self.assertFalse("  File" in text)
+
+    def test_colorized(self):
+        formatter, output = make_formatter()
+        formatter.print_colorized_traceback(
+            '  File "spam.py", line 1, in spam\n'
+            '    eggs()\n'
+            '        eggs = <function eggs>\n')
+        self.assertTrue(output.getvalue().endswith(
+            "        \x1b[1;33meggs\x1b[0m = \x1b[0m<function eggs>\x1b[0m\n"))
+
+
+class TestThreadSafety(unittest.TestCase):
+    def setUp(self):
+        # switch threads as often as possible, to provoke interleaving
+        if hasattr(sys, "setswitchinterval"):
+            self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+            sys.setswitchinterval(1e-6)
+
+    def run_threads(self, target, nr_threads=8):
+        threads = [threading.Thread(target=target, args=(index,))
+                   for index in range(nr_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_verbose_lines_not_torn(self):
+        formatter, output = make_formatter(renderer=PlainRenderer())
+
+        def run_tests(index):
+            for nr in range(200):
+                test = FakeTest("test.t%d_%d" % (index, nr))
+                formatter.start_test(test)
+                formatter.test_success(test)
+                formatter.stop_test(test)
+
+        self.run_threads(run_tests)
+        finished = []
+        for line in output.getvalue().splitlines():
+            # a line cut short by another thread's test finishing first is
+            # written again in full
+            m = re.match(r"(test\.t\d+_\d+) \.\.\. (ok)?$", line)
+            self.assertTrue(m, line)
+            if m.group(2):
+                finished.append(m.group(1))
+        self.assertEqual(len(finished), 8 * 200)
+        self.assertEqual(len(set(finished)), 8 * 200)
+
+    def test_counters(self):
+        counter = PerThreadCounter()
+        items = PerThreadList()
+
+        def count(index):
+            for nr in range(1000):
+                counter.add()
+                items.append((index, nr))
+
+        self.run_threads(count)
+        self.assertEqual(counter.value(), 8000)
+        self.assertEqual(len(items), 8000)
+        self.assertEqual(len(set(items)), 8000)
+        mine = [nr for index, nr in items if index == 3]
+        self.assertEqual(mine, list(range(1000)))
+
+
+class TestFailureRecord(unittest.TestCase):
+    traceback = (u"Traceback (most recent call last):\n"
+                 u"  File \"spam.py\", line 1, in spam\n"
+                 u"    assert False\n"
+                 u"AssertionError\n")
+
+    def test_fields(self):
+        record = FailureRecord.from_test(FakeTest("test.spam"),
+                                         self.traceback, AssertionError, str)
+        self.assertEqual(record.id(), "test.spam")
+        self.assertEqual(str(record), "test.spam")
+        self.assertEqual(record.exc_type_name, "AssertionError")
+        self.assertEqual(record.exc_type, Exception)
+        self.assertFalse(hasattr(record, "__dict__"))
+        record = FailureRecord.from_test(FakeTest("test.spam"), "",
+                                         DocTestFailureException, str)
+        self.assertEqual(record.exc_type, DocTestFailureException)
+
+    def test_reported_like_tuple(self):
+        test = FakeTest("test.spam")
+        outputs = []
+        for entry in [(test, self.traceback, AssertionError),
+                      FailureRecord.from_test(test, self.traceback,
+                                              AssertionError, str)]:
+            formatter, output = make_formatter()
+            formatter.print_error_list("FAIL", [entry])
+            outputs.append(output.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_failure_list_releases_tests(self):
+        test = FakeTest("test.spam")
+        ref = weakref.ref(test)
+        failures = FailureList([], str)
+        failures.append((test, self.traceback))
+        del test
+        gc.collect()
+        self.assertTrue(ref() is None)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0][0].id(), "test.spam")
+        self.assertEqual(failures[0][1], self.traceback)
+
+    def test_error_classes_release_tests(self):
+        keeper = ResultKeeper()
+        nose.core.run(
+            argv=["nosetests", "--with-color", "--with-result-keeper",
+                  "test:LabelResults"],
+            config=Config(stream=io.StringIO(), plugins=PluginManager(
+                plugins=[ColorOutputPlugin(), Skip(), Deprecated(),
+                         keeper])))
+        entries = dict((label, list(storage)) for storage, label, isfail
+                       in keeper.error_classes)
+        self.assertEqual(sorted(entries), ["DEPRECATED", "SKIP"])
+        for label, name in [("DEPRECATED", "test_deprecated"),
+                            ("SKIP", "test_skip")]:
+            self.assertEqual(len(entries[label]), 1)
+            test, err = entries[label][0]
+            self.assertTrue(isinstance(test, FailureRecord))
+            self.assertEqual(test.id(), "test.LabelResults." + name)
+        # the result's own name for it sees the same list
+        self.assertTrue([storage for storage, label, isfail
+                         in keeper.error_classes
+                         if label == "SKIP"][0] is keeper.skipped)
+
+
+class TestMemory(unittest.TestCase):
+    growths = [(50 * 1024 * 1024, "test.leaks", [("leaks.py", 5, 52428800)]),
+               (4096, "test.small", [])]
+
+    def fake_rss(self, values):
+        values = iter(values)
+        original = rudolf.read_rss
+        rudolf.read_rss = lambda: next(values)
+        self.addCleanup(setattr, rudolf, "read_rss", original)
+
+    def test_read_rss(self):
+        rss = read_rss()
+        if rss is not None:
+            self.assertTrue(rss > 0)
+
+    def test_format_bytes(self):
+        self.assertEqual(format_bytes(512), "512 B")
+        self.assertEqual(format_bytes(3 * 1024 * 1024, sign=True), "+3.0 MB")
+        self.assertEqual(format_bytes(-2048, sign=True), "-2.0 kB")
+        self.assertEqual(format_bytes(5 * 1024 ** 4), "5120.0 GB")
+
+    def test_keeps_largest(self):
+        tracker = MemoryTracker(top=2)
+        growths = [10, 0, 30, -5, 20, 40]
+        rss = []
+        for growth in growths:
+            rss.extend([100, 100 + growth])
+        self.fake_rss(rss)
+        for nr, growth in enumerate(growths):
+            tracker.start()
+            tracker.stop(str, FakeTest("test.t%d" % nr))
+        self.assertEqual(tracker.largest(), [(40, "test.t5", []),
+                                             (30, "test.t2", [])])
+
+    def test_report(self):
+        formatter, output = make_formatter(renderer=PlainRenderer())
+        formatter.print_memory_report(self.growths)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[1], "Largest memory growth:")
+        self.assertEqual(lines[2].split(), ["+50.0", "MB", "test.leaks"])
+        self.assertEqual(lines[3].split(), ["leaks.py:5:", "+50.0", "MB"])
+        self.assertEqual(lines[4].split(), ["+4.0", "kB", "test.small"])
+
+    def test_replay(self):
+        formatter, live = make_formatter()
+        log = io.BytesIO()
+        writer = EventLogWriter(log, formatter.get_description)
+        FormatterTee(formatter, writer).print_memory_report(self.growths)
+
+        replayed, output = make_formatter()
+        replay_event_log(io.BytesIO(log.getvalue()), replayed)
+        self.assertEqual(output.getvalue(), live.getvalue())
+
+
+class TestWatchdog(unittest.TestCase):
+    def make_watchdog(self, timeout):
+        hung = []
+        watchdog = Watchdog(timeout, lambda *args: hung.append(args))
+        self.addCleanup(watchdog.close)
+        return watchdog, hung
+
+    def test_fires_once(self):
+        watchdog, hung = self.make_watchdog(0.01)
+        watchdog.arm("test.slow")
+        time.sleep(0.2)
+        watchdog.disarm()
+        self.assertEqual(len(hung), 1)
+        description, elapsed, ident, token = hung[0]
+        self.assertEqual(description, "test.slow")
+        self.assertTrue(elapsed >= 0.01)
+        self.assertEqual(ident, threading.current_thread().ident)
+
+    def test_disarmed(self):
+        watchdog, hung = self.make_watchdog(0.1)
+        for nr in range(100):
+            watchdog.arm("test.fast")
+            watchdog.disarm()
+        time.sleep(0.2)
+        self.assertEqual(hung, [])
+
+    def test_interrupt(self):
+        watchdog, hung = self.make_watchdog(0.01)
+        watchdog.arm("test.slow")
+        time.sleep(0.2)
+        ident, token = hung[0][2:]
+        watchdog.disarm()
+        watchdog.arm("test.next")
+        called = []
+        # the hung test is over: nothing is raised into the next one
+        self.assertFalse(watchdog.interrupt(ident, token, WatchdogTimeout,
+                                            lambda: called.append(1)))
+        self.assertEqual(called, [])
+        watchdog.disarm()
+
+        def runs_too_long():
+            watchdog.arm("test.stuck")
+            try:
+                for nr in range(1000):
+                    time.sleep(0.01)
+            except WatchdogTimeout:
+                interrupted.append(True)
+            finally:
+                watchdog.disarm()
+        interrupted = []
+        thread = threading.Thread(target=runs_too_long)
+        thread.start()
+        while len(hung) < 2:
+            time.sleep(0.01)
+        ident, token = hung[1][2:]
+        self.assertTrue(watchdog.interrupt(ident, token, WatchdogTimeout,
+                                           lambda: called.append(1)))
+        thread.join()
+        self.assertEqual((called, interrupted), ([1], [True]))
+
+    def test_interrupt_sleep(self):
+        if threading.current_thread().name != "MainThread":
+            raise SkipTest("signals only reach the main thread")
+        watchdog, hung = self.make_watchdog(0.05)
+
+        def interrupt(*args):
+            hung.append(args)
+            watchdog.interrupt(args[2], args[3], WatchdogTimeout)
+        watchdog._on_timeout = interrupt
+        if not watchdog.catch_signal():
+            raise SkipTest("can't send signals to threads here")
+        watchdog.arm("test.sleeps")
+        start = time.time()
+        try:
+            self.assertRaises(WatchdogTimeout, time.sleep, 5)
+        finally:
+            watchdog.disarm()
+        self.assertTrue(time.time() - start < 4)
+        self.assertEqual(len(hung), 1)
+
+    def test_in_result_hooks(self):
+        proxy = {"__name__": "nose.proxy"}
+        exec("def addSuccess(call): return call()", proxy)
+        self.assertFalse(in_result_hooks(sys._getframe()))
+        self.assertTrue(in_result_hooks(
+            proxy["addSuccess"](lambda: sys._getframe())))
+
+    def test_no_interrupt_in_result_hooks(self):
+        watchdog, hung = self.make_watchdog(0.01)
+        proxy = {"__name__": "nose.proxy"}
+        exec("def addSuccess(call): return call()", proxy)
+
+        def reports_slowly():
+            watchdog.arm("test.done")
+            try:
+                proxy["addSuccess"](lambda: time.sleep(0.5))
+            except WatchdogTimeout:
+                interrupted.append(True)
+            finally:
+                watchdog.disarm()
+        interrupted = []
+        thread = threading.Thread(target=reports_slowly)
+        thread.start()
+        while not hung:
+            time.sleep(0.01)
+        ident, token = hung[0][2:]
+        self.assertFalse(watchdog.interrupt(ident, token, WatchdogTimeout))
+        thread.join()
+        self.assertEqual(interrupted, [])
+
+    def test_report(self):
+        formatter, live = make_formatter(renderer=PlainRenderer())
+        test = FakeTest("test.slow")
+        formatter.start_test(test)
+        log = io.BytesIO()
+        FormatterTee(formatter, EventLogWriter(log, str)).test_hung(
+            "test.slow", 2.0, format_thread_stacks())
+        formatter.test_success(test)
+        lines = live.getvalue().splitlines()
+        self.assertEqual(lines[0], "test.slow ... ")
+        self.assertEqual(lines[1], "WATCHDOG: test.slow has been running "
+                                   "for 2.000 seconds")
+        self.assertTrue("Thread MainThread (most recent call last):"
+                        in lines)
+        self.assertEqual(lines[-1], "test.slow ... ok")
+
+        replayed, output = make_formatter(renderer=PlainRenderer())
+        replay_event_log(io.BytesIO(log.getvalue()), replayed)
+        self.assertEqual(output.getvalue().splitlines(), lines[1:-1])
+
+
+class TestAggregates(unittest.TestCase):
+    def test_rows(self):
+        aggregates = Aggregates()
+        aggregates.add("spam", None, 1.0)
+        aggregates.add("spam", "failure", 2.0)
+        aggregates.add("eggs", None, 5.0)
+        aggregates.add("ham", "skip", 0.5)
+
+        def other_thread():
+            aggregates.add("eggs", "error", 0.5)
+            aggregates.add("spam", "skip", 4.0)
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        thread.join()
+        self.assertEqual(aggregates.rows(), [
+            ("spam", 3, 1, 0, 1, 7.0, 4.0),
+            ("eggs", 2, 0, 1, 0, 5.5, 5.0),
+            ("ham", 1, 0, 0, 1, 0.5, 0.5)])
+
+    def test_group_names(self):
+        self.assertEqual(group_names(FakeTest("pkg.mod.Class.test")),
+                         ("pkg.mod", "pkg.mod.Class"))
+        self.assertEqual(group_names(FakeTest("mod.test")), ("mod", "mod"))
+
+    def test_table(self):
+        rows = [("pkg.mod", 3, 1, 0, 1, 7.0, 4.0),
+                ("x" * 50, 1, 0, 0, 0, 0.25, 0.25)]
+        formatter, live = make_formatter(renderer=PlainRenderer())
+        log = io.BytesIO()
+        FormatterTee(formatter, EventLogWriter(log, str)).print_aggregates(
+            "module", rows)
+        lines = live.getvalue().splitlines()
+        self.assertEqual(lines[1].split(), ["By", "module", "tests", "fail",
+                                            "error", "skip", "total", "max"])
+        self.assertEqual(lines[2].split(), ["pkg.mod", "3", "1", "0", "1",
+                                            "7.000s", "4.000s"])
+        self.assertTrue(lines[3].startswith("..." + "x" * 37 + " "))
+
+        replayed, output = make_formatter(renderer=PlainRenderer())
+        replay_event_log(io.BytesIO(log.getvalue()), replayed)
+        self.assertEqual(output.getvalue(), live.getvalue())
+
+
+class TestRerun(unittest.TestCase):
+    def test_flaky(self):
+        FlakyResults.runs = 0
+        stream = io.StringIO()
+        success = nose.core.run(
+            argv=["nosetests", "--with-color", "--color-renderer=plain",
+                  "--color-rerun-failures=2", "test:FlakyResults"],
+            config=Config(stream=stream, plugins=PluginManager(
+                plugins=[ColorOutputPlugin(), Skip()])))
+        output = stream.getvalue()
+        self.assertFalse(success)
+        self.assertTrue("FLAKY: test.FlakyResults.test_flaky" in output)
+        self.assertTrue("FAIL: test.FlakyResults.test_broken" in output)
+        self.assertTrue("FAILED (failures=1, flaky=1)" in output)
+        self.assertEqual(FlakyResults.runs, 2)
+
+    def test_loadable_name(self):
+        self.assertEqual(loadable_name(FakeTest("spam")), None)
+
+
+class TestResultCache(unittest.TestCase):
+    modules = {"cache_helper": "def value():\n    return 1\n",
+               "cache_other": "X = 2\n",
+               "cache_tests": "from cache_helper import value\n"
+                              "def test_value():\n"
+                              "    assert value() == 1\n"}
+
+    def setUp(self):
+        self.project_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.project_dir)
+        sys.path.insert(0, self.project_dir)
+        self.addCleanup(sys.path.remove, self.project_dir)
+        for name, source in self.modules.items():
+            self.write_module(name, source)
+            self.addCleanup(sys.modules.pop, name, None)
+        __import__("cache_tests")
+        __import__("cache_other")
+
+    def write_module(self, name, source):
+        with open(os.path.join(self.project_dir, name + ".py"), "w") as f:
+            f.write(source)
+
+    def module_hash(self, name):
+        return SourceHasher(self.project_dir).module_hash(name)
+
+    def test_hash_follows_imports(self):
+        original = self.module_hash("cache_tests")
+        self.assertTrue(original)
+        self.assertEqual(self.module_hash("cache_tests"), original)
+        self.write_module("cache_other", "X = 3\n")
+        self.assertEqual(self.module_hash("cache_tests"), original)
+        self.write_module("cache_helper", "def value():\n    return 2\n")
+        self.assertNotEqual(self.module_hash("cache_tests"), original)
+
+    def test_outside_project(self):
+        self.assertEqual(self.module_hash("unittest"), None)
+        self.assertEqual(self.module_hash("no_such_module"), None)
+
+    def test_cache_file(self):
+        path = os.path.join(self.project_dir, "cache.json")
+        self.assertEqual(load_result_cache(path), {})
+        save_result_cache(path, {"test.spam": "abc"})
+        self.assertEqual(load_result_cache(path), {"test.spam": "abc"})
+
+    def test_report(self):
+        formatter, output = make_formatter(verbosity=1,
+                                           renderer=PlainRenderer())
+        test = FakeTest("test.spam")
+        formatter.start_test(test)
+        formatter.test_cached(test)
+        formatter.stop_test(test)
+        summary = nose.util.odict()
+        summary["cached"] = 1
+        formatter.print_summary(True, summary, 0, 0.0, 1.0)
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith("c-"))
+        self.assertEqual(lines[-1], "OK (cached=1)")
+
+
+class TestProgress(unittest.TestCase):
+    def test_from_history(self):
+        progress = Progress([1.0, 1.0, 2.0, None], 10.0)
+        self.assertAlmostEqual(progress.predicted, 16.0 / 3)
+        self.assertFalse(progress.test_done())
+        self.assertFalse(progress.test_done())
+        # running at half the speed of the history
+        progress._start = time.time() - 4.0
+        left, rate = progress.estimate()
+        self.assertAlmostEqual(left, (16.0 / 3 - 2.0) * 2, places=2)
+        self.assertAlmostEqual(rate, 0.5, places=2)
+
+    def test_from_rate(self):
+        progress = Progress([None] * 4, 10.0)
+        self.assertEqual(progress.predicted, None)
+        self.assertEqual(progress.estimate()[0], None)
+        progress.test_done()
+        progress._start = time.time() - 2.0
+        self.assertAlmostEqual(progress.estimate()[0], 6.0, places=2)
+
+    def test_refresh_due(self):
+        progress = Progress([None] * 4, 0.0)
+        self.assertTrue(progress.test_done())
+
+    def test_output(self):
+        formatter, output = make_formatter(verbosity=1,
+                                           renderer=PlainRenderer())
+        progress = Progress([0.5, 0.5, 0.5], 0.0)
+        formatter.set_progress(progress)
+        test = FakeTest("test.spam")
+        formatter.start_test(test)
+        formatter.test_success(test)
+        formatter.stop_test(test)
+        self.assertTrue(re.match(r"\. \[ETA [\d.]+ seconds, 1/3 tests, "
+                                 r"[\d.]+ tests/s\]\n$", output.getvalue()),
+                        output.getvalue())
+        formatter.print_summary(True, {}, 3, 0.0, 2.0)
+        self.assertTrue(output.getvalue().endswith(
+            "Predicted 1.500 seconds, took 2.000 seconds\n"))
+
+
+def frame_lines(name, lineno=1):
+    return ['  File "spam.py", line %d, in %s' % (lineno, name),
+            "    %s()" % name]
+
+
+class TestRepeatedFrames(unittest.TestCase):
+    def collapse(self, names, min_frames=3):
+        lines = []
+        for name in names:
+            lines.extend(frame_lines(name) if name != "-" else ["Exception"])
+        result = []
+        for item in collapse_repeated_frames(split_traceback_frames(lines),
+                                             min_frames):
+            if isinstance(item, tuple):
+                result.append(item)
+            elif item[0].startswith("  File"):
+                result.append(item[0].rsplit(" ", 1)[1])
+            else:
+                result.append("-")
+        return result
+
+    def test_period_one(self):
+        self.assertEqual(self.collapse(["t"] + ["f"] * 10),
+                         ["t", "f", (1, 9)])
+
+    def test_longer_period(self):
+        self.assertEqual(self.collapse(["t"] + ["a", "b", "c"] * 5 + ["a"]),
+                         ["t", "a", "b", "c", (3, 4), "a"])
+
+    def test_short_runs_kept(self):
+        self.assertEqual(self.collapse(["a", "b", "a", "b"]),
+                         ["a", "b", "a", "b"])
+        self.assertEqual(self.collapse(["a", "b", "c", "a", "d"]),
+                         ["a", "b", "c", "a", "d"])
+
+    def test_other_lines_end_runs(self):
+        self.assertEqual(self.collapse(["a", "a", "-", "a", "a", "a", "a"]),
+                         ["a", "a", "-", "a", (1, 3)])
+
+    def test_locals_ignored(self):
+        lines = []
+        for depth in range(5):
+            lines.extend(frame_lines("f") + ["        n = %d" % depth])
+        items = list(collapse_repeated_frames(split_traceback_frames(lines)))
+        self.assertEqual(items[0], frame_lines("f") + ["        n = 0"])
+        self.assertEqual(items[1], (1, 4))
+
+    def test_rendered(self):
+        formatter, output = make_formatter(renderer=PlainRenderer())
+        lines = ["Traceback (most recent call last):"]
+        for nr in range(100):
+            lines.extend(frame_lines("ping", 2) + frame_lines("pong", 4))
+        lines.append("RecursionError: maximum recursion depth exceeded")
+        formatter.print_colorized_traceback("\n".join(lines))
+        self.assertEqual(output.getvalue().splitlines(), lines[:5] + [
+            "  [previous 2 frames repeated 99 times]", lines[-1]])
+
+
+class TestMaxOutput(unittest.TestCase):
+    def test_parse_size(self):
+        self.assertEqual(parse_size("500"), 500)
+        self.assertEqual(parse_size("200k"), 200 * 1024)
+        self.assertEqual(parse_size("10MB"), 10 * 1024 * 1024)
+        self.assertRaises(ValueError, parse_size, "lots")
+
+    def test_spill(self):
+        spill_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, spill_dir)
+        spill_path = os.path.join(spill_dir, "report.txt")
+        formatter, output = make_formatter(renderer=PlainRenderer(),
+                                           max_report_size=300,
+                                           spill_path=spill_path)
+        traceback = ("Traceback (most recent call last):\n"
+                     "AssertionError: spam\n")
+        failures = [(FakeTest("test.f%d" % nr), traceback, AssertionError)
+                    for nr in range(4)]
+        formatter.print_error_list("ERROR", failures[:1])
+        formatter.print_error_list("FAIL", failures[1:])
+        formatter.print_summary(False, {}, 4, 0.0, 1.0)
+        formatter.stop_tests()
+        terminal = output.getvalue()
+        self.assertTrue("ERROR: test.f0" in terminal)
+        self.assertTrue("FAIL: test.f1" in terminal)
+        self.assertFalse("test.f2" in terminal)
+        self.assertTrue("2 more (FAIL=2) written to %s" % spill_path
+                        in terminal)
+        with io.open(spill_path, encoding="utf-8") as spill:
+            spilled = spill.read()
+        self.assertTrue("FAIL: test.f2" in spilled)
+        self.assertTrue("FAIL: test.f3" in spilled)
+        self.assertFalse("test.f1" in spilled)
+
+
+def equal_failure(first, second, msg=None):
+    return exc_info_of(lambda: unittest.TestCase().assertEqual(first, second,
+                                                               msg))
+
+
+class TestAssertionDiff(unittest.TestCase):
+    text = "".join("line %d\n" % nr for nr in range(50))
+
+    def format(self, exc_info, **kwargs):
+        return "".join(format_exception(
+            *exc_info, assertion_diff=AssertionDiff(**kwargs)))
+
+    def test_lines(self):
+        changed = self.text.replace("line 20", "lime 20").replace(
+            "line 40\n", "")
+        formatted = self.format(equal_failure(self.text, changed, "spam"))
+        diff = formatted.split("Diff (-first +second):\n")[1]
+        self.assertEqual(diff.splitlines()[:8], [
+            "@@ -18,7 +18,7 @@", "  line 17", "  line 18", "  line 19",
+            "- line 20", "?   ^", "+ lime 20", "?   ^"])
+        self.assertTrue("- line 40\n  line 41" in diff)
+        self.assertTrue("\nspam\n" in formatted)
+        # unittest's own diff is left out
+        self.assertFalse("+ lime 20\n\n" in formatted)
+
+    def test_containers(self):
+        formatted = self.format(equal_failure({"a": 1, "b": [2] * 30},
+                                              {"a": 1, "b": [2] * 29}))
+        self.assertTrue("Diff (-first +second):" in formatted)
+        self.assertTrue("         2,\n-        2,\n         2]}" in formatted)
+
+    def test_short_values(self):
+        self.assertEqual(self.format(equal_failure(1, 2)).splitlines()[-1],
+                         "AssertionError: 1 != 2")
+
+    def test_over_budget(self):
+        changed = self.text.replace("line 20", "lime 20")
+        for kwargs, reason in [({"max_size": 100},
+                                "784 characters, more than 100"),
+                               ({"budget": -1}, "took more than -1s")]:
+            formatted = self.format(equal_failure(self.text, changed),
+                                    **kwargs)
+            diff = formatted.split("Diff (-first +second):\n")[1]
+            self.assertEqual(diff.splitlines(), [
+                "@@ diff skipped (%s): -50 +50 lines, first difference at "
+                "line 21 @@" % reason,
+                "- line 20", "?   ^", "+ lime 20", "?   ^"])
+
+    def format_quickly(self, exc_info, budget):
+        start = time.time()
+        formatted = self.format(exc_info, budget=budget)
+        self.assertTrue(time.time() - start < budget + 0.2)
+        return formatted.split("Diff (-first +second):\n")[1]
+
+    def test_slow_match(self):
+        first = "".join("line %d\n" % nr for nr in range(15000))
+        second = re.sub("line (\\d*0)\n", "changed \\1\n", first)
+        diff = self.format_quickly(equal_failure(first, second), 0.02)
+        self.assertTrue(diff.startswith("@@ diff skipped (would take about "))
+        self.assertTrue(", more than 0.02s): -15000 +15000 lines, first "
+                        "difference at line 1 @@" in diff)
+
+    def test_slow_pprint(self):
+        diff = self.format_quickly(
+            equal_failure(list(range(300000)), tuple(range(300000))), 0.01)
+        self.assertTrue(re.match(r"@@ diff skipped \(\d+ characters, more "
+                                 r"than 1048576\) @@\n$", diff), diff)
+
+    def test_long_lines(self):
+        first = "abc" * 1000
+        second = first[:1500] + "Z" + first[1501:]
+        lines = self.format(equal_failure(first, second)).splitlines()
+        self.assertTrue(lines[-4].startswith("- ...bcabc"))
+        self.assertEqual(len(lines[-4]), len("- ...") + 200 + len("..."))
+        self.assertEqual(lines[-3], "? " + " " * 53 + "^")
+
+    def test_colors(self):
+        formatter, output = make_formatter(renderer=HtmlRenderer())
+        formatter.print_colorized_traceback(
+            "AssertionError: spam\nDiff (-first +second):\n"
+            "@@ -1,1 +1,1 @@\n- ab\n?  ^\n+ ax\n?  ^\n")
+        text = output.getvalue()
+        self.assertTrue(u"\0expected-output\0- a\0character-diffs\0b"
+                        in text)
+        self.assertTrue(u"\0actual-output\0+ a\0character-diffs\0x"
+                        in text)
+        self.assertFalse("?" in text)
+
+
+class TestListeners(unittest.TestCase):
+    def test_events(self):
+        recorder = RecordingPlugin()
+        stream = io.StringIO()
+        nose.core.run(
+            argv=["nosetests", "--with-color", "--with-recording",
+                  "--color-renderer=plain", "test:DumpResults"],
+            config=Config(stream=stream, plugins=PluginManager(
+                plugins=[ColorOutputPlugin(), Skip(), recorder])))
+        finished = dict((event.test_id, event)
+                        for event in recorder.finished)
+        self.assertEqual(sorted(recorder.started), sorted(finished))
+        self.assertEqual(
+            [(finished[name].outcome, finished[name].label)
+             for name in ("test.DumpResults.test_good",
+                          "test.DumpResults.test_bad",
+                          "test.DumpResults.test_boom",
+                          "test.DumpResults.test_skip")],
+            [("success", "ok"), ("failure", "FAIL"), ("error", "ERROR"),
+             ("skip", "SKIP")])
+        good = finished["test.DumpResults.test_good"]
+        self.assertEqual(good.traceback, None)
+        self.assertTrue(good.duration >= 0)
+        boom = finished["test.DumpResults.test_boom"]
+        self.assertTrue("ValueError: Example of" in boom.traceback)
+        # the report shows the very same text listeners were given, which
+        # is in ANSI colours whatever the report is rendered with
+        colored = boom.colored_traceback
+        self.assertTrue("\033[" in colored)
+        self.assertTrue(re.sub("\033\\[[0-9;]*m", "", colored)
+                        in stream.getvalue())
+        self.assertTrue(boom.colored_traceback is colored)
+        skip = finished["test.DumpResults.test_skip"]
+        self.assertEqual(skip.traceback, "Example of Skip test.")
+        summary, = recorder.summaries
+        self.assertFalse(summary.success)
+        self.assertEqual(summary.tests_run, 4)
+        self.assertEqual(summary.counts["failures"], 1)
+        self.assertEqual(summary.counts["errors"], 1)
+
+    def test_remove_listener(self):
+        plugin = ColorOutputPlugin()
+        first, second = Listener(), Listener()
+        plugin.add_listener(first)
+        plugin.add_listener(second)
+        plugin.remove_listener(first)
+        self.assertEqual(plugin._listeners, [second])
+
+
+class TestThemes(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.theme_path = self.write_theme("spam.theme",
+                                           "# comment\n\npass = red\n"
+                                           "failure=rgb(00ff00)\n")
+
+    def write_theme(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, "w") as fileobj:
+            fileobj.write(text)
+        return path
+
+    def test_parse_theme(self):
+        self.assertEqual(
+            parse_theme("pass = 45\n").get("pass").terminal_code(),
+            "\033[38;5;45m")
+        for text, error in [("pass red", "line 1: missing equals"),
+                            ("\npass =", "line 2: missing colour"),
+                            ("pass = spam", "line 1: Bad named colour")]:
+            try:
+                parse_theme(text)
+            except ValueError as exc:
+                self.assertTrue(str(exc).startswith(error), exc)
+            else:
+                self.fail("no error for %r" % text)
+
+    def test_cache(self):
+        cache_path = os.path.join(self.dir, "cache", "themes.json")
+        theme = ThemeCache(cache_path).load(self.theme_path,
+                                            ["ansi16", "html"])
+        self.assertEqual(sorted(theme), ["failure", "pass"])
+        renderer = Ansi16Renderer(theme)
+        self.assertEqual(renderer.color("pass"),
+                         parse_color("red").terminal_code())
+        self.assertEqual(renderer.color("failure"),
+                         parse_color("rgb(00ff00)").ansi16().terminal_code())
+        self.assertEqual(theme["failure"].css_color(), "#00ff00")
+
+        # same mtime and size: the compiled tables are used
+        stat = os.stat(self.theme_path)
+        changed = "pass = red\nfailure=rgb(0000ff)\n"
+        self.write_theme("spam.theme",
+                         changed + "#" * (stat.st_size - len(changed)))
+        os.utime(self.theme_path, (stat.st_atime, stat.st_mtime))
+        theme = ThemeCache(cache_path).load(self.theme_path, ["html"])
+        self.assertEqual(theme["failure"].css_color(), "#00ff00")
+
+        os.utime(self.theme_path, (stat.st_atime, stat.st_mtime + 10))
+        theme = ThemeCache(cache_path).load(self.theme_path, ["html"])
+        self.assertEqual(theme["failure"].css_color(), "#0000ff")
+
+    def test_find_theme(self):
+        user_dir = os.path.join(self.dir, "user")
+        project_dir = os.path.join(self.dir, "project")
+        for theme_dir in [os.path.join(user_dir, "rudolf", "themes"),
+                          os.path.join(project_dir, ".rudolf", "themes")]:
+            os.makedirs(theme_dir)
+            for name in ["both", os.path.basename(os.path.dirname(
+                    os.path.dirname(theme_dir)))]:
+                self.write_theme(os.path.join(theme_dir, name + ".theme"),
+                                 "")
+        old_config_home = os.environ.get("XDG_CONFIG_HOME")
+        os.environ["XDG_CONFIG_HOME"] = user_dir
+        try:
+            dirs = theme_dirs(project_dir)
+        finally:
+            if old_config_home is None:
+                del os.environ["XDG_CONFIG_HOME"]
+            else:
+                os.environ["XDG_CONFIG_HOME"] = old_config_home
+        self.assertEqual(find_theme("both", dirs), os.path.join(
+            project_dir, ".rudolf", "themes", "both.theme"))
+        self.assertEqual(find_theme("user", dirs), os.path.join(
+            user_dir, "rudolf", "themes", "user.theme"))
+        self.assertEqual(find_theme(self.theme_path, dirs), self.theme_path)
+        self.assertRaises(ValueError, find_theme, "eggs", dirs)
+
+    def test_plugin(self):
+        plugin = ColorOutputPlugin()
+        parser = optparse.OptionParser()
+        plugin.addOptions(parser, env={})
+        options, args = parser.parse_args(
+            ["--with-color", "--color-renderer=ansi256",
+             "--color-theme=" + self.theme_path, "--colors=pass=blue"])
+        cache_dir = os.path.join(self.dir, "cache")
+        old_cache_home = os.environ.get("XDG_CACHE_HOME")
+        os.environ["XDG_CACHE_HOME"] = cache_dir
+        try:
+            plugin.configure(options, Config())
+        finally:
+            if old_cache_home is None:
+                del os.environ["XDG_CACHE_HOME"]
+            else:
+                os.environ["XDG_CACHE_HOME"] = old_cache_home
+        self.assertEqual(plugin._renderer.color("failure"),
+                         parse_color("rgb(00ff00)").terminal_code())
+        self.assertEqual(plugin._renderer.color("pass"),
+                         parse_color("blue").terminal_code())
+        self.assertTrue(os.path.exists(
+            os.path.join(cache_dir, "rudolf", "themes.json")))
+
+
 class TestRudolf(object):
     """ integration tests. """
 
@@ -216,6 +1555,32 @@ class SpamPlugin(nose.plugins.Plugin):
         self.stream.write('spam')
 
 
+class RecordingPlugin(nose.plugins.Plugin, Listener):
+    name = "recording"
+
+    def begin(self):
+        self.started, self.finished, self.summaries = [], [], []
+        ColorOutputPlugin.find(self.conf).add_listener(self)
+
+    def test_started(self, event):
+        assert event.outcome is None and event.duration is None
+        self.started.append(event.test_id)
+
+    def test_finished(self, event):
+        self.finished.append(event)
+
+    def run_finished(self, summary):
+        self.summaries.append(summary)
+
+
+class ResultKeeper(nose.plugins.Plugin):
+    name = "result-keeper"
+
+    def finalize(self, result):
+        self.error_classes = list(result.errorClasses.values())
+        self.skipped = result.skipped
+
+
 class DumpResults(object):
     def test_good(self):
         assert True
@@ -243,3 +1608,22 @@ class DoctestResults(object):
     ... # doctest: +REPORT_NDIFF
     Perfect Example
     """
+
+
+class LabelResults(object):
+    def test_skip(self):
+        raise SkipTest("skipped")
+
+    def test_deprecated(self):
+        raise DeprecatedTest("deprecated")
+
+
+class FlakyResults(object):
+    runs = 0
+
+    def test_flaky(self):
+        FlakyResults.runs += 1
+        assert FlakyResults.runs > 1, "fails the first time"
+
+    def test_broken(self):
+        assert False